@@ -11,6 +11,8 @@ import os
 import LoggerClient
 import Daemon
 from FileUtils import futils
+from DirWatcher import DirWatcher
+from ChecksumCache import checksum_cache
 from StatusFlag import status
 
 
@@ -19,8 +21,21 @@ class AbstractDatasetController(object):
     """
     Base class for DatasetTransferController, TransferUnitController,
     and DatasetArrivalMonitor.
+
+    The controllers work in steps: setUp() once, then step() (which
+    returns the final status when it is time to stop, having called
+    tearDown()) and a wait for the files given by getWait(), over and
+    over.  They either loop over these
+    themselves, in a process of their own, or are driven by a StreamEngine
+    along with other data_streams, in which case the engine sets
+    shared_watcher before setUp().
     """
 
+    # a DirWatcher to add our directories to, rather than having our own
+    shared_watcher = None
+    # polling although the watcher is event driven (see initWatcher)
+    polling = False
+
     def __init__(self, dataset_config, debug_on=False):
         self.dconfig = dataset_config
         self.setVarsFromConfig()
@@ -43,6 +58,14 @@ class AbstractDatasetController(object):
         self.dataset_dir = self.dconfig.get("data_stream.directory")
         self.quarantine_dir = self.dconfig.get("outgoing.quarantine_dir")
         self.poll_interval = self.dconfig.get("global.general_poll_interval")
+        self.use_inotify = self.dconfig.get("global.use_inotify")
+        self.resync_interval = self.dconfig.get("global.inotify_resync_interval")
+        checksum_cache.configure(
+            cache_dir = self.dconfig.get("global.checksum_cache_dir"),
+            use_xattr = self.dconfig.get("global.checksum_use_xattr"),
+            buffer_size = self.dconfig.get("global.checksum_buffer_size"),
+            read_mode = self.dconfig.get("global.checksum_read_mode"),
+            drop_cache = self.dconfig.get("global.checksum_drop_cache"))
 
     def updateStatusAndConfig(self):
         """
@@ -62,6 +85,90 @@ class AbstractDatasetController(object):
             self.status = status.STOPPED
 
 
+    def initWatcher(self, *dir_paths):
+        """
+        Set up the watcher used by waitForChanges() on the given directories.
+        If global.use_inotify is set but inotify cannot be used, we fall
+        back to polling.  With a shared_watcher which cannot watch one of
+        the directories, we poll instead of waiting for its events.
+        """
+        self.watched_dirs = dir_paths
+        if self.shared_watcher != None:
+            self.watcher = self.shared_watcher
+            if not self.watcher.isEventDriven():
+                return
+            for dir_path in dir_paths:
+                if not self.watcher.addDir(dir_path):
+                    self.polling = True
+                    self.warn("cannot watch %s with inotify - polling "
+                              "every %s seconds" %
+                              (dir_path, self.poll_interval))
+            return
+        self.watcher = DirWatcher(use_inotify = self.use_inotify)
+        for dir_path in dir_paths:
+            if self.watcher.isEventDriven() and not self.watcher.addDir(dir_path):
+                self.watcher.close()
+        if self.use_inotify:
+            if self.watcher.isEventDriven():
+                self.info("Watching for arrivals with inotify in: %s" %
+                          ", ".join(dir_paths))
+            else:
+                self.warn("inotify not available - polling every %s seconds" %
+                          self.poll_interval)
+
+
+    def isEventDriven(self):
+        """
+        Whether the watcher tells us when files land in all of our
+        directories (see initWatcher)
+        """
+        return self.watcher.isEventDriven() and not self.polling
+
+
+    def waitForChanges(self, wanted = None, timeout = None):
+        """
+        Wait before rescanning.  When watching with inotify, this returns as
+        soon as a file of interest lands (wanted is an optional callable
+        taking a file name), or after global.inotify_resync_interval seconds
+        anyway in case anything was missed.  Otherwise just sleep for the
+        poll interval.  A timeout can be given to wait for less time than
+        either of these.
+        """
+        if self.isEventDriven():
+            if timeout == None:
+                timeout = self.resync_interval
+            names = self.watcher.wait(timeout, wanted = wanted)
+            if names:
+                self.debug("Woken by arrival of: %s" % names[:3])
+        elif timeout != None:
+            time.sleep(min(timeout, self.poll_interval))
+        else:
+            self.info("Sleeping for %d seconds..." % self.poll_interval)
+            time.sleep(self.poll_interval)
+
+
+    def getWaitTime(self, timeout = None):
+        """
+        How long waitForChanges(timeout = timeout) waits if no files of
+        interest land
+        """
+        if self.isEventDriven():
+            if timeout == None:
+                return self.resync_interval
+            return timeout
+        if timeout != None:
+            return min(timeout, self.poll_interval)
+        return self.poll_interval
+
+
+    def tearDown(self):
+        """
+        Let go of anything shared with other data_streams, once we have
+        stopped or finished (or, in a StreamEngine, failed)
+        """
+        pass
+
+
     # listDir moved to FileUtils - leave a wrapper here
     def listDir(self, *args, **kwargs):
         return futils.listDir(*args, **kwargs)
@@ -0,0 +1,253 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Sharing the outgoing link between the data_streams on this host.
+
+With global.bandwidth_limit set (KB/s), the data_streams which currently
+have something to send get shares of it in proportion to their
+data_stream.priority.  As each DatasetTransferController runs in its own
+process, they coordinate through files in a directory under
+global.state_dir:
+
+  busy.<data_stream>   written by a data_stream while it has items to send
+                       (its priority and process id), removed when idle
+
+  allocations          the share of each busy data_stream (KB/s), written
+                       by MiStaMoverController as data_streams go busy or
+                       idle (see BandwidthScheduler.rebalance)
+
+The shares are enforced by the transfer modules (rsync --bwlimit, and a
+ThrottledWriter for directories streamed with outgoing.stream_dirs).
+"""
+
+import os
+import time
+import json
+import errno
+
+from FileUtils import futils
+
+
+def shareBandwidth(total, weights, minimum = 1):
+    """
+    Divide total between names in proportion to their weights (a dict),
+    giving each at least minimum.  Returns a dict of name -> int.
+    """
+    weights = dict((name, max(weight, 1))
+                   for name, weight in weights.items())
+    total_weight = sum(weights.values())
+    return dict((name, max(int(total * weight / total_weight), minimum))
+                for name, weight in weights.items())
+
+
+def processExists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class BandwidthScheduler(object):
+    """
+    The files through which the data_streams share global.bandwidth_limit
+    (see the module doc string).  Each process has its own one of these.
+    """
+
+    allocations_file = "allocations"
+    busy_prefix = "busy."
+
+    def __init__(self, state_dir, total):
+        self.dir_path = os.path.join(state_dir, "bandwidth")
+        futils.ensureDirExists(self.dir_path)
+        self.total = total
+        self.busy = {}
+
+
+    def _write(self, name, value):
+        """
+        Write a file as json (tmp file and rename, so that a reader never
+        sees it half written)
+        """
+        path = os.path.join(self.dir_path, name)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp_path, "w")
+        try:
+            json.dump(value, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+
+    def _read(self, name):
+        try:
+            f = open(os.path.join(self.dir_path, name))
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+
+    def setBusy(self, name, priority, busy = True):
+        """
+        Record whether a data_stream has something to send.  Does nothing
+        if that is already what it last said.
+        """
+        if self.busy.get(name) == (busy, priority):
+            return
+        path = os.path.join(self.dir_path, self.busy_prefix + name)
+        if busy:
+            self._write(self.busy_prefix + name,
+                        {"priority": priority, "pid": os.getpid()})
+        elif os.path.exists(path):
+            os.remove(path)
+        self.busy[name] = (busy, priority)
+
+
+    def getBusy(self):
+        """
+        The busy data_streams and their priorities.  The files of those
+        whose processes have gone away are removed.
+        """
+        busy = {}
+        for file_name in os.listdir(self.dir_path):
+            if (not file_name.startswith(self.busy_prefix)
+                or file_name.endswith(".tmp")):
+                continue
+            entry = self._read(file_name)
+            if entry == None:
+                continue
+            if not processExists(entry["pid"]):
+                try:
+                    os.remove(os.path.join(self.dir_path, file_name))
+                except OSError:
+                    pass
+                continue
+            busy[file_name[len(self.busy_prefix):]] = entry["priority"]
+        return busy
+
+
+    def rebalance(self):
+        """
+        Share the bandwidth between the data_streams which are busy now,
+        and write the allocations if they have changed.  Returns the
+        allocations if so, otherwise None.
+        """
+        allocations = shareBandwidth(self.total, self.getBusy())
+        if allocations == self.getAllocations():
+            return None
+        self._write(self.allocations_file, allocations)
+        return allocations
+
+
+    def getAllocations(self):
+        allocations = self._read(self.allocations_file) or {}
+        return dict((name.encode("utf-8"), value)
+                    for name, value in allocations.items())
+
+
+    def getAllocation(self, name, priority = 1):
+        """
+        The bandwidth (KB/s) that a data_stream may use now.  If it has
+        only just gone busy, and MiStaMoverController has not shared the
+        bandwidth out again yet, it is the share it will get.
+        """
+        allocation = self.getAllocations().get(name)
+        if allocation == None:
+            busy = self.getBusy()
+            busy.setdefault(name, priority)
+            allocation = shareBandwidth(self.total, busy)[name]
+        return allocation
+
+
+    def clear(self):
+        """
+        Remove all of the files (e.g. at startup, in case any were left by
+        a previous run)
+        """
+        for file_name in os.listdir(self.dir_path):
+            try:
+                os.remove(os.path.join(self.dir_path, file_name))
+            except OSError:
+                pass
+
+
+def getScheduler(config):
+    """
+    A BandwidthScheduler for the config (global or data_stream), or None if
+    global.bandwidth_limit is not set
+    """
+    total = config.get("global.bandwidth_limit")
+    if not total:
+        return None
+    return BandwidthScheduler(futils.getStateDir(config), total)
+
+
+def getPriority(config):
+    """
+    The priority of a data_stream, as DiskSpaceMonitor sees it
+    """
+    priority = config.get("data_stream.priority")
+    if priority == None:
+        priority = config.get("disk_space_monitor.base_priority")
+    return priority or 1
+
+
+class ThrottledWriter(object):
+    """
+    A write-only file object which passes everything on to another one, no
+    faster than get_rate() KB/s (a token bucket, allowing bursts of up to a
+    second's worth).  The rate is asked for again every few seconds, so
+    that a long transfer follows changes to its allocation.
+    """
+
+    recheck_interval = 5
+    chunk_size = 0x10000
+
+    def __init__(self, fileobj, get_rate):
+        self.fileobj = fileobj
+        self.get_rate = get_rate
+        self.rate = None
+        self.checked = 0
+        self.tokens = 0.
+        self.filled = time.time()
+
+
+    def getRate(self):
+        now = time.time()
+        if now - self.checked >= self.recheck_interval:
+            self.rate = self.get_rate()
+            self.checked = now
+        return self.rate
+
+
+    def write(self, data):
+        while data:
+            rate = self.getRate()
+            if not rate:
+                self.fileobj.write(data)
+                return
+            rate *= 1024.
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.filled) * rate, rate)
+            self.filled = now
+            # (wait for enough to make the write worthwhile)
+            wanted = min(len(data), self.chunk_size, rate)
+            if self.tokens < wanted:
+                time.sleep(min((wanted - self.tokens) / rate, 1))
+                continue
+            n = min(len(data), int(self.tokens))
+            self.fileobj.write(data[:n])
+            self.tokens -= n
+            data = data[n:]
+
+
+    def flush(self):
+        self.fileobj.flush()
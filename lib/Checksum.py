@@ -0,0 +1,297 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Checksum algorithms for data files.
+
+The algorithm name is what goes in control and receipt files, so both ends
+must agree on these names.  md5 is the default, and the only algorithm
+understood by older versions.  sha256, crc32 and adler32 are always
+available; xxh64 and crc32c are available if the python modules of those
+names (xxhash, crc32c) are installed.
+
+Files can be read either with read() into a buffer or through mmap, and
+where the C library allows, the kernel is told that the file will be read
+sequentially, and optionally asked to drop it from the page cache after
+it has been checksummed (it is usually not read again on this host).
+"""
+
+import io
+import os
+import zlib
+import mmap
+import hashlib
+import threading
+
+# optional fast non-cryptographic hashes
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# posix_fadvise and madvise are not in the python 2 standard library, so
+# call libc directly if we can
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                        use_errno = True)
+    _fadvise_function = getattr(_libc, "posix_fadvise64", _libc.posix_fadvise)
+    _fadvise_function.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                  ctypes.c_longlong, ctypes.c_int]
+    _libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+# from <fcntl.h> and <sys/mman.h> (linux)
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+MADV_SEQUENTIAL = 2
+
+
+default_algorithm = "md5"
+default_buffer_size = 0x100000  # 1 MiB
+
+read_modes = ("auto", "read", "mmap")
+default_read_mode = "auto"
+
+# in "auto" mode, files at least this big are read through mmap
+mmap_threshold = 0x4000000  # 64 MiB
+
+# (largest file size, buffer size) - small buffers for small files, so as
+# not to read ahead for nothing, and larger ones for large files, so as to
+# make fewer system calls
+buffer_sizes = [(0x100000, 0x10000),      # up to 1 MiB: 64 KiB
+                (0x4000000, 0x100000),    # up to 64 MiB: 1 MiB
+                (0x40000000, 0x400000),   # up to 1 GiB: 4 MiB
+                (None, 0x1000000)]        # bigger: 16 MiB
+
+
+class UnsupportedAlgorithm(ValueError):
+    pass
+
+
+class _RunningChecksum(object):
+    """
+    Wraps a function like zlib.crc32(data, value) in the hashlib interface
+    """
+    def __init__(self, function, initial):
+        self.function = function
+        self.value = initial
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+
+def _makers():
+    makers = {"md5": hashlib.md5,
+              "sha256": hashlib.sha256,
+              "crc32": lambda: _RunningChecksum(zlib.crc32, 0),
+              "adler32": lambda: _RunningChecksum(zlib.adler32, 1)}
+    if xxhash:
+        makers["xxh64"] = xxhash.xxh64
+    if crc32c:
+        makers["crc32c"] = lambda: _RunningChecksum(crc32c.crc32c, 0)
+    return makers
+
+_hash_makers = _makers()
+
+
+def getAlgorithms():
+    """
+    Names of the algorithms that can be used here
+    """
+    return sorted(_hash_makers.keys())
+
+
+def isSupported(algorithm):
+    return algorithm in _hash_makers
+
+
+def newHash(algorithm = default_algorithm):
+    """
+    Return a new hash object (with update() and hexdigest() methods) for
+    the named algorithm, or raise UnsupportedAlgorithm
+    """
+    try:
+        return _hash_makers[algorithm]()
+    except KeyError:
+        raise UnsupportedAlgorithm(algorithm)
+
+
+def chooseBufferSize(file_size):
+    """
+    Size of read buffer (or mmap chunk) to use for a file of this size
+    """
+    for max_size, buffer_size in buffer_sizes:
+        if max_size == None or file_size <= max_size:
+            return buffer_size
+
+
+def _fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise if available - it is only advice, so errors are ignored
+    """
+    if _libc:
+        _fadvise_function(fd, offset, length, advice)
+
+
+def _madvise(m, length, advice):
+    """
+    madvise on a (writable) mmap object, if available
+    """
+    if _libc:
+        try:
+            address = ctypes.addressof(ctypes.c_char.from_buffer(m))
+        except (TypeError, ValueError):
+            return
+        _libc.madvise(address, length, advice)
+
+
+# read buffers are kept for reuse, one per size per thread, as allocating
+# a large buffer for every file is not free
+_buffers = threading.local()
+
+def _getBuffer(size):
+    buffers = getattr(_buffers, "buffers", None)
+    if buffers == None:
+        buffers = _buffers.buffers = {}
+    buf = buffers.get(size)
+    if buf == None:
+        buf = buffers[size] = bytearray(size)
+    return buf
+
+
+def _hashRead(h, f, buffer_size, drop_cache):
+    """
+    Feed a file to a hash object through read(), asking for the next chunk
+    to be read ahead while this one is hashed
+    """
+    fd = f.fileno()
+    buf = _getBuffer(buffer_size)
+    offset = 0
+    while True:
+        _fadvise(fd, offset + buffer_size, buffer_size, POSIX_FADV_WILLNEED)
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(buffer(buf, 0, n))
+        if drop_cache:
+            _fadvise(fd, offset, n, POSIX_FADV_DONTNEED)
+        offset += n
+
+
+def _hashMmap(h, fd, size, buffer_size):
+    """
+    Feed a file to a hash object through mmap.  The mapping is private
+    (copy on write, though nothing is written) so that madvise can be
+    given its address.
+    """
+    m = mmap.mmap(fd, size, access = mmap.ACCESS_COPY)
+    try:
+        _madvise(m, size, MADV_SEQUENTIAL)
+        offset = 0
+        while offset < size:
+            n = min(buffer_size, size - offset)
+            h.update(buffer(m, offset, n))
+            offset += n
+    finally:
+        m.close()
+
+
+def _useMmap(read_mode, size):
+    if size == 0:
+        return False  # can't map an empty file
+    if read_mode == "mmap":
+        return True
+    if read_mode == "read":
+        return False
+    return size >= mmap_threshold
+
+
+class HashingWriter(object):
+    """
+    A write-only file object which passes everything on to another one,
+    counting the bytes and (unless algorithm is None) calculating their
+    checksum on the way, so that a file can be checksummed as it is
+    written (or sent) rather than read back afterwards.
+    """
+    def __init__(self, fileobj, algorithm = default_algorithm):
+        self.fileobj = fileobj
+        self.algorithm = algorithm
+        self.hash = None
+        if algorithm:
+            self.hash = newHash(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        if self.hash:
+            self.hash.update(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def calcChecksum(file_path, algorithm = default_algorithm,
+                 buffer_size = None, read_mode = None, drop_cache = False):
+    """
+    Return the checksum of a file as a hex string.
+
+    read_mode is "read" (readinto() a reusable buffer), "mmap", or "auto"
+    (the default: mmap for files of at least mmap_threshold bytes).
+    buffer_size is the size of the buffer, or of the chunks of the mapping
+    passed to the hash, and is chosen by the size of the file if not
+    given.  If drop_cache is set, the file is dropped from the page cache
+    as it is read.
+
+    Raises UnsupportedAlgorithm, or IOError if the file can't be read.
+    """
+    if read_mode not in read_modes + (None,):
+        raise ValueError("checksum read mode must be one of: %s" %
+                         ", ".join(read_modes))
+    h = newHash(algorithm)
+    f = io.open(file_path, "rb", buffering = 0)
+    try:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        buffer_size = buffer_size or chooseBufferSize(size)
+        _fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        mapped = False
+        if _useMmap(read_mode, size):
+            try:
+                _hashMmap(h, fd, size, buffer_size)
+                mapped = True
+            except (EnvironmentError, OverflowError, ValueError):
+                # e.g. too big for the address space - just read it
+                h = newHash(algorithm)
+                f.seek(0)
+        if not mapped:
+            _hashRead(h, f, buffer_size, drop_cache)
+        if drop_cache:
+            # (after unmapping, as mapped pages are not dropped)
+            _fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        f.close()
+    return h.hexdigest()
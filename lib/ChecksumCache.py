@@ -0,0 +1,263 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Remember the checksums of files, so that a file which has not changed is
+only read to calculate its checksum once.
+
+See doc string for class ChecksumCache for details
+"""
+
+import os
+import errno
+import hashlib
+import threading
+
+from FileUtils import futils
+import Checksum
+
+# extended attributes are not in the python 2 standard library, so call
+# libc directly if we can
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                        use_errno = True)
+    _libc.getxattr.restype = ctypes.c_ssize_t
+    _libc.getxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                               ctypes.c_void_p, ctypes.c_size_t]
+    _libc.setxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                               ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+
+class ChecksumCache(object):
+    """
+    A cache of file checksums, keyed by path and by (device, inode, size,
+    mtime, ctime) of the file, so that an entry is only used if the file is
+    still the same one and has not been modified since it was checksummed.
+    (The ctime is there because the mtime can be set back - e.g. rsync -a
+    preserves it - and an inode can be reused once a file is deleted.)
+
+    Looks in, and stores to, up to three places:
+
+      - memory (always) - for repeated checksums of the same file within a
+        process, e.g. when a transfer is retried
+
+      - an extended attribute on the file itself (if use_xattr is set, and
+        the filesystem supports user xattrs), which follows the file if it
+        is renamed and survives restarts.  This is keyed without the ctime,
+        which renaming the file (or writing the attribute) changes; it goes
+        with the inode, so cannot outlive the file.
+
+      - a file per path (and algorithm) under cache_dir (if set), also
+        surviving restarts
+
+    Checksums are calculated with calc_function, which takes a path,
+    algorithm name, buffer size, read mode and drop cache flag (default
+    FileUtils.calcChecksum).
+    """
+
+    xattr_prefix = "user.mistamover."
+    max_memory_entries = 10000
+
+    def __init__(self, cache_dir = None, use_xattr = False,
+                 buffer_size = None, calc_function = None,
+                 read_mode = None, drop_cache = False):
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.calc_function = calc_function or futils.calcChecksum
+        self.configure(cache_dir, use_xattr, buffer_size, read_mode,
+                       drop_cache)
+
+
+    def configure(self, cache_dir = None, use_xattr = False,
+                  buffer_size = None, read_mode = None, drop_cache = False):
+        """
+        (Re)set the places other than memory to keep checksums, and how
+        files are read to calculate them (see Checksum.calcChecksum)
+        """
+        if cache_dir:
+            futils.ensureDirExists(cache_dir)
+        self.cache_dir = cache_dir or None
+        self.use_xattr = bool(use_xattr and _libc)
+        self.buffer_size = buffer_size or None
+        self.read_mode = read_mode or None
+        self.drop_cache = bool(drop_cache)
+
+
+    def _getKey(self, st, with_ctime = True):
+        key = "%d %d %d %r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        if with_ctime:
+            key += " %r" % st.st_ctime
+        return key
+
+
+    def _getSidecarPath(self, path, algorithm):
+        name = hashlib.md5(os.path.abspath(path)).hexdigest()
+        return os.path.join(self.cache_dir, "%s.%s" % (name, algorithm))
+
+
+    def _parse(self, value, key):
+        """
+        A stored value is the key and the checksum, separated by a tab.
+        Returns the checksum if the key matches, otherwise None.
+        """
+        if value and "\t" in value:
+            stored_key, checksum = value.strip().split("\t", 1)
+            if stored_key == key:
+                return checksum
+        return None
+
+
+    def _readXattr(self, path, algorithm):
+        buf = ctypes.create_string_buffer(256)
+        n = _libc.getxattr(path, self.xattr_prefix + algorithm, buf, len(buf))
+        if n < 0:
+            return None
+        return buf.raw[:n]
+
+
+    def _writeXattr(self, path, algorithm, value):
+        name = self.xattr_prefix + algorithm
+        if _libc.setxattr(path, name, value, len(value), 0) < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                # filesystem doesn't do user xattrs - don't keep trying
+                self.use_xattr = False
+
+
+    def _readSidecar(self, path, algorithm):
+        try:
+            f = open(self._getSidecarPath(path, algorithm))
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+
+
+    def _writeSidecar(self, path, algorithm, value):
+        sidecar_path = self._getSidecarPath(path, algorithm)
+        tmp_path = "%s.%d.tmp" % (sidecar_path, os.getpid())
+        try:
+            f = open(tmp_path, "w")
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            os.rename(tmp_path, sidecar_path)
+        except (IOError, OSError):
+            pass
+
+
+    def lookup(self, path, st = None, algorithm = "md5"):
+        """
+        Return the cached checksum for a path, or None if there isn't one
+        for the file as it currently is.
+        """
+        if st == None:
+            st = os.stat(path)
+        key = self._getKey(st)
+
+        self.lock.acquire()
+        try:
+            checksum = self._parse(self.memory.get((path, algorithm)), key)
+        finally:
+            self.lock.release()
+        if checksum:
+            return checksum
+
+        if self.use_xattr:
+            checksum = self._parse(self._readXattr(path, algorithm),
+                                   self._getKey(st, False))
+        if not checksum and self.cache_dir:
+            checksum = self._parse(self._readSidecar(path, algorithm), key)
+        if checksum:
+            self._remember(path, algorithm, "%s\t%s" % (key, checksum))
+        return checksum
+
+
+    def _remember(self, path, algorithm, value):
+        self.lock.acquire()
+        try:
+            if len(self.memory) >= self.max_memory_entries:
+                self.memory = {}
+            self.memory[(path, algorithm)] = value
+        finally:
+            self.lock.release()
+
+
+    def store(self, path, checksum, st, algorithm = "md5"):
+        """
+        Record the checksum of a path, which had stat st when it was
+        checksummed.
+        """
+        if self.use_xattr:
+            self._writeXattr(path, algorithm, "%s\t%s" %
+                             (self._getKey(st, False), checksum))
+            # (which changed the ctime)
+            new_st = os.stat(path)
+            if self._getKey(new_st, False) == self._getKey(st, False):
+                st = new_st
+        value = "%s\t%s" % (self._getKey(st), checksum)
+        self._remember(path, algorithm, value)
+        if self.cache_dir:
+            self._writeSidecar(path, algorithm, value)
+
+
+    def getChecksum(self, path, algorithm = "md5"):
+        """
+        Return the checksum of a file, from the cache if possible, otherwise
+        calculating it (and caching it).  Raises IOError / OSError as
+        calculating the checksum would, or Checksum.UnsupportedAlgorithm.
+        """
+        st = os.stat(path)
+        checksum = self.lookup(path, st, algorithm)
+        if checksum:
+            return checksum
+        checksum = self.calcChecksum(path, algorithm)
+        # only cache it if the file didn't change while we were reading it
+        if self._getKey(os.stat(path)) == self._getKey(st):
+            self.store(path, checksum, st, algorithm)
+        return checksum
+
+
+    def calcChecksum(self, path, algorithm = "md5"):
+        """
+        Calculate the checksum of a file, without looking in or adding to
+        the cache (e.g. to verify a file that has arrived, which must be
+        read whatever its stat says)
+        """
+        return self.calc_function(path, algorithm, self.buffer_size,
+                                  self.read_mode, self.drop_cache)
+
+
+    def forget(self, path):
+        """
+        Drop any entries for a path (e.g. once the file has been deleted).
+        Extended attributes, if any, go with the file.
+        """
+        self.lock.acquire()
+        try:
+            for algorithm in Checksum.getAlgorithms():
+                self.memory.pop((path, algorithm), None)
+        finally:
+            self.lock.release()
+        if self.cache_dir:
+            for algorithm in Checksum.getAlgorithms():
+                try:
+                    os.remove(self._getSidecarPath(path, algorithm))
+                except OSError:
+                    pass
+
+
+# one cache per process, set up from the config by the controllers
+checksum_cache = ChecksumCache()
@@ -0,0 +1,309 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Limits on the number of remote commands (rsync, ssh, ftp, globus-url-copy
+...) run at once by all of the data_streams on this host: at most
+global.max_remote_commands altogether, and at most
+global.max_commands_per_host to any one target_host.
+
+Each DatasetTransferController runs in its own process (and may have
+several worker threads), so the limits are kept with files in a directory
+under global.state_dir:
+
+  slot.all.<n>, slot.host.<host>.<n>
+                 a command may run while it holds a lock (flock) on one of
+                 the slots for all hosts and one for its target_host.  The
+                 lock goes when the process does, however it ends.  The
+                 holder writes its pid in the file, for getStatus (which
+                 must not take the locks itself).
+
+  ticket.<pid>.<thread>
+                 one for each command waiting for slots.  They are served
+                 highest data_stream.priority first, then first come first
+                 served, except that a command does not wait behind others
+                 which are only held up by the limit for a different host.
+
+See CommandLimiter.acquire.
+"""
+
+import os
+import time
+import json
+import errno
+import fcntl
+import threading
+
+from FileUtils import futils
+from BandwidthScheduler import processExists
+
+
+class CommandSlot(object):
+    """
+    The slots held for a command, to be released when it has finished
+    """
+
+    def __init__(self, fds):
+        self.fds = fds
+
+
+    def release(self):
+        for fd in self.fds:
+            try:
+                os.ftruncate(fd, 0)
+            finally:
+                os.close(fd)
+        self.fds = []
+
+
+class CommandLimiter(object):
+    """
+    The files through which the data_streams share out the slots for
+    remote commands (see the module doc string).  A limit of 0 means no
+    limit.
+    """
+
+    slot_prefix = "slot."
+    ticket_prefix = "ticket."
+
+    def __init__(self, state_dir, max_total = 0, max_per_host = 0,
+                 poll_interval = 0.5):
+        self.dir_path = os.path.join(state_dir, "commands")
+        futils.ensureDirExists(self.dir_path)
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.poll_interval = poll_interval
+
+
+    def _slotNames(self, host):
+        names = []
+        if self.max_per_host:
+            names.append(["%shost.%s.%d" % (self.slot_prefix, host, i)
+                          for i in range(self.max_per_host)])
+        if self.max_total:
+            names.append(["%sall.%d" % (self.slot_prefix, i)
+                          for i in range(self.max_total)])
+        return names
+
+
+    def _lockOne(self, names):
+        """
+        Lock the first of the slot files that is free, write our pid in it
+        and return the open file descriptor, or None if they are all in use
+        """
+        for name in names:
+            fd = os.open(os.path.join(self.dir_path, name),
+                         os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, err:
+                os.close(fd)
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            try:
+                os.ftruncate(fd, 0)
+                os.write(fd, "%d\n" % os.getpid())
+            except OSError:
+                os.close(fd)
+                raise
+            return fd
+        return None
+
+
+    def tryAcquire(self, host):
+        """
+        Take a slot for a command to host if one is free (both for the host
+        and for all hosts).  Returns (CommandSlot or None, what it was held
+        up by: "host" or "all").
+        """
+        fds = []
+        for names in self._slotNames(host):
+            fd = self._lockOne(names)
+            if fd == None:
+                CommandSlot(fds).release()
+                if names[0].startswith(self.slot_prefix + "host."):
+                    return None, "host"
+                return None, "all"
+            fds.append(fd)
+        return CommandSlot(fds), None
+
+
+    def _ticketName(self):
+        return "%s%d.%s" % (self.ticket_prefix, os.getpid(),
+                            threading.currentThread().getName())
+
+
+    def _writeTicket(self, name, ticket):
+        path = os.path.join(self.dir_path, name)
+        f = open(path + ".tmp", "w")
+        try:
+            json.dump(ticket, f)
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+
+    def getTickets(self):
+        """
+        The commands waiting for slots, in the order in which they are to
+        be served, as (name, ticket) where ticket is a dict.  Tickets left
+        by processes which have gone away are removed.
+        """
+        tickets = []
+        for name in os.listdir(self.dir_path):
+            if not name.startswith(self.ticket_prefix) or \
+                    name.endswith(".tmp"):
+                continue
+            try:
+                f = open(os.path.join(self.dir_path, name))
+                try:
+                    ticket = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue
+            if not processExists(ticket["pid"]):
+                try:
+                    os.remove(os.path.join(self.dir_path, name))
+                except OSError:
+                    pass
+                continue
+            tickets.append(((-ticket["priority"], ticket["queued"], name),
+                            name, ticket))
+        tickets.sort()
+        return [(name, ticket) for key, name, ticket in tickets]
+
+
+    def _mayTry(self, name, host, tickets):
+        """
+        Whether a waiting command should try for a slot: not if there is a
+        command ahead of it in the queue which wants the same host, or
+        which is held up by the limit for all hosts (or hasn't tried yet)
+        """
+        for other_name, ticket in tickets:
+            if other_name == name:
+                return True
+            if ticket["host"] == host or ticket["blocked"] != "host":
+                return False
+        return True
+
+
+    def acquire(self, host, priority = 1, check_abort = None,
+                on_wait = None):
+        """
+        Wait for a slot for a command to host, and return it (a
+        CommandSlot, to be released when the command has finished).
+
+        check_abort, if given, is called while waiting, and if it returns
+        True this gives up and returns None.  on_wait, if given, is called
+        once if we have to wait, with the number of commands ahead of us
+        and the number waiting altogether.
+        """
+        # (straight in, unless others are already waiting)
+        blocked = None
+        if not self.getTickets():
+            slot, blocked = self.tryAcquire(host)
+            if slot != None:
+                return slot
+        name = self._ticketName()
+        ticket = {"host": host, "priority": priority, "pid": os.getpid(),
+                  "queued": time.time(), "blocked": blocked}
+        self._writeTicket(name, ticket)
+        try:
+            if on_wait:
+                tickets = self.getTickets()
+                names = [other_name for other_name, t in tickets]
+                if name in names:
+                    on_wait(names.index(name), len(tickets))
+            while True:
+                time.sleep(self.poll_interval)
+                if check_abort and check_abort():
+                    return None
+                if not self._mayTry(name, host, self.getTickets()):
+                    continue
+                slot, new_blocked = self.tryAcquire(host)
+                if slot != None:
+                    return slot
+                if new_blocked != blocked:
+                    # (others behind us go by this)
+                    blocked = ticket["blocked"] = new_blocked
+                    self._writeTicket(name, ticket)
+        finally:
+            try:
+                os.remove(os.path.join(self.dir_path, name))
+            except OSError:
+                pass
+
+
+    def countInUse(self, names):
+        """
+        The number of the slot files that are held now: those with the pid
+        of a process that is still running.  This only reads the files, so
+        as not to get in the way of commands trying for the slots.
+        """
+        in_use = 0
+        for name in names:
+            try:
+                f = open(os.path.join(self.dir_path, name))
+                try:
+                    pid = f.read().strip()
+                finally:
+                    f.close()
+            except IOError:
+                continue
+            if pid.isdigit() and processExists(int(pid)):
+                in_use += 1
+        return in_use
+
+
+    def getStatus(self):
+        """
+        How many commands are running (for all hosts, and for each host
+        that has any) and how many are waiting, as a dict
+        """
+        running = {}
+        prefix = self.slot_prefix + "host."
+        for name in os.listdir(self.dir_path):
+            if name.startswith(prefix):
+                host = name[len(prefix):].rsplit(".", 1)[0]
+                running[host] = running.get(host, 0) + \
+                    self.countInUse([name])
+        if self.max_total:
+            total = self.countInUse(["%sall.%d" % (self.slot_prefix, i)
+                                     for i in range(self.max_total)])
+        else:
+            total = sum(running.values())
+        return {"running": total,
+                "hosts": dict((host, n) for host, n in running.items() if n),
+                "waiting": len(self.getTickets())}
+
+
+    def saveStatus(self, status):
+        """
+        Write what getStatus() found to the file "status" (as json)
+        """
+        path = os.path.join(self.dir_path, "status")
+        f = open(path + ".tmp", "w")
+        try:
+            json.dump(status, f)
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+
+def getLimiter(config):
+    """
+    A CommandLimiter for the config (global or data_stream), or None if
+    there are no limits
+    """
+    max_total = config.get("global.max_remote_commands") or 0
+    max_per_host = config.get("global.max_commands_per_host") or 0
+    if not max_total and not max_per_host:
+        return None
+    return CommandLimiter(futils.getStateDir(config), max_total,
+                          max_per_host)
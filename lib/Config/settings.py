@@ -1,5 +1,17 @@
 global_default = {
-'general_poll_interval': 3
+'general_poll_interval': 3,
+'use_inotify': False,
+'inotify_resync_interval': 60,
+'checksum_cache_dir': '',
+'checksum_use_xattr': False,
+'checksum_buffer_size': 0,
+'checksum_read_mode': 'auto',
+'checksum_drop_cache': False,
+'state_dir': '',
+'bandwidth_limit': 0,
+'max_remote_commands': 0,
+'max_commands_per_host': 0,
+'engine': 'fork'
 }
 
 incoming_default = {
@@ -7,7 +19,9 @@ incoming_default = {
 'control_file_extension': 'stager-ctrl-bss',
 'receipt_file_extension': 'stager-rcpt-bss',
 'thankyou_file_extension': 'stager-thanks-bss',
-'stop_file': '.stop'
+'stop_file': '.stop',
+'checksum_workers': 1,
+'checksum_order': 'fifo'
 }
 
 outgoing_default = {
@@ -16,9 +30,30 @@ outgoing_default = {
 'receipt_file_extension': 'stager-rcpt-bss',
 'thankyou_file_extension': 'stager-thanks-bss',
 'retry_count': 3,
+'command_timeout': 0,
+'stop_file_timeout': 0,
+'push_timeout': 0,
+'receipt_timeout': 0,
+'thankyou_timeout': 0,
+'retry_backoff_max': 300,
+'progress_interval': 0,
 'receipt_file_poll_count': 100,
 'receipt_file_poll_interval': 5,
+'receipt_file_poll_max': 60,
+'poll_jitter': 0.1,
+'async_receipts': False,
+'use_manifests': False,
 'stop_file': '.stop',
-'stop_file_poll_interval': 600
+'stop_file_poll_interval': 600,
+'stop_file_cache_ttl': 0,
+'checksum_algorithm': 'md5',
+'settle_interval': 5,
+'max_parallel_transfers': 1,
+'dir_archive_format': 'zip',
+'dir_compression': 'deflate',
+'dir_compression_level': 6,
+'dir_store_extensions': '.gz,.bz2,.xz,.zip,.zst',
+'dir_compression_workers': 1,
+'stream_dirs': False
 }
 
@@ -6,6 +6,7 @@
 # the full license text.
 
 from AbstractControlFile import *
+import Checksum
 
 
 class ControlFile(AbstractControlFile):
@@ -20,19 +21,32 @@ class ControlFile(AbstractControlFile):
         magic1
         data_file_name
         expected_size_in_bytes
-        expected_md5_checksum
+        expected_checksum
         basename_requested_for_receipt_file
+        checksum_algorithm (optional)
         magic2
+
+    The checksum algorithm line is only written if it is not md5 (the
+    default), so that files for md5 can still be read by older versions.
+    It is available after read() or create() from getAlgorithm().
     """
     magic1 = "_start_stager_ctrl_data_"
     magic2 = "_end_stager_ctrl_data_"
+    algorithm = Checksum.default_algorithm
 
-    def encode(self, filename, size, cksum, rcptname=None):
+    def encode(self, filename, size, cksum, rcptname=None,
+               algorithm=Checksum.default_algorithm):
         if not rcptname:
             rcptname = filename + ".rcpt"
-        return [filename, size, cksum, rcptname]
+        self.algorithm = algorithm
+        lines = [filename, size, cksum, rcptname]
+        if algorithm != Checksum.default_algorithm:
+            lines.append(algorithm)
+        return lines
 
     def decode(self, lines):
+        if len(lines) == 5:
+            self.algorithm = lines.pop()
         data_file_name, sizeStr, checksum, rcpt_file_name = lines
         return [data_file_name, int(sizeStr), checksum, rcpt_file_name]
         
@@ -48,6 +62,9 @@ class ControlFile(AbstractControlFile):
     def getRcptName(self):
         return self.data[3]
 
+    def getAlgorithm(self):
+        return self.algorithm
+
 
 if __name__ == '__main__':
 
@@ -63,3 +80,8 @@ if __name__ == '__main__':
     path, size, cksum, rcptfile = a2.read()
     print "-- %s -- %d -- %s -- %s --" % (path, size, cksum, rcptfile)
     print a2.getFileSize()
+
+    a3 = ControlFile(fname, can_overwrite=True)
+    a3.create("foo", 34, "1c2b3a4f", "foo.rcpt", algorithm="crc32")
+    a4 = ControlFile(fname)
+    print a4.read(), a4.getAlgorithm()
@@ -12,8 +12,12 @@ from AbstractDatasetController import AbstractDatasetController
 import ReceiptFile
 import ControlFile
 import ThankyouFile
+from ManifestControlFile import ManifestControlFile
+from ManifestReceiptFile import ManifestReceiptFile
 from StatusFlag import status
 from FileUtils import futils
+import Checksum
+from VerificationPool import VerificationPool, verifyFile
 
 class DatasetArrivalMonitor(AbstractDatasetController):
     """
@@ -36,6 +40,10 @@ class DatasetArrivalMonitor(AbstractDatasetController):
     these are referred to by a control file.  So partially arrived
     data files are not a problem.  BUT it is the sender's 
     responsibility to send the control file AFTER the data file.
+
+    A control file may also be a manifest (see ManifestControlFile) listing
+    several data files, in which case a single manifest receipt is made for
+    all of them.
     """
     short_name = "arrmon"
     long_name = "dataset arrival monitor"
@@ -50,6 +58,8 @@ class DatasetArrivalMonitor(AbstractDatasetController):
         self.incoming_dir = self.dconfig.get("incoming.directory")
         self.ctl_suffix = "." + self.dconfig.get("incoming.control_file_extension")
         self.thankyou_suffix = "." + self.dconfig.get("incoming.thankyou_file_extension")
+        self.checksum_workers = self.dconfig.get("incoming.checksum_workers")
+        self.checksum_order = self.dconfig.get("incoming.checksum_order")
         AbstractDatasetController.setVarsFromConfig(self)
 
         
@@ -76,36 +86,64 @@ class DatasetArrivalMonitor(AbstractDatasetController):
         return filename.endswith(self.ctl_suffix)
 
 
-    def createReceiptFile(self, rcpt_file_name, data_file_name, rcpt_data):
+    def createReceiptFile(self, rcpt_file_name, data_file_name, rcpt_data,
+                          algorithm = Checksum.default_algorithm):
         """
         create a receipt file in the incoming directory
            rcpt_file_name is the basename for the file to create
            data_file_name is the basename for the data file
            rcpt_data is a list of [status, size, checksum] (or shorter list if any 
              of these are not supplied)
+           algorithm is the checksum algorithm (as given in the control file)
         """
         rcpt_file_path = self.getPathInIncoming(rcpt_file_name)        
-        #
-        # The thank-you file name contains a time stamp so that on retries of a
-        # given data file, it will not overwrite one from a previous attempt.
-        # Now in fact, the file name for the receipt file already contains 
-        # the attempt number, so in principle we could extract that part and 
-        # use it instead of the timestamp - but we don't want to assume anything
-        # about the receipt filename.
-        #
-        thankyou_file_name = (".%s.%s%s" %
-                              (data_file_name,
-                               self.timeStamp(),
-                               self.thankyou_suffix))
+        thankyou_file_name = self.makeThankyouFileName(data_file_name)
         rcpt_args = [data_file_name] + rcpt_data
         rcpt_file = ReceiptFile.ReceiptFile(rcpt_file_path,
                                             can_overwrite=True)
-        kwargs = {"thankyou_file": thankyou_file_name}
+        kwargs = {"thankyou_file": thankyou_file_name,
+                  "algorithm": algorithm}
         rcpt_file.create(*rcpt_args, **kwargs)
         self.debug("made receipt file %s, want thankyou file %s" %
                    (rcpt_file_name, thankyou_file_name))
         
 
+    def makeThankyouFileName(self, data_file_name):
+        """
+        Name of the thank-you file to ask for in a receipt.
+
+        The thank-you file name contains a time stamp so that on retries of a
+        given data file, it will not overwrite one from a previous attempt.
+        Now in fact, the file name for the receipt file already contains 
+        the attempt number, so in principle we could extract that part and 
+        use it instead of the timestamp - but we don't want to assume anything
+        about the receipt filename.
+        """
+        return ".%s.%s%s" % (data_file_name, self.timeStamp(),
+                             self.thankyou_suffix)
+
+
+    def createManifestReceiptFile(self, manifest, results):
+        """
+        create the receipt file for a manifest control file, where results
+        maps each data file name in the manifest to its receipt data (as
+        from checkFile)
+        """
+        rcpt_file_name = manifest.getRcptName()
+        rcpt_file_path = self.getPathInIncoming(rcpt_file_name)
+        thankyou_file_name = self.makeThankyouFileName(rcpt_file_name.lstrip("."))
+        entries = []
+        for data_file_name, size, cksum in manifest.getEntries():
+            rcpt_data = results[data_file_name] + [None, None]
+            entries.append((data_file_name,) + tuple(rcpt_data[:3]))
+        rcpt_file = ManifestReceiptFile(rcpt_file_path, can_overwrite = True)
+        rcpt_file.create(thankyou_file_name, entries,
+                         algorithm = manifest.getAlgorithm())
+        self.debug("made manifest receipt file %s for %d files, want "
+                   "thankyou file %s" %
+                   (rcpt_file_name, len(entries), thankyou_file_name))
+
+
     def respondToControlFile(self, filename):
         """
         Respond to a control file, generating receipt file with appropriate
@@ -116,12 +154,31 @@ class DatasetArrivalMonitor(AbstractDatasetController):
 
         Returns the data file name if it was all okay, otherwise None
         """
-        data_file_delivered = False
+        ctl_file = self.readControlFile(filename)
+        if ctl_file == None:
+            return
+        if isinstance(ctl_file, ManifestControlFile):
+            return self.respondToManifest(filename, ctl_file)
+        data_file_name, correct_size, correct_cksum, rcpt_file_name \
+                        = ctl_file.data
+        rcpt_data = self.checkFile(self.getPathInIncoming(data_file_name),
+                                   correct_size, correct_cksum,
+                                   ctl_file.getAlgorithm())
+        return self.finishControlFile(filename, ctl_file, rcpt_data)
+
+
+    def readControlFile(self, filename):
+        """
+        First stage of responding to a control file: read it.
+
+        Argument is the basename of the control file.
+
+        Returns the ControlFile (or ManifestControlFile) object, with
+        contents in its data attribute, or None if it cannot be read (yet)
+        """
         ctl_path = self.getPathInIncoming(filename)
         try:                        
-            ctl_file = ControlFile.ControlFile(ctl_path)
-            filename, correct_size, correct_cksum, rcpt_file_name \
-                      = ctl_file.read()
+            ctl_file = self.readControlOrManifest(ctl_path)
         except ControlFile.Invalid:
             # an invalid control file - either it is
             # very recent or it is stale
@@ -129,37 +186,121 @@ class DatasetArrivalMonitor(AbstractDatasetController):
             if futils.getFileAge(ctl_path) < self.max_age_for_bad_ctl_file:
                 # invalid but recent control file
                 # just ignore it, may still be coming in.                
-                return
+                return None
             else:
                 # We can't really respond because the control file specifies the
                 # name of the receipt file to use, and we couldn't parse the control
                 # file.  Just log it.  The sender will time out and then retry.
                 self.warn("Unparseable control file %s" % filename)
                 futils.deleteFile(ctl_path)
-                return
-        else:
-            # good control file
-            self.info("control file %s says %s size %s cksum %s" %
-                      (ctl_path, filename, correct_size, correct_cksum))
-            file_path = self.getPathInIncoming(filename)
-            rcpt_data = self.checkFile(file_path, correct_size,
-                                       correct_cksum)        
+                return None
+
+        if isinstance(ctl_file, ManifestControlFile):
+            self.info("manifest control file %s lists %d files (%s)" %
+                      (ctl_path, len(ctl_file.getEntries()),
+                       ctl_file.getAlgorithm()))
+            return ctl_file
+
+        # good control file
+        self.info("control file %s says %s size %s cksum %s (%s)" %
+                  (ctl_path, ctl_file.getFileName(), ctl_file.getFileSize(),
+                   ctl_file.getFileChecksum(), ctl_file.getAlgorithm()))
+        return ctl_file
+
 
+    def readControlOrManifest(self, ctl_path):
+        """
+        Read a control file, which may be a manifest.  Raises
+        ControlFile.Invalid if it is neither.
+        """
+        try:
+            ctl_file = ControlFile.ControlFile(ctl_path)
+            ctl_file.read()
+        except ControlFile.Invalid:
+            ctl_file = ManifestControlFile(ctl_path)
+            ctl_file.read()
+        return ctl_file
+
+
+    def respondToManifest(self, filename, manifest):
+        """
+        As respondToControlFile, for a manifest control file.
+
+        Returns the list of data file names delivered.
+        """
+        results = {}
+        for data_file_name, correct_size, correct_cksum in \
+                manifest.getEntries():
+            results[data_file_name] = self.checkFile(
+                self.getPathInIncoming(data_file_name), correct_size,
+                correct_cksum, manifest.getAlgorithm())
+        return self.finishManifest(filename, manifest, results)
+
+
+    def finishManifest(self, filename, manifest, results):
+        """
+        Last stage of responding to a manifest control file, once all of
+        the data files in it have been checked (results maps each one to
+        its receipt data): deliver or delete each data file, delete the
+        manifest, and make the one receipt for them all.
+
+        Returns the list of data file names delivered.
+        """
+        delivered = []
+        for data_file_name, correct_size, correct_cksum in \
+                manifest.getEntries():
+            if self.deliverFile(data_file_name, results[data_file_name],
+                                correct_size, correct_cksum):
+                delivered.append(data_file_name)
+
+        # (see comment in finishControlFile)
+        ctl_path = self.getPathInIncoming(filename)
+        futils.deleteFile(ctl_path)
+        self.createManifestReceiptFile(manifest, results)
+        self.debug("deleted manifest control file %s" % ctl_path)
+        self.info("Manifest %s: %d of %d files accepted" %
+                  (filename, len(delivered), len(results)))
+        return delivered
+
+
+    def deliverFile(self, data_file_name, rcpt_data, correct_size,
+                    correct_cksum):
+        """
+        Deliver a data file which has been checked to the data_stream dir
+        if it was good, otherwise delete it.  Returns True if delivered.
+        """
+        file_path = self.getPathInIncoming(data_file_name)
         if rcpt_data[0] == ReceiptFile.SUCCESS:
             # we liked it - deliver the datafile to the data_stream dir
             try:
                 os.rename(file_path,
-                          self.getPathInDataDir(filename))
-                data_file_delivered = True
+                          self.getPathInDataDir(data_file_name))
                 self.info("File %s accepted (size %d, cksum %s)" %
-                          (filename, correct_size, correct_cksum))
+                          (data_file_name, correct_size, correct_cksum))
+                return True
             except OSError:
-                self.error("I/O error testing file %s" % filename)
+                self.error("I/O error testing file %s" % data_file_name)
+                return False
 
-        else:
-            # we didn't like the data file so delete it
-            futils.deleteFile(file_path)
-            self.warn("File %s rejected" % filename)
+        # we didn't like the data file so delete it
+        futils.deleteFile(file_path)
+        self.warn("File %s rejected" % data_file_name)
+        return False
+
+
+    def finishControlFile(self, filename, ctl_file, rcpt_data):
+        """
+        Last stage of responding to a control file, once the data file
+        has been checked (rcpt_data is as returned by checkFile): deliver or
+        delete the data file, delete the control file, and make the receipt.
+
+        Returns the data file name if it was all okay, otherwise None
+        """
+        ctl_path = self.getPathInIncoming(filename)
+        data_file_name, correct_size, correct_cksum, rcpt_file_name \
+                        = ctl_file.data
+        data_file_delivered = self.deliverFile(data_file_name, rcpt_data,
+                                               correct_size, correct_cksum)
 
         # delete control file before making receipt file - reason is that if we are heavily loaded,
         # and the checksum is bad, it is just possible (though unlikely) that the remote end
@@ -167,18 +308,75 @@ class DatasetArrivalMonitor(AbstractDatasetController):
         # get round to deleting what we think is the "old" one
 
         futils.deleteFile(ctl_path)
-        self.createReceiptFile(rcpt_file_name, filename, rcpt_data)
+        self.createReceiptFile(rcpt_file_name, data_file_name, rcpt_data,
+                               ctl_file.getAlgorithm())
 
         self.debug("deleted control file %s" % ctl_path)
 
         if data_file_delivered:
-            return filename
+            return data_file_name
+
+
+    def queueControlFile(self, filename):
+        """
+        As respondToControlFile, but the data file is checked by the
+        verification pool, and finishVerifiedFiles() does the rest.  For a
+        manifest, each data file is a separate job, with key (control file
+        name, data file name).
+        """
+        if filename in self.ctl_files:
+            return  # already queued
+        ctl_file = self.readControlFile(filename)
+        if ctl_file == None:
+            return
+        self.ctl_files[filename] = ctl_file
+        if isinstance(ctl_file, ManifestControlFile):
+            self.manifest_results[filename] = {}
+            for data_file_name, correct_size, correct_cksum in \
+                    ctl_file.getEntries():
+                self.verifiers.submit((filename, data_file_name),
+                                      self.getPathInIncoming(data_file_name),
+                                      correct_size, correct_cksum,
+                                      ctl_file.getAlgorithm())
+            return
+        data_file_name, correct_size, correct_cksum, rcpt_file_name \
+                        = ctl_file.data
+        self.verifiers.submit(filename, self.getPathInIncoming(data_file_name),
+                              correct_size, correct_cksum,
+                              ctl_file.getAlgorithm())
+
+
+    def finishVerifiedFiles(self):
+        """
+        Finish responding to the control files whose data files the
+        verification pool has checked since last time
+        """
+        for key, (rcpt_data, message) in self.verifiers.getResults():
+            if message:
+                self.warn(message)
+            if isinstance(key, tuple):
+                # one of the files in a manifest - finish once all are done
+                filename, data_file_name = key
+                results = self.manifest_results[filename]
+                results[data_file_name] = rcpt_data
+                manifest = self.ctl_files[filename]
+                if len(results) == len(manifest.getEntries()):
+                    del self.ctl_files[filename]
+                    del self.manifest_results[filename]
+                    self.finishManifest(filename, manifest, results)
+            else:
+                ctl_file = self.ctl_files.pop(key)
+                self.finishControlFile(key, ctl_file, rcpt_data)
 
 
     def isThankyouFile(self, filename):
         return filename.endswith(self.thankyou_suffix)
 
 
+    def isControlOrThankyouFile(self, filename):
+        return self.isControlFile(filename) or self.isThankyouFile(filename)
+
+
     def respondToThankyouFile(self, filename):
         """
         deal with a thank you file: delete the receipt file and the
@@ -204,55 +402,101 @@ class DatasetArrivalMonitor(AbstractDatasetController):
         self.debug("deleted thankyou file %s" % thankyou_path)
             
 
-    def checkFile(self, file_path, correct_size, correct_cksum):
+    def checkFile(self, file_path, correct_size, correct_cksum,
+                  algorithm = Checksum.default_algorithm):
         """
         Check a file and return data to write to the receipt file
         """
-        if not os.path.exists(file_path):
-            self.warn("%s: no such file" % file_path)
-            return [ReceiptFile.NO_SUCH_FILE]
-        try:
-            actual_size = futils.getSize(file_path)
-            if actual_size != correct_size:
-                self.warn("%s actual size %s correct size %s" %
-                                 (file_path, actual_size, correct_size))
-                return [ReceiptFile.BAD_SIZE, actual_size]
-            else:
-                actual_cksum = futils.calcChecksum(file_path)
-                if actual_cksum != correct_cksum:
-                    self.warn("%s actual cksum %s correct cksum %s" %
-                                     (file_path, actual_cksum, correct_cksum))
-                    return [ReceiptFile.BAD_CKSUM, actual_size, actual_cksum]
-                else:
-                    return [ReceiptFile.SUCCESS, actual_size, actual_cksum]
-        except IOError:
-            return [ReceiptFile.IO_ERROR]
+        rcpt_data, message = verifyFile(file_path, correct_size,
+                                        correct_cksum, algorithm)
+        if message:
+            self.warn(message)
+        return rcpt_data
 
 
     def monitor(self):
         """
         Ongoing monitoring of process unless told to stop.
         """
-        
+        self.setUp()
+        while True:
+            final_status = self.step()
+            if final_status != None:
+                return final_status
+            wanted, timeout = self.getWait()
+            self.waitForChanges(wanted = wanted, timeout = timeout)
+
+
+    def setUp(self):
+        """
+        Get ready to monitor arrivals (see monitor).  Returns None (there
+        is always something to do).
+        """
         futils.ensureDirExists(self.dataset_dir)
         futils.ensureDirExists(self.incoming_dir)
+        self.initWatcher(self.incoming_dir)
+
+        # with incoming.checksum_workers > 1, data files are checked by a
+        # pool of processes, and we carry on with other control files (and
+        # thank-you files) while they run
+        self.verifiers = None
+        self.ctl_files = {}
+        self.manifest_results = {}
+        if self.checksum_workers > 1:
+            self.info("Verifying up to %d files at once (%s)" %
+                      (self.checksum_workers, self.checksum_order))
+            self.verifiers = VerificationPool(self.checksum_workers,
+                                              self.checksum_order)
+        return None
+
+
+    def step(self):
+        """
+        One pass of monitor: respond to the control and thank-you files in
+        the incoming directory.  Returns the status if we are to stop,
+        otherwise None.
+        """
+        self.updateStatusAndConfig()
+        if self.status == status.STOPPED:
+            self.tearDown()
+            return self.status
+        
+        items = self.listIncomingDir(include_dotfiles = True)
 
-        while True:
+        for item in items:
+            if self.isControlFile(item):
+                if self.verifiers:
+                    self.queueControlFile(item)
+                else:
+                    self.respondToControlFile(item)
+            elif self.isThankyouFile(item):
+                self.respondToThankyouFile(item)
 
-            self.updateStatusAndConfig()
-            if self.status == status.STOPPED:
-                return self.status
-            
-            items = self.listIncomingDir(include_dotfiles = True)
+        if self.verifiers:
+            self.finishVerifiedFiles()
+        return None
 
-            for item in items:
-                if self.isControlFile(item):
-                    self.respondToControlFile(item)
-                elif self.isThankyouFile(item):
-                    self.respondToThankyouFile(item)
 
-            time.sleep(self.poll_interval)
-        
+    def tearDown(self):
+        """
+        Stop the verifying processes, if any
+        """
+        if self.verifiers:
+            self.verifiers.shutdown()
+            self.verifiers = None
+
+
+    def getWait(self):
+        """
+        What to wait for before the next step: (wanted, timeout) as for
+        waitForChanges
+        """
+        if self.verifiers and not self.verifiers.isIdle():
+            # look again soon for results, rather than waiting for
+            # new arrivals
+            return self.isControlOrThankyouFile, 1
+        return self.isControlOrThankyouFile, None
+
 
 
 if __name__ == '__main__':
@@ -12,8 +12,12 @@ import signal
 
 from AbstractDatasetController import AbstractDatasetController
 from FileUtils import futils
+from DirIndex import DirIndex
 from StatusFlag import status
 from TransferModules.TransferBaseController import TransferBaseController
+from TransferWorkerPool import TransferWorkerPool
+import BandwidthScheduler
+import Daemon
 
 class DatasetTransferController(AbstractDatasetController):
     """
@@ -30,6 +34,17 @@ class DatasetTransferController(AbstractDatasetController):
     transferred, it waits for completion before attempting the next one.
     This is desirable.  There is no attempt to rescan the directory before
     it has finished transferring (or attempting to transfer) the existing files.
+    (If outgoing.max_parallel_transfers is set, that many transfers run at
+    once in worker threads, but the same applies: the directory is not
+    rescanned until they have all finished.)  With outgoing.async_receipts,
+    a transfer to an arrival monitor finishes once the data is pushed, and
+    the receipts are collected between transfers (see
+    TransferBaseController.reapReceipts); items still waiting for receipts
+    are left out of the scan.
+
+    With global.bandwidth_limit, it says whether it has anything to send
+    (see BandwidthScheduler), so that the bandwidth is shared between the
+    data_streams which do.
     
     Note also that a key assumption is that any files created by the transfer
     unit controller for chatter with a remote arrival monitor will be 
@@ -43,18 +58,66 @@ class DatasetTransferController(AbstractDatasetController):
 
     def setVarsFromConfig(self):
         self.completion_file = self.dconfig.get("data_stream.completion_file")
+        self.settle_interval = self.dconfig.get("outgoing.settle_interval")
+        self.max_parallel_transfers = \
+            self.dconfig.get("outgoing.max_parallel_transfers")
+        self.bandwidth_scheduler = None
         AbstractDatasetController.setVarsFromConfig(self)
 
 
+    def setBusy(self, busy):
+        """
+        Tell the bandwidth scheduler, if there is one, whether we have
+        items to send
+        """
+        # (made again when the config is reread)
+        if self.bandwidth_scheduler == None:
+            self.bandwidth_scheduler = \
+                BandwidthScheduler.getScheduler(self.dconfig)
+            if self.bandwidth_scheduler == None:
+                return
+        self.bandwidth_scheduler.setBusy(
+            self.dconfig.get("data_stream.name"),
+            BandwidthScheduler.getPriority(self.dconfig), busy)
+
+
     def doSetup(self):
         futils.ensureDirExists(self.dataset_dir)
         self.tidyDatasetDir()
+        self.index = DirIndex(self.dataset_dir, deep_dirs = True,
+                              ignore = self.doIgnore)
+        self.initWatcher(self.dataset_dir)
 
     def processTransfers(self):
         """
         Runs forever until status changes.
         """
-        
+        final_status = self.setUp()
+        if final_status != None:
+            return final_status
+
+        while True:
+            final_status = self.step()
+            if final_status != None:
+                return final_status
+
+            wanted, timeout = self.getWait()
+            self.waitForChanges(wanted = wanted, timeout = timeout)
+            # if we get here - then all the files have been processed
+            # if we are running oneoff then exit here
+            if self.dconfig.get("global.oneoff") == True:
+                self.tearDown()
+                # send a signal back to MiStaMoverController syaing that this
+                # data_stream has completed
+                os.kill(os.getppid(), signal.SIGUSR2)
+                return
+
+
+    def setUp(self):
+        """
+        Get ready to process transfers (see processTransfers).  Returns the
+        status if there is nothing to do, otherwise None.
+        """
         self.doSetup()
         
         if self.status == status.COMPLETE:
@@ -63,106 +126,352 @@ class DatasetTransferController(AbstractDatasetController):
         self.status = status.RUNNING
         self.info("Processing Transfers...")
 
-        tbc = TransferBaseController(self.dconfig)
+        self.tbc = TransferBaseController(self.dconfig)
+
+        self.pool = None
+        self.updatePool()
+
+        self.had_completion_file = False
+        return None
+
+
+    def updatePool(self):
+        """
+        With outgoing.max_parallel_transfers > 1, transfers are run through
+        a pool of worker threads instead of one at a time.  Make the pool,
+        or make it again or drop it if the setting has changed since the
+        config was last read.  Only called while the pool is idle.
+        """
+        nworkers = self.max_parallel_transfers
+        if nworkers <= 1:
+            nworkers = 0
+        if self.pool != None:
+            if len(self.pool.workers) == nworkers:
+                return
+            self.shutdownPool()
+            if not nworkers:
+                self.info("Running transfers one at a time")
+        if nworkers:
+            self.info("Running up to %d transfers in parallel" % nworkers)
+            self.pool = TransferWorkerPool(self.dconfig, nworkers,
+                                           self.tbc.stop_file_cache,
+                                           self.tbc.pending_receipts,
+                                           self.tbc.metrics)
+
+
+    def shutdownPool(self):
+        """
+        Let the worker threads, if any, exit (once they have finished what
+        they are doing)
+        """
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+    def step(self):
+        """
+        One pass of processTransfers: collect receipts, scan the data_stream
+        directory and transfer what is there.  Returns the status if we are
+        to stop (or have finished), otherwise None.
+        """
+        final_status = self.transferPass()
+        if final_status != None:
+            self.tearDown()
+        return final_status
+
+
+    def tearDown(self):
+        """
+        Stop the worker threads and give up our share of the bandwidth (in
+        a StreamEngine the process carries on without us, so neither goes
+        away by itself)
+        """
+        self.shutdownPool()
+        self.setBusy(False)
+
+
+    def transferPass(self):
+        """
+        The work of step()
+        """
+        tbc = self.tbc
+        self.updateStatusAndConfig()
+        tp = self.dconfig.get("outgoing.transfer_protocol")
+        # If transfer protocol not set then exit
+        if tp.strip().lower() in ("", "none"):
+            self.status = status.STOPPED
+            print "Exiting transfer controller for '%s' because 'outgoing.transfer_protocol' is set to '%s' which is invalid." % (self.dconfig.get("data_stream.name"), tp)
+        else:
+            # If transfer protocol is set then check valid target information is set for host and directory
+            for check_item in ("outgoing.target_dir", "outgoing.target_host"):
+                if (self.dconfig.checkSet(check_item) == False):
+                    self.status = status.STOPPED
+                    print "Exiting transfer controller for '%s' because '%s' not set in config file." % (self.dconfig.get("data_stream.name"), check_item)
+        if self.status == status.STOPPED:
+            return self.status
+
+        # (the pool is idle between passes)
+        self.updatePool()
+  
+        # finish off items whose receipts have come back since last time
+        tbc.reapReceipts()
+
+        # Get a list of items, either files or directories
+        items = self.excludePending(tbc, self.scanDataDir())
+        
+        if items:
+            self.info("Found a list of items to transfer of length '%d', starting with: %s" % (len(items), items[:3]))
+
+        # completion condition is that we have seen the completion
+        # file, and the data_stream directory is currently empty
+        # (and all the receipts are in)
+        if ((not items) and self.had_completion_file
+            and not len(tbc.pending_receipts)):
+            self.status = status.COMPLETE
+            return self.status
+
+        # Only transfer items which are no longer being written to
+        items = self.settleItems(items)
+        self.setBusy(bool(items))
+
+        if self.pool:
+            seen_completion_file = self.transferItemsInParallel(tbc, items)
+        else:
+            seen_completion_file = self.transferItems(tbc, items)
+
+        if seen_completion_file:
+            self.had_completion_file = True
+
+        if self.status == status.STOPPED:
+            return self.status
+        return None
+
+
+    def getWait(self):
+        """
+        What to wait for before the next step: (wanted, timeout) as for
+        waitForChanges
+        """
+        # dot-files are our own chatter with the remote end, so only
+        # wake up for new items (or when it is time to look for receipts)
+        next_due = self.tbc.pending_receipts.getNextDue(
+            self.dconfig.get("outgoing.receipt_file_poll_interval"))
+        if next_due != None:
+            return futils.notDotFile, max(next_due - time.time(), 1)
+        return futils.notDotFile, None
+
 
+    def transferItems(self, tbc, items):
+        """
+        Transfer items one at a time (or one batch at a time, if the transfer
+        module supports sending several files in one go - see
+        TransferBaseController.makeBatches).  Returns True if the completion
+        file was among those transferred.  If told to stop, sets self.status
+        and returns early.
+
+        The completion file goes last, and only if everything else has got
+        there (see mayTransferCompletionFile).
+        """
         had_completion_file = False
-        runLoop = True
-        while runLoop == True:
- 
-            self.updateStatusAndConfig()
-            tp = self.dconfig.get("outgoing.transfer_protocol")
-            # If transfer protocol not set then exit
-            if tp.strip().lower() in ("", "none"):
-                self.status = status.STOPPED
-                print "Exiting transfer controller for '%s' because 'outgoing.transfer_protocol' is set to '%s' which is invalid." % (self.dconfig.get("data_stream.name"), tp)
-            else:
-                # If transfer protocol is set then check valid target information is set for host and directory
-                for check_item in ("outgoing.target_dir", "outgoing.target_host"):
-                    if (self.dconfig.checkSet(check_item) == False):
-                        self.status = status.STOPPED
-                        print "Exiting transfer controller for '%s' because '%s' not set in config file." % (self.dconfig.get("data_stream.name"), check_item)
+        all_sent = True
+
+        # Start a counter to check status after every 5 batches
+        icount = 1
+
+        others = [item for item in items if item != self.completion_file]
+        for batch in tbc.makeBatches(others, self.dataset_dir):
+            # Every fifth batch, test status has not been changed or stopped
+            if (icount % 5) == 0:
+                self.updateStatusAndConfig()
+                if self.status == status.STOPPED:
+                    return had_completion_file
+
+            # Copy the items to remote host.
+            for item, tresp in tbc.transferBatch(batch):
+                if self.isFatalResponse(tresp):
+                    self.status = status.STOPPED
+                if not self.isSuccessResponse(tresp):
+                    all_sent = False
+
             if self.status == status.STOPPED:
-                return self.status
-      
-            # Get a list of items, either files or directories
-            items = self.listDataDir()
-            
-            if items:
-                self.info("Found a list of items to transfer of length '%d', starting with: %s" % (len(items), items[:3]))
-
-            # completion condition is that we have seen the completion
-            # file, and the data_stream directory is currently empty
-            if (not items) and had_completion_file:
-                self.status = status.COMPLETE
-                return self.status
-
-            # Start a counter to check status after every 5 items
-            icount = 1
-
-            stat_diff = False
-            for item in items:
-                # Since we cannot guarantee that the file being placed in the incoming
-                # directory is not still being written to we:
-                #  - check size and last mod time
-                #  - wait 2 seconds
-                #  - check size and last mod time again
-
-                if os.path.isdir(item) == True:
-                    for dirname, dirnames, filenames in os.walk(item):
-                        for filename in filenames:
-                            full_path = os.path.join(self.dataset_dir, item)
-                            stat1 = (futils.getLastUpdatedTime(full_path), futils.getSize(full_path))
-                            time.sleep(5)
-                            stat2 = (futils.getLastUpdatedTime(full_path), futils.getSize(full_path))
-                            if stat1 != stat2:
-                                self.info("File is still writing so ignore: %s" % item)
-                                stat_diff = True
-                                continue
-                else:
-                    full_path = os.path.join(self.dataset_dir, item)
-                    stat1 = (futils.getLastUpdatedTime(full_path), futils.getSize(full_path))
-                    time.sleep(5)
-                    stat2 = (futils.getLastUpdatedTime(full_path), futils.getSize(full_path))
-
-                if stat1 != stat2 or stat_diff == True:
-                    self.info("File is still writing so ignore: %s" % item)
-                    continue
-
-                # Every fifth item, test status has not been changed or stopped
-                if (icount % 5) == 0:
-                    self.updateStatusAndConfig()
-                    if self.status == status.STOPPED:
-                        return self.status
-
-                if self.doIgnore(item):
-                    continue
-
-                # Copy the item to remote host.
-                # don't actually do anything with the return code. as
-                # currently coded, TUC will already have logged an error /
-                # quarantined the files as necessary
-                tresp = tbc.transfer(item)
-
-                if tresp != None and str(tresp.code) == "Failure":
-                    if tresp.msg.find("Not all variables in") != -1:
-                        # this data_stream will not continue as not all variables have been set
-                        # exit cleanly
+                return had_completion_file
+
+            tbc.reapReceipts()
+            icount += 1
+
+        if (self.completion_file in items
+            and self.mayTransferCompletionFile(tbc, all_sent)):
+            for item, tresp in tbc.transferBatch([self.completion_file]):
+                if self.isFatalResponse(tresp):
+                    self.status = status.STOPPED
+                had_completion_file = True
+
+        return had_completion_file
+
+
+    def transferItemsInParallel(self, tbc, items):
+        """
+        As transferItems(), but runs up to outgoing.max_parallel_transfers
+        transfers at once through the worker pool.
+
+        The completion file is only transferred once everything else has
+        finished (see mayTransferCompletionFile), so that it still arrives
+        after all the data.  The config is
+        only reread while the pool is idle (the workers read it while they
+        run), but a stop signal is acted on straight away: items which have
+        not been started are dropped and we wait for those in flight.
+        """
+        stages = [[item for item in items if item != self.completion_file]]
+        if self.completion_file in items:
+            stages.append([self.completion_file])
+
+        had_completion_file = False
+        all_sent = True
+
+        for stage in stages:
+            if (stage == [self.completion_file]
+                and not self.mayTransferCompletionFile(tbc, all_sent)):
+                break
+            for batch in tbc.makeBatches(stage, self.dataset_dir):
+                self.pool.submit(batch)
+
+            while not self.pool.isIdle():
+                for item, tresp in self.pool.getResults(timeout = 1):
+                    if self.isFatalResponse(tresp):
                         self.status = status.STOPPED
-                        return self.status
+                    if not self.isSuccessResponse(tresp):
+                        all_sent = False
+                    if item == self.completion_file:
+                        had_completion_file = True
+                tbc.reapReceipts()
+
+                if (self.status != status.STOPPED
+                    and Daemon.weWereSignalled("USR1")):
+                    self.info("stop requested by signal")
+                    self.status = status.STOPPED
+
+                if self.status == status.STOPPED:
+                    cancelled = self.pool.cancelPending()
+                    if cancelled:
+                        self.info("Stopping - not starting transfer of %d "
+                                  "queued items" % len(cancelled))
 
-                if item == self.completion_file:
-                    had_completion_file = True
+            if self.status == status.STOPPED:
+                return had_completion_file
 
-                icount += 1
-            self.info("Sleeping for %d seconds..." % self.poll_interval)
-            time.sleep(self.poll_interval)
-            # if we get here - then all the files have been processed
-            # if we are running oneoff then exit here
-            if self.dconfig.get("global.oneoff") == True:
-                runLoop = False
-                # send a signal back to MiStaMoverController syaing that this
-                # data_stream has completed
-                os.kill(os.getppid(), signal.SIGUSR2)
+            self.updateStatusAndConfig()
+            if self.status == status.STOPPED:
+                return had_completion_file
+
+        return had_completion_file
+
+
+    def mayTransferCompletionFile(self, tbc, all_sent):
+        """
+        Whether the completion file can be sent now, after the other items
+        in this pass: only if they all got there (all_sent) and there are
+        no receipts still to come for any items (see
+        outgoing.async_receipts), as otherwise it could reach the target
+        before the data it covers.  If not, it is left for a later pass.
+        """
+        if not all_sent:
+            self.info("Leaving completion file %s until all other items "
+                      "have been sent" % self.completion_file)
+            return False
+        tbc.reapReceipts()
+        if len(tbc.pending_receipts):
+            self.info("Leaving completion file %s until the receipts for "
+                      "%d items are in" % (self.completion_file,
+                                           len(tbc.pending_receipts)))
+            return False
+        return True
+
+
+    def excludePending(self, tbc, items):
+        """
+        Leave out items which have been sent but whose receipts are still to
+        come (see outgoing.async_receipts), and the completion file until
+        there are none of those, so that it still arrives last.
+        """
+        pending = tbc.pending_receipts
+        if not len(pending):
+            return items
+        return [item for item in items
+                if item != self.completion_file and not pending.isPending(item)]
+
+
+    def isSuccessResponse(self, tresp):
+        return tresp != None and str(tresp.code) == "Success"
+
+
+    def isFatalResponse(self, tresp):
+        """
+        Whether the response from a transfer means that this data_stream
+        cannot continue.  Otherwise we don't actually do anything with the
+        return code: as currently coded, the transfer modules will already
+        have logged an error / quarantined the files as necessary.
+        """
+        # not all variables have been set, so exit cleanly
+        return (tresp != None and str(tresp.code) == "Failure"
+                and tresp.msg.find("Not all variables in") != -1)
+
+
+    def scanDataDir(self):
+        """
+        Bring the index of the data_stream directory up to date, and
+        return the items in it, oldest first.  Ignored items (see doIgnore)
+        are not in the index.
+        """
+        self.info("Scanning contents of data_stream dir: %s" % self.dataset_dir)
+        self.index.scan()
+        return self.index.oldestFirst()
+
+
+    def settleItems(self, items):
+        """
+        Return the subset of items that are no longer being written to.
+
+        Since we cannot guarantee that an item placed in the data_stream
+        directory is complete, we only take items whose size and last mod
+        time (for a directory, those of all the files underneath it) have
+        not changed for outgoing.settle_interval seconds.  The directory
+        index records when each item last changed, so this needs no extra
+        stat calls.  If none of the items has settled yet, we wait once
+        for the first of them to do so and rescan.
+        """
+        if not items:
+            return items
+
+        stable = self.getStableItems(items)
+        if not stable:
+            wait = self.index.timeUntilStable(items, self.settle_interval)
+            if wait > 0:
+                time.sleep(wait)
+            self.index.scan()
+            stable = self.getStableItems(items)
+
+        stable_set = set(stable)
+        unstable = [item for item in items if item not in stable_set]
+
+        self.info("Settle check: %d item(s) stable, %d still being written "
+                  "(%d new, %d changed since last scan)" %
+                  (len(stable), len(unstable),
+                   len(self.index.newEntries()),
+                   len(self.index.changedEntries())))
+        if unstable:
+            self.info("Items still being written so ignored this cycle: %s" %
+                      unstable[:10])
+        return stable
+
+
+    def getStableItems(self, items):
+        """
+        Those of the given items that the index says have settled, in the
+        same order
+        """
+        stable = set(self.index.stableEntries(self.settle_interval))
+        return [item for item in items if item in stable]
 
 
     def doIgnore(self, item):
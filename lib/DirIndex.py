@@ -0,0 +1,284 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+An incremental index of the entries in a directory.
+
+See doc string for class DirIndex for details
+"""
+
+import os
+import stat
+import time
+
+# scandir (if available) gives us the inode number from the directory
+# listing itself (d_ino), so we can avoid stat calls on entries we already
+# know about
+from FileUtils import futils, scandir
+
+
+class DirEntryState(object):
+    """
+    What a DirIndex remembers about a single directory entry between scans.
+
+    sig is what is compared between scans to decide whether the entry has
+    changed: (number of files, total size, latest mtime) - for a plain file
+    this is just its own size and mtime, for a directory (if the index was
+    asked to look inside directories) it covers the files underneath it.
+    """
+    __slots__ = ("name", "path", "inode", "size", "mtime", "ctime",
+                 "is_dir", "sig", "first_seen", "last_changed")
+
+    def __init__(self, name, path, inode, st, is_dir, sig, now):
+        self.name = name
+        self.path = path
+        self.inode = inode
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+        self.is_dir = is_dir
+        self.sig = sig
+        self.first_seen = now
+        self.last_changed = now
+
+    def update(self, inode, st, is_dir, sig, now):
+        """
+        Update from a new stat; returns True if the entry had changed.
+        """
+        changed = (inode != self.inode or sig != self.sig)
+        self.inode = inode
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+        self.is_dir = is_dir
+        self.sig = sig
+        if changed:
+            self.last_changed = now
+        return changed
+
+
+class DirIndex(object):
+    """
+    An index of the entries in a single directory which is kept up to date
+    by calling scan() on each poll.
+
+    For each entry it keeps (inode, size, mtime, ctime) and the time at
+    which it was first seen and last seen to change, so that callers can ask
+    for the entries that are new, changed, stable for some number of
+    seconds, or sorted oldest/newest first, all from the one scan.
+
+    By default every entry is stat'ed on each scan, which is what is needed
+    to see whether files are still being written.  With stat_known = False,
+    an entry which has the same inode as last time (available without a
+    stat if scandir is available) is assumed unchanged, and if the directory
+    itself has not been modified since the previous scan then it is not
+    listed at all.  This is suitable for callers which mostly only need
+    the listing.  The stat attributes of an entry which was not stat'ed
+    again may be out of date (e.g. its ctime after a chmod), so a caller
+    which orders by them should call refreshStats() first (as the disk
+    space monitor does).
+
+    With deep_dirs = True, the signature of a directory entry covers all of
+    the files underneath it (see FileUtils.getStatSignature).
+
+    Dotfiles are excluded unless include_dotfiles is set.  ignore is an
+    optional callable taking an entry name, returning True for entries to
+    leave out of the index.
+    """
+
+    def __init__(self, dir_path, include_dotfiles = False, stat_known = True,
+                 deep_dirs = False, ignore = None):
+        self.dir_path = dir_path
+        self.include_dotfiles = include_dotfiles
+        self.stat_known = stat_known
+        self.deep_dirs = deep_dirs
+        self.ignore = ignore
+
+        self.entries = {}
+        self.new = []
+        self.changed = []
+        self.last_scan = None
+        self.dir_mtime = None
+
+
+    def _listEntries(self):
+        """
+        Return list of (name, inode, is_dir) for the directory, where inode
+        and is_dir are None if they are not known without a stat.
+        """
+        if scandir:
+            return [(de.name, de.inode(), de.is_dir(follow_symlinks = False))
+                    for de in scandir(self.dir_path)]
+        else:
+            return [(name, None, None) for name in os.listdir(self.dir_path)]
+
+
+    def _wanted(self, name):
+        if not self.include_dotfiles and name.startswith("."):
+            return False
+        if self.ignore and self.ignore(name):
+            return False
+        return True
+
+
+    def scan(self):
+        """
+        Bring the index up to date.  Returns True on success, or False
+        (leaving the index empty) if the directory could not be listed.
+        """
+        now = time.time()
+        self.new = []
+        self.changed = []
+
+        try:
+            dir_mtime = os.stat(self.dir_path).st_mtime
+            if (not self.stat_known
+                and self.last_scan != None
+                and dir_mtime == self.dir_mtime
+                and dir_mtime < self.last_scan - 1):
+                # nothing added, removed or renamed since the last scan
+                self.last_scan = now
+                return True
+            listing = self._listEntries()
+        except OSError:
+            self.entries = {}
+            self.last_scan = now
+            self.dir_mtime = None
+            return False
+
+        entries = {}
+        for name, inode, is_dir in listing:
+            if not self._wanted(name):
+                continue
+
+            old = self.entries.get(name)
+            if (old and not self.stat_known
+                and inode != None and inode == old.inode):
+                entries[name] = old
+                continue
+
+            path = os.path.join(self.dir_path, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # disappeared since the listing
+                continue
+            inode = st.st_ino
+            is_dir = stat.S_ISDIR(st.st_mode)
+
+            if is_dir and self.deep_dirs:
+                sig = futils.getStatSignature(path)
+            else:
+                sig = (1, st.st_size, st.st_mtime)
+
+            if old:
+                if old.update(inode, st, is_dir, sig, now):
+                    self.changed.append(name)
+                entries[name] = old
+            else:
+                entries[name] = DirEntryState(name, path, inode, st,
+                                              is_dir, sig, now)
+                self.new.append(name)
+
+        self.entries = entries
+        self.last_scan = now
+        self.dir_mtime = dir_mtime
+        return True
+
+
+    def refreshStats(self):
+        """
+        Stat every entry again, without changing what the last scan found
+        to be new or changed, so that sizes and times are up to date.
+        Entries which have gone are dropped.
+        """
+        for name, entry in self.entries.items():
+            try:
+                st = os.lstat(entry.path)
+            except OSError:
+                del self.entries[name]
+                continue
+            entry.size = st.st_size
+            entry.mtime = st.st_mtime
+            entry.ctime = st.st_ctime
+
+
+    def names(self):
+        return self.entries.keys()
+
+
+    def getEntry(self, name):
+        """
+        Return the DirEntryState for a name, or None if not in the index
+        """
+        return self.entries.get(name)
+
+
+    def getEntries(self):
+        return self.entries.values()
+
+
+    def newEntries(self):
+        """
+        Names that appeared in the most recent scan
+        """
+        return list(self.new)
+
+
+    def changedEntries(self):
+        """
+        Names that were already known but changed in the most recent scan
+        """
+        return list(self.changed)
+
+
+    def stableEntries(self, seconds):
+        """
+        Names which have been seen unchanged for at least the given number
+        of seconds, as of the most recent scan.
+        """
+        if self.last_scan == None:
+            return []
+        return [e.name for e in self.entries.itervalues()
+                if self.last_scan - e.last_changed >= seconds]
+
+
+    def timeUntilStable(self, names, seconds):
+        """
+        How long (in seconds, from now) until the first of the given names
+        could be reported by stableEntries(seconds), assuming it does not
+        change in the meantime.
+        """
+        times = [self.entries[name].last_changed + seconds
+                 for name in names if name in self.entries]
+        if not times:
+            return 0
+        return max(0, min(times) - time.time())
+
+
+    def oldestFirst(self, key = "mtime", fullPaths = False):
+        """
+        Names (or paths) sorted by the given stat attribute, oldest first
+        (same ordering as FileUtils.listDir with listOldestFirst)
+        """
+        return self._sorted(key, False, fullPaths)
+
+
+    def newestFirst(self, key = "ctime", fullPaths = False):
+        """
+        Names (or paths) sorted by the given stat attribute, newest first
+        """
+        return self._sorted(key, True, fullPaths)
+
+
+    def _sorted(self, key, reverse, fullPaths):
+        entries = self.entries.values()
+        entries.sort(key = lambda e: (getattr(e, key), e.name),
+                     reverse = reverse)
+        if fullPaths:
+            return [e.path for e in entries]
+        return [e.name for e in entries]
@@ -0,0 +1,178 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Wait for files to land in a set of directories.
+
+Uses Linux inotify (via ctypes) if it is available, so that the caller
+wakes up as soon as a file is closed after writing, a directory is made,
+or either is moved into a watched directory.  Otherwise (or if inotify is not wanted) wait() just sleeps, so
+the caller falls back to polling.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import select
+import struct
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                        use_errno = True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_event_struct = "iIII"  # wd, mask, cookie, len
+_event_size = struct.calcsize(_event_struct)
+
+
+class DirWatcher(object):
+    """
+    Watches directories for files being closed after writing
+    (IN_CLOSE_WRITE), directories being made in them (IN_CREATE, e.g. a
+    dataset directory made in place and then filled) or either being moved
+    into them (IN_MOVED_TO).  A plain file being created is not an event,
+    as it has yet to be written.
+
+        watcher = DirWatcher()
+        watcher.addDir("/some/dir")
+        names = watcher.wait(60)
+
+    wait() returns as soon as there is an event, or after the timeout,
+    so it also serves as the periodic resync in case any events are missed.
+    """
+
+    def __init__(self, use_inotify = True):
+        self.fd = None
+        self.dirs = {}
+        if use_inotify and _libc:
+            fd = _libc.inotify_init()
+            if fd >= 0:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                self.fd = fd
+
+
+    def __del__(self):
+        self.close()
+
+
+    def close(self):
+        if self.fd != None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+    def isEventDriven(self):
+        """
+        True if wait() will wake up on events, False if it just sleeps
+        """
+        return self.fd != None
+
+
+    def addDir(self, dir_path):
+        """
+        Start watching a directory.  Returns True if it is being watched
+        (always False if not event driven).
+        """
+        if self.fd == None:
+            return False
+        wd = _libc.inotify_add_watch(self.fd, dir_path,
+                                     IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            return False
+        self.dirs[wd] = dir_path
+        return True
+
+
+    def readEvents(self):
+        """
+        Read whatever events are queued without waiting.  Returns a list of
+        (dir_path, name) tuples.  On queue overflow, returns a single
+        (None, None) entry, meaning that anything may have changed.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            pos = 0
+            while pos + _event_size <= len(data):
+                wd, mask, cookie, length = \
+                    struct.unpack_from(_event_struct, data, pos)
+                name = data[pos + _event_size : pos + _event_size + length]
+                pos += _event_size + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, None))
+                elif mask & IN_IGNORED:
+                    # watched directory was removed
+                    self.dirs.pop(wd, None)
+                elif mask & IN_CREATE and not mask & IN_ISDIR:
+                    # (we hear about it again when it is closed)
+                    pass
+                else:
+                    events.append((self.dirs.get(wd), name.rstrip("\0")))
+        return events
+
+
+    def wait(self, timeout, wanted = None):
+        """
+        Wait up to timeout seconds for a file to land in any watched
+        directory.  wanted is an optional callable taking a file name, to
+        say which files are of interest (others do not end the wait).
+
+        Returns list of names of files that landed, or [None] if the event
+        queue overflowed, or [] if the timeout expired (or a signal was
+        received).  If not event driven, just sleeps and returns [].
+        """
+        if self.fd == None:
+            time.sleep(timeout)
+            return []
+
+        end_time = time.time() + timeout
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return []
+            try:
+                ready, w, x = select.select([self.fd], [], [], remaining)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    # let the caller check whether it was told to stop
+                    return []
+                raise
+            if not ready:
+                return []
+
+            names = [name for dir_path, name in self.readEvents()
+                     if name == None or wanted == None or wanted(name)]
+            if names:
+                return names
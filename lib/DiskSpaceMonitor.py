@@ -16,6 +16,7 @@ import time
 import tempfile
 
 from FileUtils import futils
+from DirIndex import DirIndex
 
 import LoggerClient
 
@@ -82,6 +83,9 @@ class DiskSpaceMonitor(object):
         self.prio_item = 'priority'
         self.stop_file_name = gconfig["incoming"]["stop_file"]
 
+        # directory indexes are kept between polls (see getDirIndex)
+        self.dir_indexes = {}
+
         if self.gconfig.checkSet("global.debug_on"):
             self.debug_on = self.gconfig.get("global.debug_on")
         else:
@@ -249,40 +253,53 @@ class DiskSpaceMonitor(object):
         q_dir = dconfig["outgoing"]["quarantine_dir"]
         arr_dir = dconfig["incoming"]["directory"]
 
-        list_dir_func = lambda dir_path: \
-                           futils.listDir(dir_path, 
-                                          fullPaths = True,
-                                          emptyListOnException = True)
-
         # add items in dataset dir
-        transfer_units = list_dir_func(ds_dir)
+        entries = self.scanDirIndex(ds_dir)
 
         if q_dir:
             # if there is a quarantine directory, add items in the quarantine
             # directory, but first exclude the quarantine dir itself, which
             # may be an entry under the dataset dir
-            transfer_units = filter(lambda path: path != q_dir,
-                                    transfer_units) \
-                               + list_dir_func(q_dir)
-        
-        
-        transfer_units.sort(key = futils.getCtimeOrNone,
-                            reverse = True)
-        
+            entries = [e for e in entries if e.path != q_dir] \
+                      + self.scanDirIndex(q_dir)
+
+        entries.sort(key = lambda e: e.ctime, reverse = True)
+        transfer_units = [e.path for e in entries]
+
         # add items in arrivals dir at start (if there is one)
         if arr_dir:
-            arr_transfer_units = list_dir_func(arr_dir)
-            arr_transfer_units.sort(key = futils.getCtimeOrNone,
-                                    reverse = True)
-            transfer_units = arr_transfer_units + transfer_units
-
-        # Okay we're done, though for good measure check they all really 
-        # exist
-        transfer_units = filter(os.path.exists, transfer_units)
+            arr_entries = self.scanDirIndex(arr_dir)
+            arr_entries.sort(key = lambda e: e.ctime, reverse = True)
+            transfer_units = [e.path for e in arr_entries] + transfer_units
 
         return transfer_units
 
 
+    def getDirIndex(self, dir_path):
+        """
+        Get the index for a directory, creating it if this is the first
+        time we have looked at it.  The indexes persist between polls so
+        that entries we already know about do not need to be stat'ed again.
+        """
+        if dir_path not in self.dir_indexes:
+            self.dir_indexes[dir_path] = DirIndex(dir_path, stat_known = False)
+        return self.dir_indexes[dir_path]
+
+
+    def scanDirIndex(self, dir_path):
+        """
+        Rescan a directory and return its entries (DirEntryState objects),
+        or an empty list if it cannot be listed.  The scan only stats new
+        entries, so they are all stat'ed again for their ctimes (this is
+        only done when something has to be deleted).
+        """
+        index = self.getDirIndex(dir_path)
+        if not index.scan():
+            return []
+        index.refreshStats()
+        return index.getEntries()
+
+
     def deleteFilesWhileVeryLowDisk(self, dconfig, deletions):
         """
         Keep deleting files from a data_stream while disk state is 
@@ -301,8 +318,17 @@ class DiskSpaceMonitor(object):
             if self.getDiskState() != DiskState.VLOW:
                 return True
 
+            # the listing may be out of date, so for good measure check
+            # it really still exists
+            if not os.path.lexists(tu_path):
+                continue
+
             deletions.append(tu_path)
             if os.path.isdir(tu_path):
+                stats = futils.getDirStats(tu_path)
+                if stats:
+                    self.info("deleting directory %s (%d files, %d bytes)" %
+                              (tu_path, stats[0], stats[1]))
                 # recursive deletion - may take a while, so 
                 # move it inside a temporary dot-dir first (and then
                 # delete from the level of the dot-dir itself) to
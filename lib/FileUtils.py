@@ -8,26 +8,81 @@
 import os
 import stat
 import time
-import hashlib 
+import shutil
+import gzip
+import tarfile
+import zlib
+import tempfile
+import itertools
+import multiprocessing
+from cStringIO import StringIO
 
 import Response
 import MyZipFile
-
-
-class _SizeAdder(object):
+import Checksum
+
+# scandir gives us the entry type from the directory listing itself
+# (d_type), so we can avoid stat calls on directories when walking a tree.
+# It is in the standard library from python 3.5, otherwise use the backport
+# if it is installed.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# files at least this big are deflated into a temporary file by _deflateFile,
+# rather than in memory
+deflate_spill_size = 0x1000000  # 16 MiB
+
+def _deflateFile(args):
     """
-    Helper for FileUtils.getDirSize()
-    Provides add() that we can call from FileUtils.recurseDir()
+    Helper for FileUtils._zipDir: raw deflate a file, as for a zip member.
+    A plain function so that it can be run in a worker process.  Returns
+    (crc, file size, compressed size, compressed data or None, path of a
+    temporary file holding it or None).
     """
-    def __init__(self, futils):
-        self.total = 0
-        self.futils = futils
-    def add(self, file):
+    path, level, spill_dir = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    compress_size = 0
+    if os.path.getsize(path) >= deflate_spill_size:
+        fd, tmp_path = tempfile.mkstemp(prefix = ".zip_member_",
+                                        dir = spill_dir)
+        out = os.fdopen(fd, "wb")
+    else:
+        tmp_path = None
+        out = StringIO()
+    try:
+        f = open(path, "rb")
         try:
-            self.total += self.futils.getSize(file)
-            return Response.success()
-        except OSError:
-            return Response.failure()
+            while True:
+                buf = f.read(0x100000)
+                if not buf:
+                    break
+                file_size += len(buf)
+                crc = zlib.crc32(buf, crc)
+                buf = compressor.compress(buf)
+                compress_size += len(buf)
+                out.write(buf)
+        finally:
+            f.close()
+        buf = compressor.flush()
+        compress_size += len(buf)
+        out.write(buf)
+    except:
+        out.close()
+        if tmp_path:
+            os.remove(tmp_path)
+        raise
+    if tmp_path:
+        out.close()
+        return crc & 0xffffffff, file_size, compress_size, None, tmp_path
+    return crc & 0xffffffff, file_size, compress_size, out.getvalue(), None
 
 
 
@@ -46,28 +101,15 @@ class FileUtils(object):
             return False
         return True
 
-    def calcChecksum(self, file_path):
+    def calcChecksum(self, file_path, algorithm = "md5", buffer_size = None,
+                     read_mode = None, drop_cache = False):
         """
-        NOTE: THIS MIGHT NOT BE BEST METHOD FOR CALCULATING MD5 checksum!!!!
-
-        comment from Alan - tested it and it agrees with md5sum command - 
-        haven't tested performance
+        Calculate the checksum of a file (hex string) - see Checksum module
+        for the algorithms available and the ways of reading the file.  The
+        default, md5, agrees with the md5sum command.
         """
-        block_size = 0x10000
-
-        def upd(m, data):
-            m.update(data)
-            return m
-
-        fd = open(file_path, "rb")
-        try:
-            contents = iter(lambda: fd.read(block_size), "")
-            m = reduce(upd, contents, hashlib.md5())
-            checksum = m.hexdigest()
-        finally:
-            fd.close()
-
-        return checksum
+        return Checksum.calcChecksum(file_path, algorithm, buffer_size,
+                                     read_mode, drop_cache)
 
 
     def getDiskSpace(self, path, getNonRoot=False):
@@ -108,20 +150,99 @@ class FileUtils(object):
         return 0
 
    
-    def getDirSize(self, dir_path):
+    def _listDirForWalk(self, dir_path):
+        """
+        Helper for walkRegularFiles: return lists of (subdirectory paths,
+        (path, stat result) of regular files) in a directory.  Symlinks to
+        directories are not followed; symlinks to files are, as for
+        os.path.isfile.
+        """
+        subdirs = []
+        files = []
+        if scandir:
+            for entry in scandir(dir_path):
+                # (is_dir and is_file use d_type where they can)
+                if entry.is_dir(follow_symlinks = False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append((entry.path, entry.stat()))
+        else:
+            for name in os.listdir(dir_path):
+                path = os.path.join(dir_path, name)
+                st = os.lstat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(path)
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue  # dangling
+                if stat.S_ISREG(st.st_mode):
+                    files.append((path, st))
+        return subdirs, files
+
+
+    def walkRegularFiles(self, dir_path, limit = None):
+        """
+        Generate (path, stat result) for the regular files under a
+        directory, as found by _listDirForWalk.  The tree is walked
+        iteratively, so depth is no problem; OSError is raised if any of
+        it cannot be read.
+
+        If limit is given, stop after the directory in which the total size
+        of the files so far passes it.
+        """
+        size = 0
+        to_walk = [dir_path]
+        while to_walk:
+            subdirs, files = self._listDirForWalk(to_walk.pop())
+            for path, st in files:
+                size += st.st_size
+                yield path, st
+            if limit != None and size > limit:
+                return
+            # (popped from the end, so walk them in the order listed)
+            to_walk.extend(reversed(subdirs))
+
+
+    def getDirStats(self, dir_path, limit = None):
+        """
+        Walk a directory tree (iteratively, so depth is no problem) and
+        return a tuple of (number of regular files, their total size in
+        bytes, their latest mtime or None), or None if any of it cannot be
+        read.
+
+        If limit is given, stop as soon as the total size is more than
+        that, in which case the figures are for the part walked so far and
+        the size is only known to exceed the limit.
+        """
+        count = 0
+        size = 0
+        latest = None
+        try:
+            for path, st in self.walkRegularFiles(dir_path, limit):
+                count += 1
+                size += st.st_size
+                if latest == None or st.st_mtime > latest:
+                    latest = st.st_mtime
+        except OSError:
+            return None
+        return (count, size, latest)
+
+
+    def getDirSize(self, dir_path, limit = None):
         """
-        recursively add sizes of regular files contained under directory 
-        (in bytes)
+        add sizes of regular files contained under directory (in bytes),
+        or return -1 if it cannot be read
+
+        If limit is given, stop as soon as the total is more than that, in
+        which case the total returned is only known to exceed the limit.
         """
-        adder = _SizeAdder(self)
-        resp = self.recurseDir(dir_path,
-                               adder.add,
-                               None,
-                               regular_files_only = True)
-        if not resp:
+        stats = self.getDirStats(dir_path, limit)
+        if stats == None:
             return -1
-        else:
-            return adder.total
+        return stats[1]
 
 
     def getLastUpdatedTime(self, file_path):
@@ -133,6 +254,28 @@ class FileUtils(object):
         return 0
 
     
+    def getStatSignature(self, path):
+        """
+        Return a tuple of (number of files, total size, latest mtime) for
+        a path, for comparing before and after an interval to see whether
+        it is still being written to.  For a directory this covers all
+        the regular files underneath it.  Returns None if it can't be stat'ed.
+        """
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                latest = os.path.getmtime(path)
+                stats = self.getDirStats(path)
+                if stats == None:
+                    return None
+                count, size, files_latest = stats
+                return (count, size, max(latest, files_latest))
+            else:
+                st = os.stat(path)
+                return (1, st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+
     def getCtimeOrNone(self, file_path):
         """
         Get ctime, or if an error then return None
@@ -194,13 +337,53 @@ class FileUtils(object):
         return retval
 
 
-    def _zipDir(self, dir_path, zip_file_path = None):
+    archive_formats = ("zip", "tar")
+    archive_compressions = ("deflate", "store")
+    default_compression_level = 6
+
+
+    def getStateDir(self, config):
+        """
+        The directory for state shared between the processes on this host
+        (global.state_dir, by default var under global.top), made if need be
+        """
+        state_dir = config.get("global.state_dir")
+        if not state_dir:
+            state_dir = os.path.join(config.get("global.top") or ".", "var")
+        self.ensureDirExists(state_dir)
+        return state_dir
+
+
+    def getArchiveName(self, dir_path, archive_format = "zip",
+                       compression = "deflate"):
+        """
+        The name of the archive file made from a directory by archiveDir:
+        dir_path + ".zip", ".tar" or (compressed) ".tar.gz"
+        """
+        while dir_path[-1] == '/':
+            dir_path = dir_path[: -1]
+        if archive_format == "zip":
+            return dir_path + ".zip"
+        if compression == "deflate":
+            return dir_path + ".tar.gz"
+        return dir_path + ".tar"
+
+
+    def _zipDir(self, dir_path, zip_file_path = None,
+                compression = "deflate", level = default_compression_level,
+                store_extensions = (), workers = 1):
         """
         Zips a directory; the zip file will contain the regular files
         found under that directory.  Only the basename part of dir_path
         plus any subdirectories encountered will be stored in the directory
         names in the zip file.  Returns zip file path, which unless
         specified in optional input will default to dir_path + ".zip"
+
+        compression is "deflate" (at the given zlib level) or "store" (no
+        compression).  Files whose names end in any of store_extensions
+        (e.g. ".gz", for data which is already compressed) are stored
+        rather than deflated regardless.  With workers > 1, the files are
+        deflated in that many processes at once.
         """
         while dir_path[-1] == '/':
             dir_path = dir_path[: -1]
@@ -208,16 +391,58 @@ class FileUtils(object):
         if not zip_file_path:
             zip_file_path = dir_path + ".zip"
 
+        paths = [path for path, st in self.walkRegularFiles(dir_path)]
+
+        store_extensions = tuple(ext.lower() for ext in store_extensions)
+        def deflate(path):
+            return (compression != "store" and
+                    not path.lower().endswith(store_extensions))
+        # (big members are deflated into temporary files in here)
+        spill_dir = tempfile.mkdtemp(prefix = ".zip_members_",
+                                     dir = os.path.dirname(zip_file_path))
+        jobs = [(path, level, spill_dir) for path in paths if deflate(path)]
+
+        pool = None
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            deflated = pool.imap(_deflateFile, jobs)
+        else:
+            deflated = itertools.imap(_deflateFile, jobs)
+
         z = MyZipFile.MyZipFile(zip_file_path, mode="w",
-                                compression = MyZipFile.ZIP_DEFLATED,
+                                compression = MyZipFile.ZIP_STORED,
+                                allowZip64 = True,
                                 remove_prefix = os.path.dirname(dir_path) + '/')
-
-        resp = self.recurseDir(dir_path,
-                               Response.Wrapper(z.writeWithoutPrefix),
-                               None,
-                               regular_files_only = True)
-        resp.assert_()
-        z.close()
+        try:
+            # (members are written in order as they are ready)
+            for path in paths:
+                if not deflate(path):
+                    z.writeWithoutPrefix(path)
+                    continue
+                crc, file_size, compress_size, data, tmp_path = deflated.next()
+                if tmp_path:
+                    data_file = open(tmp_path, "rb")
+                    try:
+                        z.writeCompressed(path, crc, file_size, compress_size,
+                                          data_file)
+                    finally:
+                        data_file.close()
+                        os.remove(tmp_path)
+                else:
+                    z.writeCompressed(path, crc, file_size, compress_size,
+                                      StringIO(data))
+            z.close()
+        except:
+            # don't leave a partial zip file to be sent
+            z.fp.close()
+            z.fp = None
+            os.remove(zip_file_path)
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            shutil.rmtree(spill_dir, True)
         return zip_file_path
 
 
@@ -228,6 +453,85 @@ class FileUtils(object):
         return Response.wrap(self._zipDir, *args, **kwargs)    
 
 
+    def _tarDir(self, dir_path, fileobj, compression = "deflate",
+                level = default_compression_level):
+        """
+        As _zipDir, but writes a tar archive (gzipped at the given level,
+        unless compression is "store") of the directory to fileobj.  Unlike a zip file this
+        is written strictly in order, so fileobj need not be seekable: it
+        can be a pipe (to send the archive as it is made) or a
+        Checksum.HashingWriter (to checksum it as it is written).
+        """
+        while dir_path[-1] == '/':
+            dir_path = dir_path[: -1]
+        prefix_length = len(os.path.dirname(dir_path) + '/')
+
+        gz = None
+        if compression == "deflate":
+            # (tarfile's own "w|gz" always uses compression level 9,
+            # which is slow for little gain)
+            gz = gzip.GzipFile(os.path.basename(dir_path) + ".tar", "wb",
+                               level, fileobj)
+            fileobj = gz
+        t = tarfile.open(mode = "w|", fileobj = fileobj)
+
+        def add(path):
+            t.add(path, arcname = path[prefix_length :], recursive = False)
+
+        try:
+            for path, st in self.walkRegularFiles(dir_path):
+                add(path)
+            t.close()
+        except:
+            # abandon it - don't let the garbage collector try to finish it
+            t.fileobj.closed = True
+            t.closed = True
+            raise
+        if gz:
+            gz.close()
+
+
+    def _archiveDir(self, dir_path, archive_format = "zip",
+                    compression = "deflate", algorithm = None,
+                    level = default_compression_level,
+                    store_extensions = (), workers = 1):
+        """
+        Pack a directory into a single file next to it (see getArchiveName)
+        with _zipDir or _tarDir.  Returns a tuple of (archive path, checksum)
+        where the checksum is None unless the archive is a tar file and
+        algorithm is given, in which case it is calculated as the archive
+        is written.
+
+        level, store_extensions and workers are as for _zipDir (only level
+        applies to a tar file, which is compressed as a whole).
+        """
+        archive_path = self.getArchiveName(dir_path, archive_format,
+                                           compression)
+        if archive_format == "zip":
+            return (self._zipDir(dir_path, archive_path, compression, level,
+                                 store_extensions, workers), None)
+
+        f = open(archive_path, "wb")
+        try:
+            writer = Checksum.HashingWriter(f, algorithm)
+            self._tarDir(dir_path, writer, compression, level)
+        except:
+            f.close()
+            os.remove(archive_path)
+            raise
+        f.close()
+        if algorithm:
+            return archive_path, writer.hexdigest()
+        return archive_path, None
+
+
+    def archiveDir(self, *args, **kwargs):
+        """
+        As _archiveDir, but returns a Response object
+        """
+        return Response.wrap(self._archiveDir, *args, **kwargs)
+
+
     # Functions deleteFile and deleteEmptyDir are like os.remove and
     # os.rmdir respectively, but they go via Response.Wrapper, so returns
     # a Response object, and any exceptions are just reflected in the
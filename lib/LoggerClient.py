@@ -9,9 +9,33 @@ import os
 #import re
 import logging, logging.handlers
 import signal
+import threading
 
 import AlertEmailer
 
+# the connection to the LoggerServer is shared by all of the clients in a
+# process (e.g. the data_streams run by a StreamEngine) - one per process,
+# as a connection made before a fork must not be used by the child too
+_socket_handlers = {}
+_socket_handlers_lock = threading.Lock()
+
+
+def getSocketHandler(host, port):
+    """
+    The handler which sends log records to the server at host, port from
+    this process
+    """
+    key = (host, port, os.getpid())
+    _socket_handlers_lock.acquire()
+    try:
+        handler = _socket_handlers.get(key)
+        if handler == None:
+            handler = logging.handlers.SocketHandler(host, port)
+            _socket_handlers[key] = handler
+        return handler
+    finally:
+        _socket_handlers_lock.release()
+
 
 class LoggerClient(object):
 
@@ -56,9 +80,20 @@ class LoggerClient(object):
    
         logger = logging.getLogger(tag)
         logger.setLevel(level)
-   
-        socketHandler = logging.handlers.SocketHandler(host, port)
-        logger.addHandler(socketHandler)
+
+        # loggers are shared between clients with the same tag, so only add
+        # a handler if there isn't one already, or every message is sent
+        # once for each client that has ever been created.  A handler for
+        # the same server made by another process (inherited across a
+        # fork) is replaced with this process's own.
+        socket_handler = getSocketHandler(host, port)
+        for handler in list(logger.handlers):
+            if (handler is not socket_handler
+                and isinstance(handler, logging.handlers.SocketHandler)
+                and (handler.host, handler.port) == (host, port)):
+                logger.removeHandler(handler)
+        if socket_handler not in logger.handlers:
+            logger.addHandler(socket_handler)
         self.logger = logger
         self.mailer = AlertEmailer.AlertEmailer(config,
                                                 name or tag)
@@ -67,11 +102,21 @@ class LoggerClient(object):
         self.email_timer = 300
         if config.checkSet("logging.email_timer"):
             self.email_timer = config.get("logging.email_timer")
-        signal.signal(signal.SIGALRM, self.sendEmails)
-        signal.alarm(self.email_timer)
+        # emails are batched up and sent on a timer, but signal handlers
+        # can only be installed from the main thread, so a client created
+        # in another thread (e.g. a transfer worker) sends them straight away
+        try:
+            signal.signal(signal.SIGALRM, self.sendEmails)
+            signal.alarm(self.email_timer)
+            self.batch_emails = True
+        except ValueError:
+            self.batch_emails = False
 
     def pushMessage(self, message):
-        self.emails.append(message)
+        if self.batch_emails:
+            self.emails.append(message)
+        else:
+            self.mailer.sendEmailInBackground(message)
 
     def sendEmails(self, signum, frame):
         self.info("sendEmails")
@@ -0,0 +1,83 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+from AbstractControlFile import *
+import Checksum
+
+
+class ManifestControlFile(AbstractControlFile):
+    """
+    A control file for several data files at once, answered by a single
+    ManifestReceiptFile, so that a batch of files needs one control file
+    and one receipt between them rather than one of each per file.
+
+    It has the same file extension as an ordinary ControlFile; the two are
+    told apart by the magic lines.
+
+    create() requires (rcpt_file_name, entries, algorithm) where entries is
+    a list of (data_file_name, size, checksum); read() returns
+    [rcpt_file_name, entries], and this is also in the data attribute
+    after either.
+
+    Lines of manifest control file are:
+
+        magic1
+        basename_requested_for_receipt_file
+        checksum_algorithm
+        number_of_data_files
+        size<TAB>checksum<TAB>data_file_name  (one line per data file)
+        magic2
+    """
+    magic1 = "_start_stager_manifest_data_"
+    magic2 = "_end_stager_manifest_data_"
+    algorithm = Checksum.default_algorithm
+
+    def encode(self, rcpt_file_name, entries,
+               algorithm = Checksum.default_algorithm):
+        self.algorithm = algorithm
+        lines = [rcpt_file_name, algorithm, len(entries)]
+        for data_file_name, size, cksum in entries:
+            lines.append("%s\t%s\t%s" % (size, cksum, data_file_name))
+        return lines
+
+    def decode(self, lines):
+        rcpt_file_name, self.algorithm, count = lines[:3]
+        entries = []
+        for line in lines[3:]:
+            size, cksum, data_file_name = line.split("\t", 2)
+            entries.append((data_file_name, int(size), cksum))
+        assert len(entries) == int(count)
+        return [rcpt_file_name, entries]
+
+    def create(self, *args, **kwargs):
+        AbstractControlFile.create(self, *args, **kwargs)
+        # so that data is as from read()
+        self.data = self.decode([str(line) for line in self.data])
+
+    def getRcptName(self):
+        return self.data[0]
+
+    def getEntries(self):
+        return self.data[1]
+
+    def getAlgorithm(self):
+        return self.algorithm
+
+
+if __name__ == '__main__':
+
+    import os
+
+    fname = "manifest.tmp"
+    os.system("rm -f %s" % fname)
+
+    m1 = ManifestControlFile(fname)
+    m1.create("manifest.rcpt", [("foo", 34, "a25902q5390"),
+                                ("bar baz", 0, "d41d8cd9")])
+    os.system("cat %s" % fname)
+    m2 = ManifestControlFile(fname)
+    print m2.read(), m2.getAlgorithm()
@@ -0,0 +1,110 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+from AbstractControlFile import *
+import ReceiptFile
+import Checksum
+
+
+class ManifestReceiptFile(AbstractControlFile):
+    """
+    The receipt for a ManifestControlFile: the result of checking each of
+    the data files it listed, with the same status codes as ReceiptFile.
+
+    It has the same file extension as an ordinary ReceiptFile; the two are
+    told apart by the magic lines.
+
+    create() requires (thankyou_file_name, entries, algorithm) where
+    entries is a list of (data_file_name, status, size, checksum) - size
+    and checksum may be None if not applicable; read() returns
+    [thankyou_file_name, entries], and this is also in the data attribute
+    after either.
+
+    Lines of manifest receipt file are:
+
+        magic1
+        basename_requested_for_thankyou_file
+        checksum_algorithm
+        number_of_data_files
+        status<TAB>size<TAB>checksum<TAB>data_file_name  (one per data file)
+        magic2
+    """
+    magic1 = "_start_stager_manifest_receipt_"
+    magic2 = "_end_stager_manifest_receipt_"
+    algorithm = Checksum.default_algorithm
+
+    def encode(self, thankyou_file_name, entries,
+               algorithm = Checksum.default_algorithm):
+        self.algorithm = algorithm
+        lines = [thankyou_file_name, algorithm, len(entries)]
+        for data_file_name, status, size, cksum in entries:
+            assert status in ReceiptFile.status_description
+            if size == None:
+                size = -1
+            lines.append("%s\t%s\t%s\t%s" %
+                         (status, size, cksum or "", data_file_name))
+        return lines
+
+    def decode(self, lines):
+        thankyou_file_name, self.algorithm, count = lines[:3]
+        entries = []
+        for line in lines[3:]:
+            status, size, cksum, data_file_name = line.split("\t", 3)
+            status = int(status)
+            assert status in ReceiptFile.status_description
+            entries.append((data_file_name, status, int(size), cksum))
+        assert len(entries) == int(count)
+        self.statuses = dict((entry[0], entry[1]) for entry in entries)
+        return [thankyou_file_name, entries]
+
+    def create(self, *args, **kwargs):
+        AbstractControlFile.create(self, *args, **kwargs)
+        self.data = self.decode([str(line) for line in self.data])
+
+    def getThankyouFileName(self):
+        return self.data[0]
+
+    def getEntries(self):
+        return self.data[1]
+
+    def getStatus(self, data_file_name = None):
+        """
+        The status for one of the data files, or None if it is not listed.
+        Without a name, the status for the whole manifest: SUCCESS if every
+        file was accepted, otherwise that of the first one which was not.
+        """
+        if data_file_name != None:
+            return self.statuses.get(data_file_name)
+        for name, status, size, cksum in self.getEntries():
+            if status != ReceiptFile.SUCCESS:
+                return status
+        return ReceiptFile.SUCCESS
+
+    def describeStatus(self, status):
+        try:
+            return ReceiptFile.status_description[status]
+        except KeyError:
+            return "unknown status code %s" % status
+
+    def getAlgorithm(self):
+        return self.algorithm
+
+
+if __name__ == '__main__':
+
+    import os
+
+    fname = "manifest_rcpt.tmp"
+    os.system("rm -f %s" % fname)
+
+    r1 = ManifestReceiptFile(fname)
+    r1.create(".manifest.thanks",
+              [("foo", ReceiptFile.SUCCESS, 34, "a25902q5390"),
+               ("bar", ReceiptFile.NO_SUCH_FILE, None, None)])
+    os.system("cat %s" % fname)
+    r2 = ManifestReceiptFile(fname)
+    print r2.read(), r2.getStatus("bar")
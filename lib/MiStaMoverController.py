@@ -20,6 +20,9 @@ import DatasetArrivalMonitor
 import LoggerServer
 import LoggerClient
 import DiskSpaceMonitorLauncher
+import BandwidthScheduler
+import CommandLimiter
+import StreamEngine
 
 class MiStaMoverController(object):
     """
@@ -35,6 +38,16 @@ class MiStaMoverController(object):
 
       * a DatasetArrivalMonitor for each data_stream which needs it
 
+    With global.bandwidth_limit set, it also shares the bandwidth out
+    between the data_streams with something to send (see
+    BandwidthScheduler), and with limits on the number of remote commands
+    run at once, it reports how many are running and waiting (see
+    CommandLimiter).
+
+    With global.engine = threads, the DatasetTransferControllers and
+    DatasetArrivalMonitors all run in one sub-process instead, driven by a
+    StreamEngine (not in oneoff mode).
+
     It is the top-level in MiStaMover (apart from the main program MiStaMover.py
     which basically just sets a few variables and calls this)
     """  
@@ -72,6 +85,7 @@ class MiStaMoverController(object):
         self.checkConfig()
 
         self.sub_procs = {}
+        self.engine_proc = None
 
         if not os.path.exists(self.gconfig.get("logging.base_log_dir")):
             print ("log path " + self.gconfig.get("logging.base_log_dir") + 
@@ -133,11 +147,23 @@ class MiStaMoverController(object):
         for signo in (signal.SIGTERM, signal.SIGINT):
             signal.signal(signo, self.stopHandler)
         
+        last_scan = time.time()
         while not self.stopRequested:
             # any signal will cause sleep to terminate early
             # after 30 seconds test for changes to configs dir
-            time.sleep(30)
-            self.scanDatasetConfigsForChange()
+            if self.bandwidth_scheduler or self.command_limiter:
+                # (and share out the bandwidth again as data_streams go
+                # busy or idle, and report on the remote commands)
+                time.sleep(self.gconfig.get("global.general_poll_interval"))
+                if self.bandwidth_scheduler:
+                    self.rebalanceBandwidth()
+                if self.command_limiter:
+                    self.reportCommands()
+            else:
+                time.sleep(30)
+            if time.time() - last_scan >= 30:
+                self.scanDatasetConfigsForChange()
+                last_scan = time.time()
     
         self.stopAll()
                 
@@ -310,6 +336,18 @@ class MiStaMoverController(object):
 
         print "Scanning for new data_stream configs or updated status in existing configs..."
 
+        if self.engine_proc != None:
+            # the engine has a fixed set of data_streams, so start it
+            # again with the new set
+            ds_removed = [ds_name for ds_name in self.dconfigs
+                          if ds_name not in self.datasets]
+            if ds_added or ds_removed:
+                self.info("restarting stream engine for changed data_streams")
+                self.stopEngine()
+                self._removeDeletedDatasets()
+                self.startEngine()
+            return
+
         # Now start up those that have just been added
         for ds_name in ds_added:
             print "Starting procs for data_stream %s" % ds_name
@@ -327,20 +365,140 @@ class MiStaMoverController(object):
         """
         self.startLogServer()
 
+        self.bandwidth_scheduler = \
+            BandwidthScheduler.getScheduler(self.gconfig)
+        if self.bandwidth_scheduler:
+            # anything left from a previous run is out of date
+            self.bandwidth_scheduler.clear()
+            self.info("sharing %s KB/s between data_streams" %
+                      self.bandwidth_scheduler.total)
+
+        self.command_limiter = CommandLimiter.getLimiter(self.gconfig)
+        self.command_status = None
+
         self.dsml = DiskSpaceMonitorLauncher.DiskSpaceMonitorLauncher(
             self.gconfig, self.dconfigs, logger = self.logger)
         self.dsml.launch()
 
         self.info("started log server")
+        if self.useEngine():
+            self.startEngine()
+            return
         for ds_name in self.datasets:
             self.info("starting procs for data_stream %s" % ds_name)
             self.startDatasetProcs(ds_name)
 
 
+    def useEngine(self):
+        """
+        Whether to run all of the data_streams in one process, with a
+        StreamEngine (global.engine = threads), rather than forking
+        processes for each
+        """
+        return (self.gconfig.get("global.engine") == "threads"
+                and not self.oneoff)
+
+
+    def startEngine(self):
+        """
+        Start the sub-process running the data_streams with a StreamEngine
+        """
+        ds_names = [ds_name for ds_name in self.datasets
+                    if ds_name in self.dconfigs]
+        self.info("starting stream engine for data_streams: %s" %
+                  " ".join(ds_names))
+        self.engine_proc = Daemon.DaemonCtl(self.runEngine,
+                                            args = [ds_names],
+                                            description = "mistamover_engine")
+
+
+    def stopEngine(self):
+        """
+        Ask the stream engine to stop (each data_stream after its current
+        step) and wait for it
+        """
+        if self.engine_proc == None:
+            return
+        self.info("signalling stream engine to stop")
+        self.engine_proc.sendSignal("USR1")
+        if self.engine_proc.isRunning():
+            status = self.engine_proc.getStatus(wait = True)
+            self.info("process '%s' exited with status %s" % \
+                          (self.engine_proc.description, status))
+        self.engine_proc = None
+
+
+    def runEngine(self, ds_names):
+        """
+        This is method that is run in the daemon when startEngine() is
+        called: the same controllers as startDatasetProcs() would run, for
+        all of the data_streams.
+
+        Don't call this directly unless you want it running
+        in the foreground.
+        """
+        engine = StreamEngine.StreamEngine(
+            use_inotify = self.gconfig.get("global.use_inotify"),
+            debug_on = self.debug_on, logger = self.logger)
+        for ds_name in ds_names:
+            dconfig = self.dconfigs[ds_name]
+            if dconfig.get("outgoing.transfer_protocol") != "none":
+                dconfig.set("global.oneoff", False)
+                engine.addStream(
+                    "transfer controller for data_stream %s" % ds_name,
+                    DatasetTransferController.DatasetTransferController,
+                    dconfig)
+            if dconfig['incoming']['require_arrival_monitor']:
+                # (each controller rereads its own config)
+                engine.addStream(
+                    "arrival monitor for data_stream %s" % ds_name,
+                    DatasetArrivalMonitor.DatasetArrivalMonitor,
+                    DatasetConfig(ds_name, self.gconfig))
+        return engine.run()
+
+
+    def rebalanceBandwidth(self):
+        """
+        Share global.bandwidth_limit between the data_streams which have
+        something to send, in proportion to their priorities
+        """
+        try:
+            allocations = self.bandwidth_scheduler.rebalance()
+        except (IOError, OSError), err:
+            self.warn("could not share out bandwidth: %s" % err)
+            return
+        if allocations != None:
+            self.info("bandwidth allocations (KB/s): %s" %
+                      (", ".join(["%s %s" % item for item in
+                                  sorted(allocations.items())]) or "none"))
+
+
+    def reportCommands(self):
+        """
+        Log how many remote commands are running and waiting to run when
+        that changes, and write it to the file "status" in the
+        CommandLimiter's directory (as json) for monitoring
+        """
+        try:
+            command_status = self.command_limiter.getStatus()
+        except (IOError, OSError), err:
+            self.warn("could not check remote commands: %s" % err)
+            return
+        if command_status == self.command_status:
+            return
+        self.command_status = command_status
+        self.info("remote commands: %s running, %d waiting%s" % (
+            command_status["running"], command_status["waiting"],
+            "".join(["; %s: %d" % item for item in
+                     sorted(command_status["hosts"].items())])))
+        self.command_limiter.saveStatus(command_status)
+
+
     def stopAll(self):
         """
         Stop the same things that startAll() starts
         """
+        self.stopEngine()
         for ds_name in self.datasets:
             self.info("signalling procs for data_stream %s to stop" %
                              ds_name)
@@ -13,9 +13,16 @@ Use exactly as for ZipFile except that on instantiaion you have the
 argument remove_prefix which is the prefix you want removed from all
 paths in the zip file, and method writeWithoutPrefix() which will
 be like ZipFile.write() except that it will remove the prefix
+
+writeCompressed() adds a file whose data has already been compressed
+(e.g. in another process), so that members can be compressed in parallel
 """
 
+import os
+import time
+import shutil
 from zipfile import *
+from zipfile import ZIP64_LIMIT
 
 
 class MyZipFile(ZipFile):
@@ -28,8 +35,42 @@ class MyZipFile(ZipFile):
         self.prefix_length = len(remove_prefix)
         ZipFile.__init__(self, path, *args, **kwargs)
 
-    def writeWithoutPrefix(self, fname, *args, **kwargs):
+    def getArcName(self, fname):
         aname = fname
         if self.remove_prefix and aname.startswith(self.remove_prefix):
             aname = aname[self.prefix_length :]
-        return self.write(fname, arcname=aname, *args, **kwargs)
+        return aname
+
+    def writeWithoutPrefix(self, fname, *args, **kwargs):
+        return self.write(fname, arcname=self.getArcName(fname),
+                          *args, **kwargs)
+
+    def writeCompressed(self, fname, crc, file_size, compress_size,
+                        data_file):
+        """
+        Add file fname (with the prefix removed, as writeWithoutPrefix)
+        where its contents have already been raw deflated (zlib with
+        wbits -15) into data_file, a file object read from its current
+        position.  crc is the CRC-32 of the uncompressed contents.
+        """
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        st = os.stat(fname)
+        zinfo = ZipInfo(self.getArcName(fname),
+                        time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = ZIP_DEFLATED
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        zip64 = self._allowZip64 and (file_size > ZIP64_LIMIT or
+                                      compress_size > ZIP64_LIMIT)
+        self.fp.write(zinfo.FileHeader(zip64))
+        shutil.copyfileobj(data_file, self.fp, 1 << 20)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
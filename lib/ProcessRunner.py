@@ -0,0 +1,317 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Run external commands without a shell, in the style of bin/runCommand.py:
+the command is exec'ed directly from an argument list, and its stdout and
+stderr are read as they are produced with select(), while any input is
+written to its stdin.
+
+Unlike runCommand, the output is not all kept: only the last max_output
+bytes of each stream are (see OutputBuffer), so a verbose command can't
+use unbounded memory, and each line can be passed to a callback as it
+arrives (e.g. to follow progress).  Lines may end in either "\\n" or "\\r",
+as programs which show progress rewrite the same line with "\\r".  A
+command may also be given a timeout, after which it (and anything it
+started) is killed.
+
+See doc strings for Command and runProcess.
+"""
+
+import os
+import re
+import time
+import shlex
+import pipes
+import errno
+import fcntl
+import select
+import signal
+from subprocess import Popen, PIPE
+
+# default number of bytes of each of stdout and stderr kept
+default_max_output = 0x100000  # 1 MiB
+
+# seconds between asking a command to stop and killing it
+kill_grace_period = 5
+
+# seconds to go on reading output once a command has exited, in case
+# something it left running in the background still has it open
+output_drain_period = 1
+
+# characters which mean that a command string needs a shell
+_shell_chars = set("|&;<>()$`\\\"'*?[]#~=%{}\n")
+
+
+class Command(object):
+    """
+    A command to run: a list of arguments (the first being the program),
+    and optionally a string to write to its standard input.
+
+    str() gives a shell-like rendering for logging, without the input
+    (which may hold a password).
+    """
+
+    def __init__(self, argv, input = None):
+        self.argv = [str(arg) for arg in argv]
+        self.input = input
+
+
+    def __str__(self):
+        text = " ".join([pipes.quote(arg) for arg in self.argv])
+        if self.input != None:
+            text += " < (input)"
+        return text
+
+    __repr__ = __str__
+
+
+    def __add__(self, args):
+        """
+        The same command with more arguments
+        """
+        return Command(self.argv + list(args), self.input)
+
+
+def makeCommand(cmd):
+    """
+    Turn what a transfer module gave as a command into a Command: a
+    Command is returned as it is, and a list of arguments is wrapped.
+    A string (the old style) is split into arguments, unless it uses
+    shell syntax, in which case it is run with /bin/sh as before.
+    """
+    if isinstance(cmd, Command):
+        return cmd
+    if isinstance(cmd, basestring):
+        if _shell_chars.intersection(cmd):
+            return Command(["/bin/sh", "-c", cmd])
+        return Command(shlex.split(cmd))
+    return Command(cmd)
+
+
+def splitCommand(cmd_string):
+    """
+    Split a command from the config (e.g. "rsync_ssh.cmd", which may
+    include options) into a Command
+    """
+    return Command(shlex.split(cmd_string or ""))
+
+
+class OutputBuffer(object):
+    """
+    Keeps the last max_bytes of a stream of output
+    """
+
+    def __init__(self, max_bytes = default_max_output):
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.size = 0
+        self.dropped = 0
+
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            excess = self.size - self.max_bytes
+            if len(self.chunks[0]) <= excess:
+                chunk = self.chunks.pop(0)
+                self.size -= len(chunk)
+                self.dropped += len(chunk)
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.size -= excess
+                self.dropped += excess
+
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class _LineSplitter(object):
+    """
+    Passes complete lines (ending in "\\n" or "\\r", without the ending) of
+    a stream of output to callback(name, line).  Only the last max_bytes
+    of a line which has not ended yet are kept, as for OutputBuffer.
+    """
+
+    line_end = re.compile(r"[\r\n]")
+
+    def __init__(self, name, callback, max_bytes = default_max_output):
+        self.name = name
+        self.callback = callback
+        self.max_bytes = max_bytes
+        self.partial = ""
+
+
+    def feed(self, data):
+        lines = self.line_end.split(self.partial + data)
+        self.partial = lines.pop()[-self.max_bytes :]
+        for line in lines:
+            if line:
+                self.callback(self.name, line)
+
+
+    def flush(self):
+        if self.partial:
+            self.callback(self.name, self.partial)
+        self.partial = ""
+
+
+class ProcessResult(object):
+    """
+    What runProcess found: returncode (negative if killed by a signal),
+    stdout and stderr (the last part of each, see OutputBuffer), and
+    whether it timed_out or was aborted (see check_abort)
+    """
+
+    def __init__(self, returncode, stdout, stderr, timed_out, elapsed,
+                 aborted = False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+        self.aborted = aborted
+
+
+def _nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK | flags)
+
+
+def _signalGroup(p, sig):
+    """
+    Send a signal to the process group of a command run by runProcess
+    (so that e.g. the ssh started by rsync goes too)
+    """
+    try:
+        os.killpg(p.pid, sig)
+    except OSError:
+        pass
+
+
+def runProcess(cmd, timeout = None, line_callback = None,
+               max_output = default_max_output, check_abort = None):
+    """
+    Run a command (a Command, or anything makeCommand takes) and return a
+    ProcessResult.  Raises OSError if the program cannot be run.
+
+    If timeout (seconds) is given, the command is killed once it has run
+    for that long.  line_callback(name, line), if given, is called with
+    each line of output as it arrives, where name is "stdout" or "stderr".
+    check_abort, if given, is called every second or so while the command
+    runs, and if it returns True the command is killed as for a timeout
+    (but aborted is set rather than timed_out).
+
+    The command runs in its own process group, which is what is killed.
+    runProcess returns once the command itself has exited (after reading
+    what is left of its output for up to output_drain_period seconds), so
+    anything it leaves running in the background does not hold it up.
+    """
+    cmd = makeCommand(cmd)
+    start = time.time()
+    if cmd.input != None:
+        stdin = PIPE
+    else:
+        stdin = open(os.devnull)
+    try:
+        p = Popen(cmd.argv, stdin = stdin, stdout = PIPE, stderr = PIPE,
+                  close_fds = True, preexec_fn = os.setpgrp)
+    finally:
+        if stdin != PIPE:
+            stdin.close()
+
+    buffers = {p.stdout.fileno(): OutputBuffer(max_output),
+               p.stderr.fileno(): OutputBuffer(max_output)}
+    splitters = {}
+    if line_callback:
+        splitters[p.stdout.fileno()] = _LineSplitter("stdout", line_callback,
+                                                     max_output)
+        splitters[p.stderr.fileno()] = _LineSplitter("stderr", line_callback,
+                                                     max_output)
+    rlist = buffers.keys()
+    wlist = []
+    input = cmd.input
+    if input != None:
+        _nonblocking(p.stdin.fileno())
+        wlist = [p.stdin.fileno()]
+
+    timed_out = False
+    aborted = False
+    killed_at = None
+    exited_at = None
+    while True:
+        now = time.time()
+        if exited_at == None and p.poll() != None:
+            exited_at = now
+        if exited_at != None:
+            if not (rlist or wlist) or now - exited_at > output_drain_period:
+                break
+        elif killed_at == None:
+            if timeout and now - start > timeout:
+                timed_out = True
+            elif check_abort and check_abort():
+                aborted = True
+            if timed_out or aborted:
+                _signalGroup(p, signal.SIGTERM)
+                killed_at = now
+        elif now - killed_at > kill_grace_period:
+            _signalGroup(p, signal.SIGKILL)
+
+        # (look at the process again more often once there is no output
+        # to wait on, or it has exited)
+        if exited_at != None:
+            wait = max(exited_at + output_drain_period - now, 0)
+        elif rlist or wlist:
+            wait = 0.25
+        else:
+            wait = 0.05
+        try:
+            r, w, x = select.select(rlist, wlist, [], wait)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in r:
+            data = os.read(fd, 0x10000)
+            if not data:
+                rlist.remove(fd)
+                if fd in splitters:
+                    splitters[fd].flush()
+                continue
+            buffers[fd].append(data)
+            if fd in splitters:
+                splitters[fd].feed(data)
+
+        if w:
+            try:
+                if input:
+                    input = input[os.write(p.stdin.fileno(), input):]
+                if not input:
+                    p.stdin.close()
+                    wlist = []
+            except OSError, err:
+                if err.errno != errno.EPIPE:
+                    raise
+                # it isn't reading any more
+                p.stdin.close()
+                wlist = []
+
+    for fd in splitters:
+        if fd in rlist:
+            splitters[fd].flush()
+    if wlist:
+        p.stdin.close()
+    stdout = buffers[p.stdout.fileno()].getvalue()
+    stderr = buffers[p.stderr.fileno()].getvalue()
+    p.stdout.close()
+    p.stderr.close()
+
+    return ProcessResult(p.returncode, stdout, stderr, timed_out,
+                         time.time() - start, aborted)
@@ -6,17 +6,20 @@
 # the full license text.
 
 from AbstractControlFile import *
+import Checksum
 
 SUCCESS = 0
 BAD_SIZE = 1
 BAD_CKSUM = 2
 IO_ERROR = 3
 NO_SUCH_FILE = 4
+UNSUPPORTED_ALGORITHM = 5
 status_description = { 0: "success",
                        1: "data file has bad size",
                        2: "data file has bad checksum",
                        3: "I/O error reading data file",
-                       4: "data file does not exist" }
+                       4: "data file does not exist",
+                       5: "checksum algorithm not supported" }
 _all_status_codes = status_description.keys()
 
 
@@ -38,13 +41,17 @@ class ReceiptFile(AbstractControlFile):
         data_file_name
         numerical_status (see codes at top of module)
         actual_size_in_bytes (if applicable else empty line)
-        actual_md5_checksum (if applicable else empty line)
+        actual_checksum (if applicable else empty line)
         basename_requested_for_thankyou_file
+        checksum_algorithm (optional)
         magic2
 
+    As for control files, the checksum algorithm line is only written if
+    it is not md5, and is available from getAlgorithm().
     """
     magic1 = "_start_stager_receipt_data_"
     magic2 = "_end_stager_receipt_data_"
+    algorithm = Checksum.default_algorithm
 
     def describeStatus(self, status):
         try:
@@ -53,11 +60,17 @@ class ReceiptFile(AbstractControlFile):
             return "unknown status code %s" % status
     
     def encode(self, filename, status, size = -1, cksum = "",
-               thankyou_file = ""):
+               thankyou_file = "", algorithm = Checksum.default_algorithm):
         assert status in _all_status_codes
-        return [filename, status, size, cksum, thankyou_file]
+        self.algorithm = algorithm
+        lines = [filename, status, size, cksum, thankyou_file]
+        if algorithm != Checksum.default_algorithm:
+            lines.append(algorithm)
+        return lines
 
     def decode(self, lines):
+        if len(lines) == 6:
+            self.algorithm = lines.pop()
         filename = lines[0]
         status = int(lines[1])
         size = int(lines[2])
@@ -78,6 +91,12 @@ class ReceiptFile(AbstractControlFile):
     def getFileChecksum(self):
         return self.data[3]
 
+    def getThankyouFileName(self):
+        return self.data[4]
+
+    def getAlgorithm(self):
+        return self.algorithm
+
 if __name__ == '__main__':
     
     import os
@@ -0,0 +1,221 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Running many data_streams in one process (global.engine = threads), rather
+than a process (or two) for each.
+
+Each DatasetTransferController and DatasetArrivalMonitor is run a step at
+a time (see AbstractDatasetController): the worker threads run the steps
+of whichever controllers are due, and the main thread waits, for all of
+them at once, until the next one is due or a file of interest lands in
+one of their directories (with a single DirWatcher).  There is a worker
+for each controller, as a step can block for a long time (waiting for a
+stop file to go, for items to settle or for a receipt), and otherwise a
+few such data_streams could hold up all of the others.  The number of
+remote commands run at once is limited as usual (see CommandLimiter).
+The controllers share the process's connection to the LoggerServer, and
+the bandwidth scheduler and command limiter work as they do between
+processes.
+
+Asking the process to stop (SIGUSR1) stops every data_stream, each after
+its current step.
+"""
+
+import os
+import time
+import errno
+import Queue
+import select
+import threading
+import traceback
+
+import Daemon
+from DirWatcher import DirWatcher
+
+
+class StreamTask(object):
+    """
+    One controller run by a StreamEngine, e.g. the DatasetTransferController
+    for a data_stream.  The controller itself is made in a worker thread
+    when it is first due.
+    """
+
+    def __init__(self, name, controller_class, dconfig):
+        self.name = name
+        self.controller_class = controller_class
+        self.dconfig = dconfig
+        self.controller = None
+        self.due = 0
+        self.running = False
+        self.finished = False
+        self.final_status = None
+        self.wanted = None
+
+
+    def runStep(self, watcher, debug_on = False):
+        """
+        Run the next step of the controller (making it and setting it up
+        first if need be), and work out when the one after is due
+        """
+        controller = self.controller
+        if controller == None:
+            controller = self.controller_class(self.dconfig,
+                                               debug_on = debug_on)
+            controller.shared_watcher = watcher
+            self.controller = controller
+            final_status = controller.setUp()
+            if final_status != None:
+                self.finish(final_status)
+                return
+        final_status = controller.step()
+        if final_status != None:
+            self.finish(final_status)
+            return
+        self.wanted, timeout = controller.getWait()
+        self.due = time.time() + controller.getWaitTime(timeout)
+
+
+    def finish(self, final_status):
+        self.finished = True
+        self.final_status = final_status
+
+
+    def isWatching(self, dir_path):
+        return dir_path in getattr(self.controller, "watched_dirs", ())
+
+
+class StreamEngine(object):
+    """
+    Runs the steps of a set of controllers (see addStream), until they
+    have all finished.  Failures are logged with the controller's logger
+    (or with logger, if the controller could not be made).
+    """
+
+    # longest time between checks for a stop request, in case a signal
+    # arrives while the main thread is not waiting
+    check_interval = 5
+
+    def __init__(self, use_inotify = False, debug_on = False, logger = None):
+        self.debug_on = debug_on
+        self.logger = logger
+        self.watcher = DirWatcher(use_inotify = use_inotify)
+        self.tasks = []
+        self.pending = Queue.Queue()
+        self.results = Queue.Queue()
+        # the workers write to this to wake up the main thread
+        self.wake_r, self.wake_w = os.pipe()
+
+
+    def addStream(self, name, controller_class, dconfig):
+        """
+        Add a controller to run: controller_class(dconfig, debug_on = ...)
+        """
+        self.tasks.append(StreamTask(name, controller_class, dconfig))
+
+
+    def _work(self):
+        """
+        Worker thread main loop.  A None task tells the worker to exit.
+        """
+        while True:
+            task = self.pending.get()
+            if task == None:
+                return
+            try:
+                task.runStep(self.watcher, self.debug_on)
+            except Exception, err:
+                message = "%s failed and will not be run again: %s\n%s" % \
+                          (task.name, err, traceback.format_exc())
+                logger = task.controller or self.logger
+                try:
+                    if logger:
+                        logger.error(message)
+                except Exception:
+                    pass
+                # (e.g. so that it no longer takes a share of the bandwidth)
+                try:
+                    task.controller.tearDown()
+                except Exception:
+                    pass
+                task.finish(None)
+            self.results.put(task)
+            os.write(self.wake_w, "x")
+
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for a step to finish or a file to land.
+        The controllers watching the directory where a file of interest
+        landed are made due now.
+        """
+        rlist = [self.wake_r]
+        if self.watcher.isEventDriven():
+            rlist.append(self.watcher.fd)
+        try:
+            ready, w, x = select.select(rlist, [], [], timeout)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                # let the caller check whether it was told to stop
+                return
+            raise
+        if self.wake_r in ready:
+            os.read(self.wake_r, 4096)
+        if self.watcher.fd in ready:
+            for dir_path, name in self.watcher.readEvents():
+                for task in self.tasks:
+                    if dir_path == None or (
+                        task.isWatching(dir_path)
+                        and (task.wanted == None or task.wanted(name))):
+                        task.due = 0
+
+
+    def run(self):
+        """
+        Run the controllers until they have all finished.  Returns the
+        number which failed.
+        """
+        workers = []
+        for i in range(len(self.tasks)):
+            worker = threading.Thread(target = self._work,
+                                      name = "stream_worker_%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        while True:
+            while True:
+                try:
+                    self.results.get_nowait().running = False
+                except Queue.Empty:
+                    break
+
+            live = [task for task in self.tasks if not task.finished]
+            if not live:
+                break
+
+            now = time.time()
+            stopping = Daemon.weWereSignalled("USR1")
+            for task in live:
+                if stopping:
+                    # (so that they all see it at once)
+                    task.due = 0
+                if not task.running and task.due <= now:
+                    task.running = True
+                    self.pending.put(task)
+
+            timeout = self.check_interval
+            for task in live:
+                if not task.running:
+                    timeout = min(timeout, max(task.due - now, 0))
+            self.wait(timeout)
+
+        for worker in workers:
+            self.pending.put(None)
+        for worker in workers:
+            worker.join()
+        return len([task for task in self.tasks if task.final_status == None])
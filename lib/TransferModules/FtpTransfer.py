@@ -8,7 +8,6 @@
 from TransferBase import TransferBase
 from TransferUtils import TransferUtils
 import os
-import tempfile
 import time
 
 import sys
@@ -21,14 +20,18 @@ from Response import Response, ResponseCode
 from ControlFile import ControlFile
 from ReceiptFile import ReceiptFile
 from ThankyouFile import ThankyouFile
+from ProcessRunner import Command, splitCommand
 
 class FtpTransfer(TransferBase):
     """
     Ftp transfer type
     """
+    # (ftp reads its commands on standard input, see makeFtpCmd)
+    stream_input = "fifo"
+
     def __init__(self, config):
         self.config = config
-        self.cmd = self.config.get("ftp.cmd");
+        self.cmd = splitCommand(self.config.get("ftp.cmd"))
 
         self.setConfig(config)
 
@@ -39,26 +42,35 @@ class FtpTransfer(TransferBase):
         self.rcpt_file_path = None
         self.ctl_file_path = None
 
+    def makeFtpCmd(self, commands, local_dir = None):
+        '''
+        create an ftp command which logs in to the target, changes to the
+        target directory and to local_dir (default the data_stream
+        directory), and then runs the given ftp commands.  These are given
+        to ftp on its standard input, so that the password is neither on
+        the command line nor in a file.
+        '''
+        if local_dir == None:
+            local_dir = self.config.get("data_stream.directory")
+        script = ["user " + self.config.get("ftp.username") + " " +
+                  self.config.get("ftp.password"),
+                  "cd " + self.config.get("outgoing.target_dir"),
+                  "lcd " + local_dir]
+        script += commands
+        script.append("exit")
+        return Command(self.cmd.argv +
+                       ["-n", self.config.get("outgoing.target_host")],
+                       input = "\n".join(script) + "\n")
+
     # called by TransferBase
     def setupStopFileCmd(self):
         '''
         called by TransferBase in order to create the command to check for stop
          files
         '''
-        tf, name = tempfile.mkstemp()
-        (os.write(tf, "user " + self.config.get("ftp.username") + " " +
-            self.config.get("ftp.password") + "\n"))
-        os.write(tf, "cd " + self.config.get("outgoing.target_dir") + "\n")
-        os.write(tf, "lcd " + self.config.get("data_stream.directory") + "\n")
-        os.write(tf, "get " + self.config.get("outgoing.stop_file") + "\n")
-        os.write(tf, "exit\n")
-        os.fsync(tf)
-        os.close(tf)
-        pullstop = ("/usr/bin/ftp -n " + self.config.get("outgoing.target_host")
-             + " < " + name)
+        pullstop = self.makeFtpCmd(["get " +
+                                    self.config.get("outgoing.stop_file")])
         self.info("setupStopFileCmd %s" % pullstop)
-        self.stoptf = tf
-        self.stopname = name
         return pullstop
 
     # called by TransferBase
@@ -88,32 +100,23 @@ class FtpTransfer(TransferBase):
             os.path.basename(ctl_file_name)))
         self.ctl_file_path = ctl_file_path
         item_size = os.path.getsize(item_path)
-        item_cksum = TransferUtils.calcChecksum(item_path)                                               
+        algorithm = self.config.get("outgoing.checksum_algorithm")
+        item_cksum = TransferUtils.calcChecksum(item_path, algorithm)
         ts = "%.2f" % time.time()
         rcpt_file_name = (".%s.%s.%s" % (item_name, ts, self.config.get(
             "outgoing.receipt_file_extension")))
         ctl_file = ControlFile(ctl_file_path, can_overwrite=True)
-        ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name)
+        ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name,
+                        algorithm = algorithm)
         self.rcpt_file_name = rcpt_file_name
         self.rcpt_file_path = (TransferUtils.getPathInDir(rcpt_file_name,
             self.config.get("data_stream.directory")))
         # set up ftp transfer + control file
-        tf, name = tempfile.mkstemp()
-        (os.write(tf, "user " + self.config.get("ftp.username") + " " +
-            self.config.get("ftp.password") + "\n"))
-        os.write(tf, "cd " + self.config.get("outgoing.target_dir") + "\n")
-        os.write(tf, "lcd " + self.config.get("data_stream.directory") + "\n")
-        os.write(tf, "put " + self.getFile() + "\n")
+        commands = ["put " + self.getFile()]
         if self.config.get("outgoing.target_uses_arrival_monitor"):
-            os.write(tf, "put " + ctl_file_name + "\n")
-        os.write(tf, "exit\n")
-        os.fsync(tf)
-        os.close(tf)
-        pushcmd = ("/usr/bin/ftp -n " + self.config.get("outgoing.target_host")
-            + " < " + name)
+            commands.append("put " + ctl_file_name)
+        pushcmd = self.makeFtpCmd(commands)
         self.info("setupPushCmd %s" % pushcmd)
-        self.pushtf = tf
-        self.pushname = name
         return pushcmd
 
     # called by TransferBase
@@ -122,20 +125,8 @@ class FtpTransfer(TransferBase):
         called by TransferBase to setup the command that pulls receipt files 
         from the target
         '''
-        tf, name = tempfile.mkstemp()
-        (os.write(tf, "user " + self.config.get("ftp.username") + " " +
-            self.config.get("ftp.password") + "\n"))
-        os.write(tf, "cd " + self.config.get("outgoing.target_dir") + "\n")
-        os.write(tf, "lcd " + self.config.get("data_stream.directory") + "\n")
-        os.write(tf, "get " + self.rcpt_file_name + "\n")
-        os.write(tf, "exit\n")
-        os.fsync(tf)
-        os.close(tf)
-        pullrcpt = ("/usr/bin/ftp -n " + self.config.get("outgoing.target_host")
-            + " < " + name)
+        pullrcpt = self.makeFtpCmd(["get " + self.rcpt_file_name])
         self.info("setupPullRcptCmd %s" % pullrcpt)
-        self.pulltf = tf
-        self.pullname = name
         return pullrcpt
 
     # called by TransferBase
@@ -165,20 +156,52 @@ class FtpTransfer(TransferBase):
         thankyou_file.create(self.rcpt_file_name)
         self.thankyou_file_path = thankyou_file_path
         # set up ftp transfer + thankyou file
-        tf, name = tempfile.mkstemp()
-        (os.write(tf, "user " + self.config.get("ftp.username") + " " +
-            self.config.get("ftp.password") + "\n"))
-        os.write(tf, "cd " + self.config.get("outgoing.target_dir") + "\n")
-        os.write(tf, "lcd " + self.config.get("data_stream.directory") + "\n")
-        os.write(tf, "put " + thankyou_file_name + "\n")
-        os.write(tf, "exit\n")
-        os.fsync(tf)
-        os.close(tf)
-        thankyoucmd = ("/usr/bin/ftp -n " + self.config.get(
-            "outgoing.target_host") + " < " + name)
+        thankyoucmd = self.makeFtpCmd(["put " + thankyou_file_name])
         self.info("setupThanksCmd %s" % thankyoucmd)
-        self.thktf = tf
-        self.thkname = name
+        return thankyoucmd
+
+    def setupStreamCmds(self, archive_name, source):
+        '''
+        create the commands to send an archive from the named pipe source
+        (read by cat, as ftp will only put plain files) into a temporary
+        dotfile in the target directory, to rename it once it is all there,
+        and to remove it if not
+        '''
+        part_name = ".%s.part" % archive_name
+        streamcmd = self.makeFtpCmd(["put \"|cat %s\" %s" %
+                                     (source, part_name)])
+        renamecmd = self.makeFtpCmd(["rename %s %s" %
+                                     (part_name, archive_name)])
+        cleanupcmd = self.makeFtpCmd(["delete " + part_name])
+        self.info("setupStreamCmds %s" % streamcmd)
+        return streamcmd, renamecmd, cleanupcmd
+
+    def setupPushControlCmd(self, ctl_file_name):
+        '''
+        create the command to push a control file on its own (after the
+        streamed archive it is for)
+        '''
+        return self.makeFtpCmd(["put " + ctl_file_name])
+
+    def setupPullAllRcptsCmd(self, dest_dir):
+        '''
+        called by TransferBase.collectReceipts to set up the command that
+        pulls every receipt file in the target directory in one session
+        '''
+        # ("prompt" turns off asking about each file)
+        pullrcpts = self.makeFtpCmd(["prompt", "mget .*." +
+            self.config.get("outgoing.receipt_file_extension")], dest_dir)
+        self.info("setupPullAllRcptsCmd %s" % pullrcpts)
+        return pullrcpts
+
+    def setupPushAllThanksCmd(self, thankyou_file_names):
+        '''
+        called by TransferBase.pushThankYous to set up the command that
+        pushes several thank-you files in one session
+        '''
+        thankyoucmd = self.makeFtpCmd(["put " + thankyou_file_name
+                                       for thankyou_file_name
+                                       in thankyou_file_names])
         return thankyoucmd
 
     def checkVars(self):
@@ -205,6 +228,9 @@ class FtpTransfer(TransferBase):
             rks = "".join(rk)
             raise Exception("%c" % rks)
     
+    def configChanged(self):
+        self.cmd = splitCommand(self.config.get("ftp.cmd"))
+
     # entry point for module  
     def setupTransfer(self, f):
         self.setFile(f)
@@ -212,9 +238,16 @@ class FtpTransfer(TransferBase):
             rc = ResponseCode(False)
             grv = Response(rc, "Not attempting file transfer")
             return grv
-        file_name = (TransferUtils.getPlainFileName(self.config.get(
-            "data_stream.directory"), f, self.config.get(
-            "outgoing.dir_size_limit")))
+        streaming = self.canStreamDir(f)
+        if streaming:
+            file_name = None
+            filesize = self.getStreamDirSize(f)
+            if filesize != None:
+                file_name = f
+        else:
+            file_name = (TransferUtils.getPlainFileName(self.config.get(
+                "data_stream.directory"), f, self.config.get(
+                "outgoing.dir_size_limit"), **self.getArchiveOptions()))
         if not file_name:
             (TransferUtils.quarantine(f, self.config.get("data_stream.directory"),
                  self.config.get("outgoing.quarantine_dir")))
@@ -224,11 +257,13 @@ class FtpTransfer(TransferBase):
         else:
             self.setFile(os.path.basename(file_name))
 
-        fn = os.path.join(self.config.get("data_stream.directory"), file_name)
-        filesize = os.path.getsize(fn)
+        if not streaming:
+            fn = os.path.join(self.config.get("data_stream.directory"),
+                              file_name)
+            filesize = os.path.getsize(fn)
 
         try:
-            self.checkVars()
+            self.checkVarsIfChanged()
         except Exception, ex:
             rc = ResponseCode(False)
             r = Response(rc, "not all variables in FtpTransfer ", str(ex))
@@ -241,22 +276,20 @@ class FtpTransfer(TransferBase):
 
         grv = self.waitForStopFile()
         if str(grv.code) == "Success":
-            os.remove(self.stopname)
             # get rid of any stop files we may have retrieved
             if (os.path.exists(self.config.get("data_stream.directory") + "/" +
                 self.config.get("outgoing.stop_file"))):
                 (os.remove(self.config.get("data_stream.directory") + "/" + 
                     self.config.get("outgoing.stop_file")))
 
-            grv = self.pushData()
+            if streaming:
+                self.info("Streaming directory %s; size: %s" %
+                          (f, filesize))
+                grv = self.streamDir()
+                self.info("FtpTransfer exiting %s" % str(grv.code))
+                return grv
 
-            # remove temp files
-            try:
-                os.remove(self.pushname)
-                os.remove(self.pullname)
-                os.remove(self.thkname)
-            except Exception, ex:
-                print str(ex)
+            grv = self.pushData()
 
             # remove transfer control files
             try:
@@ -20,14 +20,24 @@ from Response import Response, ResponseCode
 from ControlFile import ControlFile
 from ReceiptFile import ReceiptFile
 from ThankyouFile import ThankyouFile
+from ProcessRunner import Command, splitCommand
+from TransferMetrics import parseGlobusProgress
 
 class GridFTPTransferCertificate(TransferBase):
     """
     GridFTP transfer type
     """
+    # (globus-url-copy reads a streamed directory from a named pipe, see
+    # setupStreamCmds)
+    stream_input = "fifo"
+
+    # how long (in seconds) to go without checking the credential again,
+    # which is also how much longer it must be valid for when we check it
+    credential_check_interval = 600
+
     def __init__(self, config): 
         self.config = config
-        self.cmd = self.config.get("gridftp_certificate.cmd");
+        self.cmd = splitCommand(self.config.get("gridftp_certificate.cmd"))
     
         self.setConfig(config)
     
@@ -37,6 +47,19 @@ class GridFTPTransferCertificate(TransferBase):
         self.thankyou_file_path = None
         self.rcpt_file_path = None
         self.ctl_file_path = None
+        self.credential_checked = None
+
+    def getProgressOptions(self):
+        '''
+        with outgoing.progress_interval, have globus-url-copy report its
+        performance as it goes
+        '''
+        if self.getProgressInterval() > 0 and "-vb" not in self.cmd.argv:
+            return ["-vb"]
+        return []
+
+    def parseProgress(self, line):
+        return parseGlobusProgress(line)
 
     # this is called by TransferModule
     def setupPushCmd(self):
@@ -68,31 +91,36 @@ class GridFTPTransferCertificate(TransferBase):
                 "data_stream.directory"), os.path.basename(ctl_file_name)))
             self.ctl_file_path = ctl_file_path
             item_size = os.path.getsize(item_path)
-            item_cksum = TransferUtils.calcChecksum(item_path)
+            algorithm = self.config.get("outgoing.checksum_algorithm")
+            item_cksum = TransferUtils.calcChecksum(item_path, algorithm)
             ts = "%.2f" % time.time()
             rcpt_file_name = (".%s.%s.%s" % (item_name, ts, self.config.get(
                 "outgoing.receipt_file_extension")))
             ctl_file = ControlFile(ctl_file_path, can_overwrite=True)
-            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name)
+            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name,
+                            algorithm = algorithm)
             self.rcpt_file_name = rcpt_file_name
             self.rcpt_file_path = (TransferUtils.getPathInDir(rcpt_file_name,
                 self.config.get("data_stream.directory")))
 
         f = self.getFile()
-        gftp = self.cmd
+        gftp = self.cmd + self.getProgressOptions()
         if self.config.get("outgoing.target_uses_arrival_monitor") == False:
-            gftp += " -sync -sync-level 3"
-        pushcmd = (gftp + " " + self.config.get("data_stream.directory") + "/"
-            + f + " gsiftp://" + self.config.get("outgoing.target_host") + ":" 
+            gftp += ["-sync", "-sync-level", "3"]
+        pushcmd = gftp + [self.config.get("data_stream.directory") + "/"
+            + f, "gsiftp://" + self.config.get("outgoing.target_host") + ":" 
             + str(self.config.get("gridftp_certificate.port")) + "//" +  
-            self.config.get("outgoing.target_dir") + "/" + f)
+            self.config.get("outgoing.target_dir") + "/" + f]
         if self.config.get("outgoing.target_uses_arrival_monitor"):
-            pushcmd += ("; " + gftp + " " + self.config.get(
-                "data_stream.directory") + "/" + ctl_file_name + " gsiftp://"
+            # the data file, then the control file
+            pushcmd = [pushcmd, gftp + [self.config.get(
+                "data_stream.directory") + "/" + ctl_file_name, "gsiftp://"
                 + self.config.get("outgoing.target_host") + ":" +
                 str(self.config.get("gridftp_certificate.port")) +
-                self.config.get("outgoing.target_dir") + "/" + ctl_file_name)
-        self.info("setupPushCmd %s " % pushcmd)
+                self.config.get("outgoing.target_dir") + "/" + ctl_file_name]]
+            self.info("setupPushCmd %s " % "; ".join(map(str, pushcmd)))
+        else:
+            self.info("setupPushCmd %s " % pushcmd)
         return pushcmd
 
     def setupPullRcptCmd(self):
@@ -101,10 +129,10 @@ class GridFTPTransferCertificate(TransferBase):
         from the target
         '''
         gftp = self.cmd
-        pullrcpt = (gftp + " gsiftp://" + self.config.get("outgoing.target_host")
+        pullrcpt = gftp + ["gsiftp://" + self.config.get("outgoing.target_host")
             + ":" + str(self.config.get("gridftp_certificate.port")) + "//" + self.config.get(
-            "outgoing.target_dir") + "/" + self.rcpt_file_name + " " +
-            self.config.get("data_stream.directory") + "/" + self.rcpt_file_name)
+            "outgoing.target_dir") + "/" + self.rcpt_file_name,
+            self.config.get("data_stream.directory") + "/" + self.rcpt_file_name]
         return pullrcpt
 
     def setupPushThanksCmd(self):
@@ -133,13 +161,73 @@ class GridFTPTransferCertificate(TransferBase):
         thankyou_file = ThankyouFile(thankyou_file_path)
         thankyou_file.create(self.rcpt_file_name)
         self.thankyou_file_path = thankyou_file_path
-        thankyoucmd = (gftp + " " + self.config.get("data_stream.directory") +
-            "/" + thankyou_file_name + " gsiftp://" + self.config.get(
+        thankyoucmd = gftp + [self.config.get("data_stream.directory") +
+            "/" + thankyou_file_name, "gsiftp://" + self.config.get(
             "outgoing.target_host") + ":" + str(self.config.get(
             "gridftp_certificate.port")) + "//" +  self.config.get("outgoing.target_dir")
-            + "/" + thankyou_file_name)
+            + "/" + thankyou_file_name]
         return thankyoucmd
 
+    def getTargetUrl(self):
+        return ("gsiftp://" + self.config.get("outgoing.target_host") + ":" +
+            str(self.config.get("gridftp_certificate.port")) + "//" +
+            self.config.get("outgoing.target_dir") + "/")
+
+    def setupStreamCmds(self, archive_name, source):
+        '''
+        create the command to send an archive from the named pipe source
+        to the target directory.  It is written under its own name, as
+        setupPushCmd does for a file, so there are no commands to rename
+        or remove it.
+        '''
+        streamcmd = self.cmd + self.getProgressOptions() + [source,
+            self.getTargetUrl() + archive_name]
+        self.info("setupStreamCmds %s " % streamcmd)
+        return streamcmd, None, None
+
+    def setupPushControlCmd(self, ctl_file_name):
+        '''
+        create the command to push a control file on its own (after the
+        streamed archive it is for)
+        '''
+        return self.cmd + [self.config.get("data_stream.directory") + "/" +
+            ctl_file_name, self.getTargetUrl() + ctl_file_name]
+
+    def setupPullAllRcptsCmd(self, dest_dir):
+        '''
+        called by TransferBase.collectReceipts to set up the command that
+        pulls every receipt file in the target directory in one go
+        '''
+        pullrcpts = self.cmd + [self.getTargetUrl() + ".*." +
+            self.config.get("outgoing.receipt_file_extension"),
+            dest_dir + "/"]
+        self.info("setupPullAllRcptsCmd %s" % pullrcpts)
+        return pullrcpts
+
+    def setupPushAllThanksCmd(self, thankyou_file_names):
+        '''
+        called by TransferBase.pushThankYous to set up the command that
+        pushes several thank-you files in one go (a list of source and
+        destination pairs for -f)
+        '''
+        tf, name = tempfile.mkstemp()
+        for thankyou_file_name in thankyou_file_names:
+            os.write(tf, self.config.get("data_stream.directory") + "/" +
+                thankyou_file_name + " " + self.getTargetUrl() +
+                thankyou_file_name + "\n")
+        os.close(tf)
+        self.thkname = name
+        return self.cmd + ["-f", name]
+
+    def removeTempFiles(self):
+        '''
+        remove the list of files made by setupPushAllThanksCmd
+        '''
+        name = getattr(self, "thkname", None)
+        if name and os.path.exists(name):
+            os.remove(name)
+        self.thkname = None
+
     # this is called by TransferModule
     def setupStopFileCmd(self):
         '''
@@ -149,10 +237,10 @@ class GridFTPTransferCertificate(TransferBase):
         tf, name = tempfile.mkstemp()
         self.stopname = name
         self.stoptf = tf
-        pullstop = (self.cmd + " gsiftp://" + self.config.get(
+        pullstop = self.cmd + ["gsiftp://" + self.config.get(
             "outgoing.target_host") + ":" + str(self.config.get("gridftp_certificate.port"))
             + "//" + self.config.get("outgoing.target_dir") + "/" +
-            self.config.get("outgoing.stop_file") + " " + name)
+            self.config.get("outgoing.stop_file"), name]
         self.info("setupStopFileCmd %s " % pullstop)
         return pullstop
 
@@ -175,6 +263,19 @@ class GridFTPTransferCertificate(TransferBase):
         if not self.config.checkSet("data_stream.directory"):
             raise Exception("data_stream.directory is not set")
 
+    def configChanged(self):
+        self.cmd = splitCommand(self.config.get("gridftp_certificate.cmd"))
+
+    def credentialIsFresh(self):
+        '''
+        whether the credential was found to be valid (for at least another
+        credential_check_interval seconds) within the last
+        credential_check_interval seconds
+        '''
+        return (self.credential_checked != None and
+                time.time() - self.credential_checked <
+                self.credential_check_interval)
+
     # this is the entry point for the module
     def setupTransfer(self, f):
         self.setFile(f)
@@ -182,8 +283,16 @@ class GridFTPTransferCertificate(TransferBase):
             rc = ResponseCode(False)
             grv = Response(rc, "Not attempting file transfer")
             return grv
-        file_name = (TransferUtils.getPlainFileName(self.config.get(
-            "data_stream.directory"), f, self.config.get("outgoing.dir_size_limit")))
+        streaming = self.canStreamDir(f)
+        if streaming:
+            file_name = None
+            filesize = self.getStreamDirSize(f)
+            if filesize != None:
+                file_name = f
+        else:
+            file_name = (TransferUtils.getPlainFileName(self.config.get(
+                "data_stream.directory"), f, self.config.get(
+                "outgoing.dir_size_limit"), **self.getArchiveOptions()))
         if not file_name:
             (TransferUtils.quarantine(f, self.config.get("data_stream.directory"),
                  self.config.get("outgoing.quarantine_dir")))
@@ -193,11 +302,13 @@ class GridFTPTransferCertificate(TransferBase):
         else:
             self.setFile(os.path.basename(file_name))
 
-        fn = os.path.join(self.config.get("data_stream.directory"), file_name)
-        filesize = os.path.getsize(fn)
+        if not streaming:
+            fn = os.path.join(self.config.get("data_stream.directory"),
+                              file_name)
+            filesize = os.path.getsize(fn)
 
         try:
-            self.checkVars()
+            self.checkVarsIfChanged()
         except Exception, ex:
             rc = ResponseCode(False)
             r = Response(rc, "not all required variables in GridFTPTransfer are set : ", str(ex))
@@ -206,31 +317,40 @@ class GridFTPTransferCertificate(TransferBase):
         self.setStopReturnCode(1)
         self.setStopError("failed: No such file or directory")
 
-        # in order to use grid ftp we need a valid credential
-        self.info("GridFTPTransfer checking credentials")
-        checkCredential = "grid-proxy-info -exists"
-        grv = self.transferData(checkCredential)
-        if str(grv.code) == "Failure":
-            # try and set a new credential
-            self.info("GridFTPTransfer checking credentials failed %s" % grv.data)
-            tf, name = tempfile.mkstemp()
-            os.write(tf, self.config.get("gridftp_certificate.password"))
-            os.fsync(tf)
-            setupCredential = ("grid-proxy-init -pwstdin " + " < " + name)
-            grv = self.transferData(setupCredential)
-            try:
-                os.close(tf)
-                os.remove(name)
-            except:
-                pass
+        # in order to use grid ftp we need a valid credential (but we don't
+        # need to look again if we did so recently)
+        if not self.credentialIsFresh():
+            self.info("GridFTPTransfer checking credentials")
+            checkCredential = Command(["grid-proxy-info", "-exists", "-valid",
+                "%d:%02d" % divmod(self.credential_check_interval / 60, 60)])
+            grv = self.transferData(checkCredential)
             if str(grv.code) == "Failure":
-                return grv
+                # try and set a new credential
+                self.info("GridFTPTransfer checking credentials failed %s" % grv.data)
+                # (the password goes to its standard input)
+                setupCredential = Command(["grid-proxy-init", "-pwstdin"],
+                    input = self.config.get("gridftp_certificate.password"))
+                grv = self.transferData(setupCredential)
+                if str(grv.code) == "Failure":
+                    return grv
+            self.credential_checked = time.time()
 
         grv = self.waitForStopFile()
+        if str(grv.code) == "Success" and streaming:
+            self.info("Streaming directory %s; size: %s" % (f, filesize))
+            grv = self.streamDir()
+            self.info("GridFTPTransferCertificate exiting %s" % str(grv.code))
+            if str(grv.code) != "Success":
+                self.credential_checked = None
+            return grv
         if str(grv.code) == "Success":
             grv = self.pushData()
             self.info(" rv = %s " % str(grv.code))
             self.info("GridFTPTransferCertificate exiting %s" % str(grv.code))
+            if str(grv.code) != "Success":
+                # check the credential again before the next item, in case
+                # that is why it failed
+                self.credential_checked = None
             self.info("Successfully sent: %s; size: %s" % (self.getFile(), filesize))
         return grv
 
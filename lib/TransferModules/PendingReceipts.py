@@ -0,0 +1,219 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import os
+import time
+import json
+import threading
+
+
+def _bytes(value):
+    """
+    json gives back unicode, but file names here are byte strings
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, dict):
+        return dict((_bytes(k), _bytes(v)) for k, v in value.items())
+    return value
+
+
+class PendingReceipts(object):
+    """
+    The items which have been pushed to a target running an arrival monitor
+    but whose receipts have not been collected yet (see
+    outgoing.async_receipts), and the number of failed attempts to send
+    each item.
+
+    They are kept in a dotfile in the data_stream directory, so that after
+    a restart the receipts are still collected, rather than the items being
+    sent again.  The file is removed when there is nothing in it.
+
+    One of these is shared by all of the transfer modules for a data_stream
+    (including those in different worker threads).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}   # item -> dict, see add()
+        self.failures = {}  # item -> number of failed attempts
+        self.load()
+
+
+    def load(self):
+        """
+        Read the saved state, if any.  An unreadable file is ignored (the
+        items in it will then be sent again).
+        """
+        try:
+            f = open(self.path)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            self.entries = _bytes(state.get("pending", {}))
+            self.failures = _bytes(state.get("failures", {}))
+        except (IOError, ValueError, AttributeError):
+            pass
+
+
+    def save(self):
+        """
+        Write the state (tmp file and rename, so it is never half written)
+        """
+        self.lock.acquire()
+        try:
+            if not self.entries and not self.failures:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp_path = "%s.tmp" % self.path
+            f = open(tmp_path, "w")
+            try:
+                json.dump({"pending": self.entries,
+                           "failures": self.failures}, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        finally:
+            self.lock.release()
+
+
+    def add(self, item, rcpt_file_name, ctl_file_path, size):
+        """
+        Record that an item has been pushed, with its control file, and
+        that its receipt will be called rcpt_file_name
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.entries[item] = {"rcpt_file_name": rcpt_file_name,
+                                  "ctl_file_path": ctl_file_path,
+                                  "size": size,
+                                  "pushed": now,
+                                  "polled": now,
+                                  "due": now}
+        finally:
+            self.lock.release()
+        self.save()
+
+
+    def remove(self, item):
+        self.lock.acquire()
+        try:
+            self.entries.pop(item, None)
+        finally:
+            self.lock.release()
+
+
+    def get(self, item):
+        self.lock.acquire()
+        try:
+            return self.entries.get(item)
+        finally:
+            self.lock.release()
+
+
+    def isPending(self, item):
+        self.lock.acquire()
+        try:
+            return item in self.entries
+        finally:
+            self.lock.release()
+
+
+    def getItems(self):
+        self.lock.acquire()
+        try:
+            return self.entries.keys()
+        finally:
+            self.lock.release()
+
+
+    def _dueTime(self, entry, interval):
+        # (entries saved by older versions have no due time)
+        return entry.get("due", entry["polled"] + interval)
+
+
+    def getDue(self, interval):
+        """
+        The items (oldest first) whose receipts are due to be looked for
+        (see markPolled), or for those without a time set, were last
+        looked for at least interval seconds ago
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            due = [(entry["pushed"], item)
+                   for item, entry in self.entries.items()
+                   if self._dueTime(entry, interval) <= now]
+        finally:
+            self.lock.release()
+        due.sort()
+        return [item for pushed, item in due]
+
+
+    def getNextDue(self, interval):
+        """
+        The time at which the next receipt is due to be looked for, or None
+        if there are none pending
+        """
+        self.lock.acquire()
+        try:
+            if not self.entries:
+                return None
+            return min([self._dueTime(entry, interval)
+                        for entry in self.entries.values()])
+        finally:
+            self.lock.release()
+
+
+    def markPolled(self, item, delay = 0):
+        """
+        Record that the item's receipt was looked for but isn't there yet,
+        and that it is to be looked for again in delay seconds
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if item in self.entries:
+                self.entries[item]["polled"] = now
+                self.entries[item]["due"] = now + delay
+        finally:
+            self.lock.release()
+
+
+    def getAge(self, item):
+        """
+        Seconds since the item was pushed
+        """
+        return time.time() - self.get(item)["pushed"]
+
+
+    def addFailure(self, item):
+        """
+        Count a failed attempt to send an item, and return the number so far
+        """
+        self.lock.acquire()
+        try:
+            self.failures[item] = self.failures.get(item, 0) + 1
+            return self.failures[item]
+        finally:
+            self.lock.release()
+
+
+    def clearFailures(self, item):
+        self.lock.acquire()
+        try:
+            self.failures.pop(item, None)
+        finally:
+            self.lock.release()
+
+
+    def __len__(self):
+        return len(self.entries)
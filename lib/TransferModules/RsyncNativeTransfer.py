@@ -19,6 +19,8 @@ from Response import Response, ResponseCode
 from ControlFile import ControlFile
 from ReceiptFile import ReceiptFile
 from ThankyouFile import ThankyouFile
+from ProcessRunner import splitCommand
+from TransferMetrics import parseRsyncProgress
 
 
 class RsyncNativeTransfer(TransferBase):
@@ -27,7 +29,7 @@ class RsyncNativeTransfer(TransferBase):
     """
     def __init__(self, config): 
         self.config = config
-        self.cmd = self.config.get("rsync_native.cmd")
+        self.cmd = splitCommand(self.config.get("rsync_native.cmd"))
     
         self.setConfig(config)
     
@@ -38,11 +40,35 @@ class RsyncNativeTransfer(TransferBase):
         self.rcpt_file_path = None
         self.ctl_file_path = None
 
+        self.stripTargetDir()
+
+    def stripTargetDir(self):
         # remove any leading /
         otd = self.config.get("outgoing.target_dir")
         otd = otd.lstrip("/")
         self.config.set("outgoing.target_dir", otd)
 
+    def getProgressOptions(self):
+        '''
+        with outgoing.progress_interval, have rsync report the progress of
+        the whole transfer (needs rsync 3.1.0 or later)
+        '''
+        if self.getProgressInterval() > 0:
+            return ["--info=progress2"]
+        return []
+
+    def getBandwidthOptions(self):
+        '''
+        with global.bandwidth_limit, keep to this data_stream's share
+        '''
+        limit = self.getBandwidthLimit()
+        if limit:
+            return ["--bwlimit=%d" % limit]
+        return []
+
+    def parseProgress(self, line):
+        return parseRsyncProgress(line)
+
     # this is called from the TransferBase
     def setupPushCmd(self):
         '''
@@ -71,33 +97,31 @@ class RsyncNativeTransfer(TransferBase):
                 "data_stream.directory"), os.path.basename(ctl_file_name)))
             self.ctl_file_path = ctl_file_path
             item_size = os.path.getsize(item_path)
-            item_cksum = TransferUtils.calcChecksum(item_path)
+            algorithm = self.config.get("outgoing.checksum_algorithm")
+            item_cksum = TransferUtils.calcChecksum(item_path, algorithm)
             ts = "%.2f" % time.time()
             rcpt_file_name = (".%s.%s.%s" % (item_name, ts, self.config.get(
                 "outgoing.receipt_file_extension")))
             ctl_file = ControlFile(ctl_file_path, can_overwrite=True)
-            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name)
+            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name,
+                            algorithm = algorithm)
             self.rcpt_file_name = rcpt_file_name
             self.rcpt_file_path = (TransferUtils.getPathInDir(rcpt_file_name,
                 self.config.get("data_stream.directory")))
 
-        rsc = self.cmd + " -avz --password-file=" + self.passwordfile + " "
+        rsc = self.cmd + ["-avz", "--password-file=" + self.passwordfile]
         if self.config.get("rsync_native.use_checksum") == True:
-            rsc += " --checksum "
+            rsc += ["--checksum"]
         if self.config.get("rsync_native.check_size") == True:
-            rsc += " --size-only "
+            rsc += ["--size-only"]
+        rsc += self.getProgressOptions() + self.getBandwidthOptions()
         if not self.config.get("outgoing.target_uses_arrival_monitor"):
-            pushcmd = (rsc + self.config.get("data_stream.directory") + "/" +f
-                + " " + "rsync://" + self.config.get("rsync_native.username")
-                + "@" + self.config.get("outgoing.target_host") + "/" +
-                self.config.get("outgoing.target_dir") + "/" + f)
+            pushcmd = rsc + [self.config.get("data_stream.directory") + "/" +
+                f, self.getTargetUrl() + f]
         else:
-            pushcmd = (rsc + self.config.get("data_stream.directory") + "/" +f
-                + " " + self.config.get("data_stream.directory") + "/" +
-               ctl_file_name + " " + "rsync://" + self.config.get(
-               "rsync_native.username") + "@" + self.config.get(
-               "outgoing.target_host") + "/" + self.config.get(
-               "outgoing.target_dir"))
+            pushcmd = rsc + [self.config.get("data_stream.directory") + "/" +
+                f, self.config.get("data_stream.directory") + "/" +
+                ctl_file_name, self.getTargetUrl().rstrip("/")]
         self.info("setupPushCmd %s " % pushcmd)
         return pushcmd
 
@@ -107,13 +131,9 @@ class RsyncNativeTransfer(TransferBase):
         called by TransferBase in order to create the command to check for 
         stop files
         '''
-        listonly = (self.cmd + " --list-only --password-file=" +
-            self.passwordfile + " ")
-        pullstop = (listonly + "rsync://" + self.config.get(
-            "rsync_native.username") + "@" +
-            self.config.get("outgoing.target_host") + "/" +self.config.get(
-            "outgoing.target_dir") + "/" +  self.config.get(
-            "outgoing.stop_file"))
+        pullstop = self.cmd + ["--list-only",
+            "--password-file=" + self.passwordfile,
+            self.getTargetUrl() + self.config.get("outgoing.stop_file")]
         self.info("setupStopFileCmd %s " % pullstop)
         return pullstop
 
@@ -122,11 +142,9 @@ class RsyncNativeTransfer(TransferBase):
         called by TransferBase to setup the command that pulls receipt files 
         from the target
         '''
-        pullrcpt = (self.cmd + " --password-file=" + self.passwordfile +
-            " " + "rsync://" + self.config.get("rsync_native.username") + "@"
-            + self.config.get("outgoing.target_host") +  "/" +
-            self.config.get("outgoing.target_dir") + "/" + self.rcpt_file_name
-            + " " + self.config.get("data_stream.directory") + "/")
+        pullrcpt = self.cmd + ["--password-file=" + self.passwordfile,
+            self.getTargetUrl() + self.rcpt_file_name,
+            self.config.get("data_stream.directory") + "/"]
         self.info("setupPullRcptCmd %s" % pullrcpt)
         return pullrcpt
 
@@ -157,13 +175,65 @@ class RsyncNativeTransfer(TransferBase):
         thankyou_file = ThankyouFile(thankyou_file_path)
         thankyou_file.create(self.rcpt_file_name)
         self.thankyou_file_path = thankyou_file_path
-        thankyoucmd = (self.cmd + " --password-file=" + self.passwordfile +
-            " " + self.thankyou_file_path + "rsync://" + self.config.get(
-            "rsync_native.username") + "@" + self.config.get(
-            "outgoing.target_host") + "/" + self.config.get(
-            "outgoing.target_dir") + "/")
+        thankyoucmd = self.cmd + ["--password-file=" + self.passwordfile,
+            self.thankyou_file_path, self.getTargetUrl()]
         return thankyoucmd
 
+    def writePasswordFile(self):
+        '''
+        write the password to a temporary file for --password-file (removed
+        by removeTempFiles, or at the end of setupTransfer)
+        '''
+        tf, name = tempfile.mkstemp()
+        self.passwordfile = name
+        os.write(tf, self.config.get("rsync_native.password"))
+        os.close(tf)
+        return name
+
+    def getTargetUrl(self):
+        return ("rsync://" + self.config.get("rsync_native.username") + "@" +
+            self.config.get("outgoing.target_host") + "/" +
+            self.config.get("outgoing.target_dir") + "/")
+
+    def setupPullAllRcptsCmd(self, dest_dir):
+        '''
+        called by TransferBase.collectReceipts to set up the command that
+        pulls every receipt file in the target directory in one go
+        '''
+        self.writePasswordFile()
+        pattern = ".*." + self.config.get("outgoing.receipt_file_extension")
+        pullrcpts = self.cmd + ["-r", "--password-file=" + self.passwordfile,
+            "--include=" + pattern, "--exclude=*",
+            self.getTargetUrl(), dest_dir + "/"]
+        self.info("setupPullAllRcptsCmd %s" % pullrcpts)
+        return pullrcpts
+
+    def setupPushAllThanksCmd(self, thankyou_file_names):
+        '''
+        called by TransferBase.pushThankYous to set up the command that
+        pushes several thank-you files in one go
+        '''
+        self.writePasswordFile()
+        fd, self.thanks_list_path = tempfile.mkstemp()
+        os.write(fd, "\0".join(thankyou_file_names) + "\0")
+        os.close(fd)
+        thankyoucmd = self.cmd + ["--password-file=" + self.passwordfile,
+            "--from0", "--files-from=" + self.thanks_list_path,
+            self.config.get("data_stream.directory") + "/",
+            self.getTargetUrl()]
+        return thankyoucmd
+
+    def removeTempFiles(self):
+        '''
+        remove the password file and file list made for bulk receipts and
+        thank-you files
+        '''
+        for attr in ("passwordfile", "thanks_list_path"):
+            name = getattr(self, attr, None)
+            if name and os.path.exists(name):
+                os.remove(name)
+            setattr(self, attr, None)
+
     def checkVars(self):
         if not self.config.checkSet("rsync_native.cmd"):
             raise Exception("rsync_native.cmd is not set")
@@ -180,6 +250,10 @@ class RsyncNativeTransfer(TransferBase):
         if not self.config.checkSet("data_stream.directory"):
             raise Exception("data_stream.directory is not set")
 
+    def configChanged(self):
+        self.cmd = splitCommand(self.config.get("rsync_native.cmd"))
+        self.stripTargetDir()
+
     # this is the entry point for the module
     def setupTransfer(self, f):
         self.setFile(f)
@@ -197,7 +271,7 @@ class RsyncNativeTransfer(TransferBase):
         else:
             file_name = (TransferUtils.getPlainFileName(self.config.get(
                 "data_stream.directory"), f, self.config.get(
-                "outgoing.dir_size_limit")))
+                "outgoing.dir_size_limit"), **self.getArchiveOptions()))
         if not file_name:
             (TransferUtils.quarantine(f, self.config.get(
                 "data_stream.directory"), self.config.get(
@@ -212,17 +286,14 @@ class RsyncNativeTransfer(TransferBase):
         filesize = os.path.getsize(fn)
 
         try:
-            self.checkVars()
+            self.checkVarsIfChanged()
         except Exception, ex:
             rc = ResponseCode(False)
             r = (Response(rc, "not all variables in RsyncNativeTransfer ",
                 str(ex)))
             self.info("not all variables in RsyncNativeTransfer %s " % str(ex))
             return r
-        tf, name = tempfile.mkstemp()
-        self.passwordfile = name
-        os.write(tf, self.config.get("rsync_native.password"))
-        os.close(tf)
+        name = self.writePasswordFile()
         self.setStopReturnCode(23)
         self.setStopError("failed: No such file or directory")
 
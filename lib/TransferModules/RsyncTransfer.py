@@ -8,6 +8,9 @@
 from TransferBase import TransferBase
 from TransferUtils import *
 import os
+import tempfile
+import re
+import pipes
 
 import sys
 this_dir = os.path.dirname(__file__)
@@ -17,17 +20,24 @@ sys.path.append(lib_dir)
 
 from Response import Response, ResponseCode
 from ControlFile import ControlFile
-from ReceiptFile import ReceiptFile
+from ManifestControlFile import ManifestControlFile
+from ReceiptFile import ReceiptFile, SUCCESS
 from ThankyouFile import ThankyouFile
+from SshControlMaster import getControlMaster
+from ProcessRunner import Command, splitCommand
+from TransferMetrics import parseRsyncProgress
 
 
 class RsyncTransfer(TransferBase):
     """
     Rsync transfer type
     """
+    # (directories are streamed through ssh, see setupStreamCmds)
+    stream_input = "stdin"
+
     def __init__(self, config): 
         self.config = config
-        self.cmd = self.config.get("rsync_ssh.cmd")
+        self.cmd = splitCommand(self.config.get("rsync_ssh.cmd"))
     
         self.setConfig(config)
     
@@ -39,6 +49,46 @@ class RsyncTransfer(TransferBase):
         self.ctl_file_path = None
 
 
+    def getTargetPath(self, path = ""):
+        '''
+        the rsync name of path in the target directory
+        '''
+        return (self.config.get("rsync_ssh.username") + "@" +
+                self.config.get("outgoing.target_host") + "://" +
+                self.config.get("outgoing.target_dir") + "/" + path)
+
+    def getCompareOptions(self):
+        '''
+        the rsync options for how to tell whether a file has changed
+        '''
+        options = []
+        if self.config.get("rsync_ssh.use_checksum") == True:
+            options.append("--checksum")
+        if self.config.get("rsync_ssh.check_size") == True:
+            options.append("--size-only")
+        return options
+
+    def getProgressOptions(self):
+        '''
+        with outgoing.progress_interval, have rsync report the progress of
+        the whole transfer (needs rsync 3.1.0 or later)
+        '''
+        if self.getProgressInterval() > 0:
+            return ["--info=progress2"]
+        return []
+
+    def getBandwidthOptions(self):
+        '''
+        with global.bandwidth_limit, keep to this data_stream's share
+        '''
+        limit = self.getBandwidthLimit()
+        if limit:
+            return ["--bwlimit=%d" % limit]
+        return []
+
+    def parseProgress(self, line):
+        return parseRsyncProgress(line)
+
     # this is called from the TransferBase
     def setupPushCmd(self):
         '''
@@ -67,32 +117,27 @@ class RsyncTransfer(TransferBase):
                 "data_stream.directory"), os.path.basename(ctl_file_name)))
             self.ctl_file_path = ctl_file_path
             item_size = os.path.getsize(item_path)
-            item_cksum = TransferUtils.calcChecksum(item_path)
+            algorithm = self.config.get("outgoing.checksum_algorithm")
+            item_cksum = TransferUtils.calcChecksum(item_path, algorithm)
             ts = "%.2f" % time.time()
             rcpt_file_name = (".%s.%s.%s" % (item_name, ts, self.config.get(
                 "outgoing.receipt_file_extension")))
             ctl_file = ControlFile(ctl_file_path, can_overwrite=True)
-            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name)
+            ctl_file.create(item_name, item_size, item_cksum, rcpt_file_name,
+                            algorithm = algorithm)
             self.rcpt_file_name = rcpt_file_name
             self.rcpt_file_path = (TransferUtils.getPathInDir(rcpt_file_name,
                 self.config.get("data_stream.directory")))
 
-        rsc = self.cmd + " -avz "
-        if self.config.get("rsync_ssh.use_checksum") == True:
-            rsc += " --checksum "
-        if self.config.get("rsync_ssh.check_size") == True:
-            rsc += " --size-only "
+        rsc = (self.cmd + ["-avz"] + self.getCompareOptions() +
+               self.getProgressOptions() + self.getBandwidthOptions())
         if not self.config.get("outgoing.target_uses_arrival_monitor"):
-            pushcmd = (rsc + self.config.get("data_stream.directory") + "/" +
-            f + " " + self.config.get("rsync_ssh.username") + "@" +
-            self.config.get("outgoing.target_host") + "://" +
-            self.config.get("outgoing.target_dir") + "/" + f)
+            pushcmd = rsc + [self.config.get("data_stream.directory") + "/" +
+            f, self.getTargetPath(f)]
         else:
-            pushcmd = (rsc + self.config.get("data_stream.directory") + "/"
-            + f + " " + self.config.get("data_stream.directory") + "/" +
-            ctl_file_name + " " + self.config.get("rsync_ssh.username") + "@" +
-            self.config.get("outgoing.target_host") +
-            "://" + self.config.get("outgoing.target_dir") + "/")
+            pushcmd = rsc + [self.config.get("data_stream.directory") + "/"
+            + f, self.config.get("data_stream.directory") + "/" +
+            ctl_file_name, self.getTargetPath()]
         self.info("setupPushCmd %s " % pushcmd)
         return pushcmd
 
@@ -102,11 +147,8 @@ class RsyncTransfer(TransferBase):
         called by TransferBase in order to create the command to check for 
         stop files
         '''
-        listonly = self.cmd + " --list-only "
-        pullstop = (listonly + self.config.get("rsync_ssh.username") + "@" +
-            self.config.get("outgoing.target_host") + "://" 
-            + self.config.get("outgoing.target_dir") + "/" + "/" + 
-            self.config.get("outgoing.stop_file"))
+        pullstop = self.cmd + ["--list-only", self.getTargetPath(
+            "/" + self.config.get("outgoing.stop_file"))]
         self.info("setupStopFileCmd %s " % pullstop)
         return pullstop
 
@@ -115,11 +157,8 @@ class RsyncTransfer(TransferBase):
         called by TransferBase to setup the command that pulls receipt files 
         from the target
         '''
-        pullrcpt = (self.cmd + " " + self.config.get("rsync_ssh.username") + "@" +
-            self.config.get("outgoing.target_host")
-            + "://" + self.config.get("outgoing.target_dir") + "/" +
-            self.rcpt_file_name + " " + self.config.get(
-            "data_stream.directory") + "/")
+        pullrcpt = self.cmd + [self.getTargetPath(self.rcpt_file_name),
+            self.config.get("data_stream.directory") + "/"]
         self.info("setupPullRcptCmd %s" % pullrcpt)
         return pullrcpt
 
@@ -150,12 +189,44 @@ class RsyncTransfer(TransferBase):
         thankyou_file = ThankyouFile(thankyou_file_path)
         thankyou_file.create(self.rcpt_file_name)
         self.thankyou_file_path = thankyou_file_path
-        thankyoucmd = (self.cmd + " " + self.thankyou_file_path +
-            self.config.get("rsync_ssh.username") + "@" +
-            self.config.get("outgoing.target_host") + "://" +
-            self.config.get("outgoing.target_dir") + "/")
+        thankyoucmd = self.cmd + [self.thankyou_file_path,
+                                  self.getTargetPath()]
         return thankyoucmd
 
+    def setupPullAllRcptsCmd(self, dest_dir):
+        '''
+        called by TransferBase.collectReceipts to set up the command that
+        pulls every receipt file in the target directory in one go
+        '''
+        pattern = ".*." + self.config.get("outgoing.receipt_file_extension")
+        pullrcpts = self.cmd + ["-r", "--include=" + pattern,
+            "--exclude=*", self.getTargetPath(), dest_dir + "/"]
+        self.info("setupPullAllRcptsCmd %s" % pullrcpts)
+        return pullrcpts
+
+    def setupPushAllThanksCmd(self, thankyou_file_names):
+        '''
+        called by TransferBase.pushThankYous to set up the command that
+        pushes several thank-you files in one go
+        '''
+        self.thanks_list_path = self.writeFileList(thankyou_file_names)
+        thankyoucmd = self.cmd + ["--from0",
+            "--files-from=" + self.thanks_list_path,
+            self.config.get("data_stream.directory") + "/",
+            self.getTargetPath()]
+        return thankyoucmd
+
+    def removeTempFiles(self):
+        '''
+        remove the file list made by setupPushAllThanksCmd
+        '''
+        if getattr(self, "thanks_list_path", None):
+            try:
+                os.remove(self.thanks_list_path)
+            except OSError:
+                pass
+            self.thanks_list_path = None
+
     def checkVars(self):
         if not self.config.checkSet("rsync_ssh.cmd"):
             raise Exception("rsync_ssh.cmd is not set")
@@ -170,6 +241,75 @@ class RsyncTransfer(TransferBase):
         if not self.config.checkSet("data_stream.directory"):
             raise Exception("data_stream.directory is not set")
 
+    def setupControlMaster(self):
+        '''
+        if rsync_ssh.use_control_master is set, make sure that there is a
+        master ssh connection to the target and make all of our rsync
+        commands use it; otherwise (or if it cannot be started) each
+        command makes its own connection as usual
+        '''
+        self.cmd = splitCommand(self.config.get("rsync_ssh.cmd"))
+        self.ssh_cmd = splitCommand(self.config.get("rsync_ssh.ssh_cmd")
+                                    or "ssh")
+        if not self.config.get("rsync_ssh.use_control_master"):
+            return
+        master = getControlMaster(
+            self.config.get("rsync_ssh.username"),
+            self.config.get("outgoing.target_host"),
+            ssh_cmd = self.config.get("rsync_ssh.ssh_cmd") or "ssh",
+            control_dir = self.config.get("rsync_ssh.control_dir"),
+            control_persist = (self.config.get("rsync_ssh.control_persist")
+                               or 600))
+        resp = master.ensure()
+        if resp:
+            self.debug(resp.msg)
+            self.cmd += master.getSshOption()
+            self.ssh_cmd += master.getSshArgs()
+        else:
+            self.warn("%s - not using a shared ssh connection" % resp.msg)
+
+    def setupReceiptPull(self):
+        '''
+        as TransferBase.setupReceiptPull, also sharing the ssh connection
+        '''
+        TransferBase.setupReceiptPull(self)
+        self.setupControlMaster()
+
+    def canStreamDir(self, f):
+        '''
+        as TransferBase.canStreamDir, but not in mirror mode (the directory
+        is deleted once it has been sent)
+        '''
+        return (self.config.get("rsync_ssh.transfer_mode") != "mirror" and
+                TransferBase.canStreamDir(self, f))
+
+    def setupStreamCmds(self, archive_name, source = None):
+        '''
+        create the commands to stream an archive (from standard input) into
+        a temporary dotfile in the target directory, to rename it once it
+        is all there, and to remove it if not
+        '''
+        target_dir = self.config.get("outgoing.target_dir")
+        part_path = pipes.quote(os.path.join(target_dir,
+                                             ".%s.part" % archive_name))
+        target_path = pipes.quote(os.path.join(target_dir, archive_name))
+        ssh = self.ssh_cmd + [self.config.get("rsync_ssh.username") + "@" +
+                              self.config.get("outgoing.target_host")]
+        # (the remote command is still run by a shell on the target)
+        streamcmd = ssh + ["cat > %s" % part_path]
+        renamecmd = ssh + ["mv %s %s" % (part_path, target_path)]
+        cleanupcmd = ssh + ["rm -f %s" % part_path]
+        self.info("setupStreamCmds %s " % streamcmd)
+        return streamcmd, renamecmd, cleanupcmd
+
+    def setupPushControlCmd(self, ctl_file_name):
+        '''
+        create the command to push a control file on its own (after the
+        streamed archive it is for)
+        '''
+        return self.cmd + [os.path.join(self.config.get(
+            "data_stream.directory"), ctl_file_name), self.getTargetPath()]
+
     # this is the entry point for the module
     def setupTransfer(self, f):
         self.setFile(f)
@@ -179,8 +319,14 @@ class RsyncTransfer(TransferBase):
             grv = Response(rc, "Not attempting file transfer")
             return grv
 
+        streaming = self.canStreamDir(f)
         # if we are mirroring - then do not zip directories - (we pass False to getPlainFileName)
-        if self.config.get("rsync_ssh.transfer_mode") == "mirror":
+        if streaming:
+            file_name = None
+            filesize = self.getStreamDirSize(f)
+            if filesize != None:
+                file_name = f
+        elif self.config.get("rsync_ssh.transfer_mode") == "mirror":
             self.mirror = True
             file_name = (TransferUtils.getPlainFileName(self.config.get(
                 "data_stream.directory"), f, self.config.get(
@@ -188,7 +334,7 @@ class RsyncTransfer(TransferBase):
         else:
             file_name = (TransferUtils.getPlainFileName(self.config.get(
                 "data_stream.directory"), f, self.config.get(
-                "outgoing.dir_size_limit")))
+                "outgoing.dir_size_limit"), **self.getArchiveOptions()))
         if not file_name:
             (TransferUtils.quarantine(f, self.config.get(
                 "data_stream.directory"), self.config.get(
@@ -200,21 +346,29 @@ class RsyncTransfer(TransferBase):
         else:
             self.setFile(os.path.basename(file_name))
 
-        fn = os.path.join(self.config.get("data_stream.directory"), file_name)
-        filesize = os.path.getsize(fn)
+        if not streaming:
+            fn = os.path.join(self.config.get("data_stream.directory"),
+                              file_name)
+            filesize = os.path.getsize(fn)
 
         try:
-            self.checkVars()
+            self.checkVarsIfChanged()
         except Exception, ex:
             rc = ResponseCode(False)
             r = Response(rc, "not all variables in RsyncTransfer ", str(ex))
             self.info("not all variables in RsyncTransfer %s " % str(ex))
             return r
 
+        self.setupControlMaster()
         self.setStopReturnCode(23)
         self.setStopError("failed: No such file or directory")
 
         grv = self.waitForStopFile()
+        if str(grv.code) == "Success" and streaming:
+            self.info("Streaming directory %s; size: %s" % (f, filesize))
+            grv = self.streamDir()
+            self.info("RsyncTransfer exiting %s" % str(grv.code))
+            return grv
         if str(grv.code) == "Success":
             grv = self.pushData()
             self.info(" rv = %s " % str(grv.code))
@@ -234,3 +388,317 @@ class RsyncTransfer(TransferBase):
                     filesize)))
         return grv
 
+
+    def setupBatchPushCmd(self, list_path):
+        '''
+        create the command to push all of the files named in list_path
+        (NUL-separated, relative to the data_stream directory) in one go.
+        Each file is itemized on stdout as "flags|bytes|name", with
+        unchanged files included, so that we can see which files made it.
+        (Asking for the bytes sent makes rsync log each file once it has
+        been sent rather than when it starts.)
+        '''
+        pushcmd = (self.cmd + ["-az", "-ii", "--out-format=%i|%b|%n"] +
+            self.getCompareOptions() + self.getProgressOptions() +
+            self.getBandwidthOptions() + ["--from0", "--files-from=" + list_path,
+            self.config.get("data_stream.directory") + "/",
+            self.getTargetPath()])
+        self.info("setupBatchPushCmd %s " % pushcmd)
+        return pushcmd
+
+    def writeFileList(self, files):
+        '''
+        write the names of files to a temporary file for --files-from,
+        and return its path
+        '''
+        fd, list_path = tempfile.mkstemp(prefix = "mistamover_rsync_")
+        f = os.fdopen(fd, "w")
+        try:
+            f.write("\0".join(files) + "\0")
+        finally:
+            f.close()
+        return list_path
+
+    def collectItemized(self, name, line):
+        '''
+        line callback for the batch push command: note the names of the
+        files itemized on stdout once they have been sent (as only the end
+        of the output is kept, which for a large batch would not list them
+        all)
+        '''
+        if name == "stdout" and line.count("|") >= 2:
+            flags, nbytes, f = line.split("|", 2)
+            self.itemized.add(f)
+
+    # rsync exit statuses which mean that the run went to the end, but some
+    # files could not be sent (or had vanished); anything else (connection
+    # lost, disk full at the target, timeout...) may have cut a file short
+    # after rsync itemized it
+    partial_returncodes = (23, 24)
+
+    def getSentFiles(self, files):
+        '''
+        after a batch push which did not succeed as a whole, work out which
+        of the files certainly got there: if rsync ran to the end, those
+        itemized on stdout (see collectItemized) which are not named in an
+        error on stderr (see getFailedNames).  Otherwise none of them - the
+        next try skips those which did get there, and confirms them by
+        succeeding.
+        '''
+        if self.last_returncode not in self.partial_returncodes:
+            return []
+        failed = self.getFailedNames(self.last_stderr or "")
+        return [f for f in files
+                if f in self.itemized and os.path.basename(f) not in failed]
+
+    def getFailedNames(self, errors):
+        '''
+        the names of the files that rsync's error messages are about: the
+        last part of each quoted path, e.g. from
+            rsync: send_files failed to open "/data/ds/f": ...
+        or, for rsync's temporary file at the target (".f.XXXXXX"), the
+        name it stands for
+        '''
+        names = set()
+        for path in re.findall(r'"([^"]+)"', errors):
+            name = os.path.basename(path.rstrip("/"))
+            names.add(name)
+            match = re.match(r"^\.(.+)\.[^.]{6}$", name)
+            if match:
+                names.add(match.group(1))
+        return names
+
+    def createManifest(self, files):
+        '''
+        create a manifest control file listing files in the data_stream
+        directory, for the arrival monitor to check together, and set up
+        the names of its receipt (as setupPushCmd does for a single file).
+        Returns the push command for the manifest.
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        algorithm = self.config.get("outgoing.checksum_algorithm")
+        entries = []
+        for f in files:
+            path = os.path.join(data_dir, f)
+            entries.append((f, os.path.getsize(path),
+                            TransferUtils.calcChecksum(path, algorithm)))
+        ts = "%.2f" % time.time()
+        manifest_name = "%s.%s.manifest" % (files[0], ts)
+        ctl_file_name = (".%s.%s" % (manifest_name, self.config.get(
+            "outgoing.control_file_extension")))
+        self.ctl_file_path = os.path.join(data_dir, ctl_file_name)
+        self.rcpt_file_name = (".%s.%s" % (manifest_name, self.config.get(
+            "outgoing.receipt_file_extension")))
+        self.rcpt_file_path = TransferUtils.getPathInDir(self.rcpt_file_name,
+                                                         data_dir)
+        ctl_file = ManifestControlFile(self.ctl_file_path, can_overwrite=True)
+        ctl_file.create(self.rcpt_file_name, entries, algorithm = algorithm)
+        pushcmd = self.cmd + [self.ctl_file_path, self.getTargetPath()]
+        self.info("createManifest %s for %d files" % (ctl_file_name,
+                                                       len(files)))
+        return pushcmd
+
+    def confirmBatch(self, files, sizes, mirror):
+        '''
+        with an arrival monitor (and outgoing.use_manifests), once files
+        have been pushed: push a manifest for them, then either record that
+        its receipt is to be collected later (outgoing.async_receipts) or
+        pull the receipt and deal with each file according to it.  Returns
+        a dict of file -> Response.
+        '''
+        results = {}
+        rv = self.transferData(self.createManifest(files),
+                               self.getCommandTimeout("push"))
+        if str(rv.code) != "Success":
+            self.removeLocalFiles([self.ctl_file_path])
+            for f in files:
+                results[f] = rv
+            return results
+
+        if self.usesAsyncReceipts():
+            for f in files:
+                self.pending_receipts.add(f, self.rcpt_file_name,
+                                          self.ctl_file_path, sizes[f])
+                results[f] = Response(ResponseCode(True),
+                                      "receipt for %s will be collected "
+                                      "later" % f)
+            self.info("confirmBatch: receipt for %d files will be collected "
+                      "later" % len(files))
+            return results
+
+        rv = self.pullReceipt()
+        # (whether it was fetched and read, not rv, which also fails if the
+        # target did not support our checksum algorithm - that is in the
+        # status of each file)
+        rcpt = self.last_receipt
+        if rcpt == None:
+            self.removeLocalFiles([self.ctl_file_path, self.rcpt_file_path])
+            for f in files:
+                results[f] = rv
+            return results
+
+        for f in files:
+            status = rcpt.getStatus(f)
+            if status == SUCCESS:
+                if not mirror:
+                    self.deleteOrWarn(os.path.join(
+                        self.config.get("data_stream.directory"), f))
+                self.info("Successfully sent: %s; size: %s" % (f, sizes[f]))
+                results[f] = Response(ResponseCode(True), "sent %s" % f)
+            else:
+                if status == None:
+                    reason = "missing from receipt"
+                else:
+                    reason = rcpt.describeStatus(status)
+                results[f] = Response(ResponseCode(False),
+                                      "target rejected %s: %s" % (f, reason))
+        self.pushThankYous({self.rcpt_file_name: rcpt})
+        self.removeLocalFiles([self.ctl_file_path])
+        return results
+
+    def noteBatchFailure(self, f, rv):
+        '''
+        a file was still not sent after outgoing.retry_count tries in a
+        batch.  Count that against it (kept with the pending receipts, so
+        that it lasts from one batch to the next), and once it has happened
+        outgoing.retry_count times, quarantine the file rather than trying
+        it in every batch for ever.  Returns the response for the file.
+        '''
+        if self.pending_receipts == None:
+            return rv
+        failures = self.pending_receipts.addFailure(f)
+        if failures < self.config.get("outgoing.retry_count"):
+            return rv
+        self.pending_receipts.clearFailures(f)
+        self.error("%s not sent in %d batches - quarantining it" %
+                   (f, failures))
+        TransferUtils.quarantine(f, self.config.get("data_stream.directory"),
+                                 self.config.get("outgoing.quarantine_dir"))
+        return Response(ResponseCode(False), "%s; quarantined" % rv.msg)
+
+    def transferBatch(self, files):
+        '''
+        entry point for sending several plain files in a single rsync
+        invocation.  Returns a list of (file, Response) in the same order as
+        the input.
+
+        The stop file is checked once for the whole batch.  If rsync does
+        not succeed for all of the files, the ones which did get there are
+        dealt with and the rest are retried, up to outgoing.retry_count times.
+        A file which is still not sent then counts as a failed attempt (see
+        noteBatchFailure).
+
+        With an arrival monitor (only if outgoing.use_manifests is set), the
+        files which got there are then listed in a single manifest control
+        file, and answered by a single receipt (see confirmBatch).
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        results = {}
+
+        to_send = []
+        for f in files:
+            if self.checkFileExists(os.path.join(data_dir, f)):
+                to_send.append(f)
+            else:
+                results[f] = Response(ResponseCode(False),
+                                      "Not attempting file transfer")
+
+        try:
+            self.checkVarsIfChanged()
+        except Exception, ex:
+            rc = ResponseCode(False)
+            r = Response(rc, "not all variables in RsyncTransfer ", str(ex))
+            self.info("not all variables in RsyncTransfer %s " % str(ex))
+            return [(f, r) for f in files]
+
+        self.setupControlMaster()
+        self.setStopReturnCode(23)
+        self.setStopError("failed: No such file or directory")
+
+        if to_send:
+            grv = self.waitForStopFile()
+            if str(grv.code) != "Success":
+                to_send = []
+                for f in files:
+                    results.setdefault(f, grv)
+
+        mirror = (self.config.get("rsync_ssh.transfer_mode") == "mirror")
+        use_monitor = self.config.get("outgoing.target_uses_arrival_monitor")
+        pushed = []
+        sizes = {}
+        for f in to_send:
+            try:
+                sizes[f] = os.path.getsize(os.path.join(data_dir, f))
+            except OSError, err:
+                # (gone since the scan)
+                results[f] = Response(ResponseCode(False),
+                                      "Not attempting file transfer: %s" % err)
+        to_send = [f for f in to_send if f in sizes]
+
+        if not self.config.checkSet("outgoing.retry_count"):
+            self.config.set("outgoing.retry_count", 3)
+
+        tries = 0
+        grv = Response(ResponseCode(False), "batch transfer not attempted")
+        while to_send and tries < self.config.get("outgoing.retry_count"):
+            srv = self.checkUSR1()
+            if srv != None:
+                grv = srv
+                break
+
+            list_path = self.writeFileList(to_send)
+            self.itemized = set()
+            self.startProgress("batch of %d files from %s" %
+                               (len(to_send), to_send[0]),
+                               sum([sizes[f] for f in to_send]), tries + 1)
+            try:
+                rv = self.transferData(self.setupBatchPushCmd(list_path),
+                                       self.getCommandTimeout("push"),
+                                       line_callback = self.collectItemized)
+            finally:
+                os.remove(list_path)
+            self.checkTargetFull(rv)
+
+            if str(rv.code) == "Success":
+                sent = to_send
+            else:
+                sent = self.getSentFiles(to_send)
+                grv = rv
+            sent_set = set(sent)
+            self.endProgress(rv, sum([sizes[f] for f in sent]))
+
+            for f in sent:
+                if use_monitor:
+                    # not done with until the receipt says so
+                    pushed.append(f)
+                    continue
+                if self.pending_receipts != None:
+                    self.pending_receipts.clearFailures(f)
+                if not mirror:
+                    self.deleteOrWarn(os.path.join(data_dir, f))
+                self.info("Successfully sent: %s; size: %s" % (f, sizes[f]))
+                results[f] = Response(ResponseCode(True), "sent %s" % f)
+
+            to_send = [f for f in to_send
+                       if f not in results and f not in sent_set]
+            if to_send:
+                tries += 1
+                if tries < self.config.get("outgoing.retry_count"):
+                    self.info("transferBatch %d of %d files not sent, "
+                              "trying again" % (len(to_send), len(sizes)))
+                    self.backOff(tries)
+
+        exhausted = (tries >= self.config.get("outgoing.retry_count"))
+        for f in to_send:
+            if exhausted:
+                results[f] = self.noteBatchFailure(f, grv)
+            else:
+                results[f] = grv
+        if self.pending_receipts != None:
+            self.pending_receipts.save()
+        if pushed:
+            results.update(self.confirmBatch(pushed, sizes, mirror))
+        self.info("RsyncTransfer batch of %d files exiting, %d sent" %
+                  (len(files), len([r for r in results.values()
+                                    if str(r.code) == "Success"])))
+        return [(f, results[f]) for f in files]
@@ -0,0 +1,231 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Long-lived multiplexed ssh connections (ssh ControlMaster) for rsync_ssh.
+
+See doc string for class SshControlMaster for details
+"""
+
+import os
+import time
+import hashlib
+import pipes
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+import sys
+this_dir = os.path.dirname(__file__)
+top_dir = os.path.abspath(os.path.dirname(this_dir + "../"))
+lib_dir = os.path.join(top_dir, "lib")
+sys.path.append(lib_dir)
+
+import Response
+from ProcessRunner import splitCommand
+
+
+class SshControlMaster(object):
+    """
+    A master ssh connection to username@host, which other ssh commands
+    (in particular rsync -e "ssh ...") can share via a control socket,
+    so that they do not each have to set up their own connection.
+
+    The master is started in the background with ControlPersist, so that
+    it exits by itself once it has been idle for control_persist seconds.
+    ensure() checks that it is running (ssh -O check) and starts it again
+    if not.  Commands using the options from getSshOption() fall back
+    to making their own connection if the master is not available.
+
+    Use getControlMaster() rather than creating these directly, so that
+    there is only one per (username, host) in the process.
+    """
+
+    def __init__(self, username, host, ssh_cmd = "ssh",
+                 control_dir = None, control_persist = 600,
+                 connect_timeout = 30):
+        self.username = username
+        self.host = host
+        # (as configured, so it may include options)
+        self.ssh_argv = splitCommand(ssh_cmd).argv
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+
+        if not control_dir:
+            control_dir = os.path.join(tempfile.gettempdir(),
+                                       "mistamover-ssh-%d" % os.getuid())
+        self.control_dir = control_dir
+        # hash the name so that it fits within the limit on socket path length
+        name = hashlib.md5("%s@%s" % (username, host)).hexdigest()[:16]
+        self.control_path = os.path.join(control_dir, "cm-%s" % name)
+
+
+    def getTarget(self):
+        return "%s@%s" % (self.username, self.host)
+
+
+    def _ensureControlDir(self):
+        """
+        The control directory must only be accessible by us, as anyone who
+        can get at the socket can use the connection.
+        """
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, 0700)
+        st = os.stat(self.control_dir)
+        if st.st_uid != os.getuid():
+            raise Exception("%s is not owned by us" % self.control_dir)
+        if st.st_mode & 077:
+            os.chmod(self.control_dir, 0700)
+
+
+    def _run(self, args):
+        """
+        Run ssh with the given arguments, returning (returncode, stderr).
+        The returncode is None if ssh could not be run at all.
+        """
+        devnull = open(os.devnull)
+        try:
+            try:
+                p = Popen(self.ssh_argv + args, stdin = devnull,
+                          stdout = PIPE, stderr = PIPE, close_fds = True)
+            except OSError, err:
+                return None, "cannot run %s: %s" % (self.ssh_argv, err)
+            stdout, stderr = p.communicate()
+        finally:
+            devnull.close()
+        return p.returncode, stderr
+
+
+    def check(self):
+        """
+        Returns True if the master connection is up
+        """
+        if not os.path.exists(self.control_path):
+            return False
+        rc, stderr = self._run(["-o", "ControlPath=%s" % self.control_path,
+                                "-O", "check", self.getTarget()])
+        return rc == 0
+
+
+    def start(self):
+        """
+        Start the master connection in the background.  Returns a Response.
+
+        The backgrounded ssh keeps whatever it was given as stdout/stderr, so
+        these go to a temporary file rather than a pipe which we would then
+        wait on for as long as the master runs.
+        """
+        try:
+            self._ensureControlDir()
+            if os.path.exists(self.control_path):
+                # stale socket left by a master that has gone away
+                os.remove(self.control_path)
+        except Exception, err:
+            return Response.failure("cannot set up ssh control path %s: %s"
+                                    % (self.control_path, err))
+
+        errfile = tempfile.TemporaryFile()
+        devnull = open(os.devnull)
+        try:
+            try:
+                p = Popen(self.ssh_argv +
+                          ["-M", "-N", "-f",
+                           "-o", "BatchMode=yes",
+                           "-o", "ConnectTimeout=%d" % self.connect_timeout,
+                           "-o", "ServerAliveInterval=30",
+                           "-o", "ControlPath=%s" % self.control_path,
+                           "-o", "ControlPersist=%d" % self.control_persist,
+                           self.getTarget()],
+                          stdin = devnull, stdout = errfile,
+                          stderr = errfile, close_fds = True)
+            except OSError, err:
+                return Response.failure("cannot run %s: %s" %
+                                        (" ".join(self.ssh_argv), err))
+            rc = p.wait()
+            errfile.seek(0)
+            stderr = errfile.read().strip()
+        finally:
+            devnull.close()
+            errfile.close()
+
+        if rc != 0:
+            return Response.failure("could not start ssh master for %s "
+                                    "(exit status %s): %s"
+                                    % (self.getTarget(), rc, stderr))
+
+        # ssh -f returns once authenticated, but give the socket a moment
+        for i in range(10):
+            if os.path.exists(self.control_path):
+                break
+            time.sleep(0.1)
+        return Response.success("started ssh master for %s" % self.getTarget())
+
+
+    def ensure(self):
+        """
+        Make sure that the master connection is up, starting it if needed.
+        Returns a Response.
+        """
+        self.lock.acquire()
+        try:
+            if self.check():
+                return Response.success("ssh master for %s is running"
+                                        % self.getTarget())
+            return self.start()
+        finally:
+            self.lock.release()
+
+
+    def stop(self):
+        """
+        Ask the master connection to exit
+        """
+        self.lock.acquire()
+        try:
+            if os.path.exists(self.control_path):
+                self._run(["-o", "ControlPath=%s" % self.control_path,
+                           "-O", "exit", self.getTarget()])
+        finally:
+            self.lock.release()
+
+
+    def getSshArgs(self):
+        """
+        The ssh arguments to use the master connection.  With
+        ControlMaster=no, ssh will make its own connection if the master
+        has gone away.
+        """
+        return ["-o", "ControlMaster=no",
+                "-o", "ControlPath=%s" % self.control_path]
+
+
+    def getSshOption(self):
+        """
+        The rsync arguments to make it use the master connection.
+        """
+        return ["-e", " ".join([pipes.quote(arg) for arg in
+                                self.ssh_argv + self.getSshArgs()])]
+
+
+_masters = {}
+_masters_lock = threading.Lock()
+
+def getControlMaster(username, host, **kwargs):
+    """
+    Return the SshControlMaster for (username, host), creating it if this
+    is the first time it is asked for.  Subsequent calls with different
+    keyword arguments get the same object.
+    """
+    _masters_lock.acquire()
+    try:
+        key = (username, host)
+        if key not in _masters:
+            _masters[key] = SshControlMaster(username, host, **kwargs)
+        return _masters[key]
+    finally:
+        _masters_lock.release()
@@ -0,0 +1,99 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import time
+import threading
+
+
+class StopFileCache(object):
+    """
+    Remembers, for one data_stream, when the target was last seen to have no
+    stop file, so that TransferBase.waitForStopFile need not ask the target
+    again before every item.
+
+    The result is trusted for ttl seconds (a ttl of 0 means never, i.e. the
+    target is asked every time, which was the behaviour before this cache).
+    It is forgotten straight away if a push fails in a way which suggests
+    that the target has filled up, as that is when a stop file is most
+    likely to appear.
+
+    One of these is shared by all of the transfer modules for a data_stream
+    (including those in different worker threads).
+    """
+
+    # things that the transfer commands say when the target is full
+    # (the last two are the RFC 959 texts for FTP replies 552 and 452)
+    target_full_messages = ["No space left on device",
+                            "Disk quota exceeded",
+                            "Exceeded storage allocation",
+                            "Insufficient storage space"]
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.clear_time = None
+        self.lock = threading.Lock()
+
+
+    def setTTL(self, ttl):
+        """
+        Change the ttl (e.g. on rereading the config)
+        """
+        self.lock.acquire()
+        try:
+            self.ttl = ttl
+        finally:
+            self.lock.release()
+
+
+    def isClear(self):
+        """
+        True if the target was seen to have no stop file within the last
+        ttl seconds
+        """
+        self.lock.acquire()
+        try:
+            return (self.ttl > 0 and self.clear_time != None
+                    and time.time() - self.clear_time < self.ttl)
+        finally:
+            self.lock.release()
+
+
+    def setClear(self):
+        """
+        Record that the target has just been seen to have no stop file
+        """
+        self.lock.acquire()
+        try:
+            self.clear_time = time.time()
+        finally:
+            self.lock.release()
+
+
+    def invalidate(self):
+        """
+        Forget the last result, so that the next transfer asks the target
+        """
+        self.lock.acquire()
+        try:
+            self.clear_time = None
+        finally:
+            self.lock.release()
+
+
+    def checkResponse(self, resp):
+        """
+        Look at the Response from a push, and invalidate the cache if it
+        suggests the target is full.  Returns True if it did.  (This looks
+        at successful responses too, as an ftp command will exit with
+        success even if the server refused the file.)
+        """
+        text = "%s %s" % (resp.msg, resp.data)
+        for message in self.target_full_messages:
+            if message in text:
+                self.invalidate()
+                return True
+        return False
@@ -8,7 +8,13 @@
 import os
 from subprocess import Popen, PIPE
 import time
+import errno
+import fcntl
+import random
+import signal
 import shutil
+import tempfile
+import threading
 
 import sys
 this_dir = os.path.dirname(__file__)
@@ -20,7 +26,16 @@ from Response import Response, ResponseCode
 from LoggerClient import LoggerClient
 from StatusFlag import status
 from Daemon import weWereSignalled
-from ReceiptFile import ReceiptFile
+from ReceiptFile import ReceiptFile, UNSUPPORTED_ALGORITHM
+from ManifestReceiptFile import ManifestReceiptFile
+from ControlFile import ControlFile, Invalid
+from ThankyouFile import ThankyouFile
+from ChecksumCache import checksum_cache
+from FileUtils import futils
+from ProcessRunner import Command, makeCommand, runProcess
+from BandwidthScheduler import getScheduler, getPriority, ThrottledWriter
+from CommandLimiter import getLimiter, CommandSlot
+import Checksum
 
 class TransferBase:
     """
@@ -66,6 +81,28 @@ class TransferBase:
     __stopError = None
     __file = None
     __mirror = None
+    mirror = False
+    last_stdout = None
+    last_stderr = None
+    last_returncode = None
+    last_timed_out = False
+    last_receipt = None
+    parallel_width = None
+    stop_file_cache = None
+    pending_receipts = None
+    metrics = None
+    progress_item = None
+    vars_checked_for = None
+    bandwidth_scheduler = None
+    scheduler_made_for = ()
+    command_limiter = None
+    limiter_made_for = ()
+    receipt_staging_dir = ".mistamover_receipts"
+    # how the command made by setupStreamCmds reads a directory streamed by
+    # streamDir: "stdin", or "fifo" (a named pipe, for a command which
+    # reads something else on its standard input); None if the module
+    # cannot stream directories
+    stream_input = None
 
     def setStopReturnCode(self, c):
         self.__stopReturnCode = c
@@ -91,6 +128,70 @@ class TransferBase:
     def getConfig(self):
         return self.config
 
+    def reset(self):
+        '''
+        forget the state left over from the previous item, so that the same
+        instance can be used to transfer the next one
+        '''
+        self.setFile(None)
+        self.mirror = False
+        self.thankyou_file_path = None
+        self.rcpt_file_path = None
+        self.ctl_file_path = None
+        self.last_stdout = None
+        self.last_stderr = None
+        self.last_returncode = None
+        self.last_receipt = None
+
+    def checkVarsIfChanged(self):
+        '''
+        call checkVars, but only the first time and after the config has been
+        reread, rather than for every item.  Raises an exception as
+        checkVars does.
+        '''
+        read_time = getattr(self.config, "time_last_read", None)
+        if read_time != None and read_time == self.vars_checked_for:
+            return
+        self.checkVars()
+        algorithm = self.config.get("outgoing.checksum_algorithm")
+        if (self.config.get("outgoing.target_uses_arrival_monitor")
+            and not Checksum.isSupported(algorithm)):
+            raise Exception("outgoing.checksum_algorithm %s is not one of %s"
+                            % (algorithm, ", ".join(Checksum.getAlgorithms())))
+        self.configChanged()
+        self.vars_checked_for = read_time
+
+    def getBandwidthScheduler(self):
+        '''
+        the BandwidthScheduler for the config, or None if there is no
+        global.bandwidth_limit - made the first time, and again only once
+        the config has been reread, rather than for every command
+        '''
+        read_time = getattr(self.config, "time_last_read", None)
+        if read_time != self.scheduler_made_for:
+            self.bandwidth_scheduler = getScheduler(self.config)
+            self.scheduler_made_for = read_time
+        return self.bandwidth_scheduler
+
+    def getCommandLimiter(self):
+        '''
+        the CommandLimiter for the config, or None if there are no limits
+        - made the first time, and again only once the config has been
+        reread, rather than for every command
+        '''
+        read_time = getattr(self.config, "time_last_read", None)
+        if read_time != self.limiter_made_for:
+            self.command_limiter = getLimiter(self.config)
+            self.limiter_made_for = read_time
+        return self.command_limiter
+
+    def configChanged(self):
+        '''
+        called (after checkVars) when the config has been reread, for
+        modules to pick up any values that they keep themselves
+        '''
+        pass
+
     def __del__(self):
         self.info("transferbase exit")
 
@@ -104,43 +205,633 @@ class TransferBase:
             return False
         return True
 
-    def transferData(self, cmd):
+    def getCommandTimeout(self, operation = None):
+        '''
+        seconds after which a transfer command is killed (None for never):
+        from outgoing.<operation>_timeout if that is set (operation being
+        stop_file, push, receipt or thankyou), otherwise from
+        outgoing.command_timeout
+        '''
+        timeout = None
+        if operation != None:
+            timeout = self.config.get("outgoing.%s_timeout" % operation)
+        return timeout or self.config.get("outgoing.command_timeout") or None
+
+    def stopRequested(self):
+        '''
+        whether we have been asked to stop (by SIGUSR1)
+        '''
+        return weWereSignalled("USR1")
+
+    def sleepUnlessStopped(self, seconds):
+        '''
+        sleep for up to seconds, but return early (True) if asked to stop
+        '''
+        end = time.time() + seconds
+        while True:
+            if self.stopRequested():
+                return True
+            left = end - time.time()
+            if left <= 0:
+                return False
+            time.sleep(min(left, 1))
+
+    def getRetryDelay(self, tries):
+        '''
+        seconds to wait after the tries'th failed attempt at something:
+        global.general_poll_interval, doubling with each further attempt, up
+        to outgoing.retry_backoff_max
+        '''
+        delay = (self.config.get("global.general_poll_interval") or 0) * \
+            2 ** max(tries - 1, 0)
+        limit = self.config.get("outgoing.retry_backoff_max")
+        if limit:
+            delay = min(delay, limit)
+        return delay
+
+    def backOff(self, tries):
+        '''
+        wait (see getRetryDelay) before trying again after the tries'th
+        failed attempt.  Returns True if asked to stop meanwhile.
+        '''
+        delay = self.getRetryDelay(tries)
+        self.info("waiting %s seconds before trying again" % delay)
+        return self.sleepUnlessStopped(delay)
+
+    def getPollDelay(self, waited, base, limit, expected = None):
+        '''
+        seconds to wait before looking on the target again for something
+        (a receipt, or a stop file going away) which has been waited for
+        for waited seconds so far.
+
+        If it is expected after some time (e.g. the usual time for a
+        receipt to come back) and that hasn't passed yet, the wait is until
+        then.  Otherwise it is as long again as the time overdue, so that
+        the looks get further apart the longer something takes, but at
+        least base and at most limit seconds.  Each wait is spread by
+        outgoing.poll_jitter (a fraction of it either way), so that workers
+        and data_streams don't all look at the same moment.
+        '''
+        if expected and waited < expected:
+            delay = expected - waited
+        else:
+            delay = waited - (expected or 0)
+            if limit:
+                delay = min(delay, limit)
+            delay = max(delay, base)
+        jitter = self.config.get("outgoing.poll_jitter") or 0
+        if jitter > 0:
+            delay *= random.uniform(1 - jitter, 1 + jitter)
+        return delay
+
+    def getReceiptPollDelay(self, waited):
+        '''
+        seconds to wait before looking for a receipt again (see getPollDelay),
+        using the moving average of the time receipts have taken
+        '''
+        expected = None
+        if self.metrics:
+            expected = self.metrics.getReceiptLatency()
+        return self.getPollDelay(
+            waited, self.config.get("outgoing.receipt_file_poll_interval"),
+            self.config.get("outgoing.receipt_file_poll_max"), expected)
+
+    def getReceiptTimeout(self):
+        '''
+        seconds after which a receipt is given up on
+        '''
+        return (self.config.get("outgoing.receipt_file_poll_interval") *
+                self.config.get("outgoing.receipt_file_poll_count"))
+
+    def countPoll(self):
+        if self.metrics:
+            self.metrics.countPoll()
+
+    def acquireCommandSlot(self):
+        '''
+        wait until we may run a remote command, if the number run at once
+        on this host is limited (global.max_remote_commands and
+        global.max_commands_per_host - see CommandLimiter).  Returns the
+        CommandSlot to release when the command has finished, or None if
+        we were asked to stop while waiting.
+        '''
+        limiter = self.getCommandLimiter()
+        if limiter == None:
+            return CommandSlot([])
+        host = self.config.get("outgoing.target_host")
+        def waiting(ahead, queued):
+            self.info("waiting to run a command on %s: %d ahead of us, %d "
+                      "waiting in all" % (host, ahead, queued))
+        return limiter.acquire(host, getPriority(self.config),
+                               self.stopRequested, waiting)
+
+    def transferData(self, cmd, timeout = None, line_callback = None):
         """
-        transferData via subprocess.popen
-        all data is piped back through stdout and stderr
-        This method does not know about the concept of push or pull, it 
-        only executes the command string given to it
+        run a transfer command (without a shell - see ProcessRunner) and
+        capture its output.  This method does not know about the concept
+        of push or pull, it only runs the command given to it.
+
+        cmd is a ProcessRunner.Command (or an argument list), or a list of
+        Commands to run one after another, stopping at the first which
+        fails.  (A plain string is still accepted, and is only run with
+        /bin/sh if it needs to be.)
+
+        The command is killed if it runs for longer than timeout seconds
+        (default outgoing.command_timeout), or if we are asked to stop
+        (SIGUSR1) while it runs.  line_callback(name, line) is called with
+        each line of output as it arrives (see runProcess).  If remote
+        commands are limited, it first waits its turn (see
+        acquireCommandSlot); a list of Commands runs in a single turn.
+
+        The output of the (last) command is also kept in self.last_stdout
+        and self.last_stderr for callers which need to parse it - only the
+        last ProcessRunner.default_max_output bytes of each - and its exit
+        status in self.last_returncode (None if it did not run to the end)
+
+        While a transfer is being measured (see startProgress), its progress
+        is also picked out of the output as it arrives
         """
-        grc = None
-        grv = None 
         self.info("transferData")
         if cmd == None:
-            grc = ResponseCode(False)
-            grv = Response(grc, "cmd was None")
-            return grv
+            return Response(ResponseCode(False), "cmd was None")
+        if timeout == None:
+            timeout = self.getCommandTimeout()
+        if self.progress_item != None:
+            line_callback = self.makeProgressCallback(line_callback)
+        if isinstance(cmd, list) and cmd and isinstance(cmd[0], Command):
+            cmds = cmd
+        else:
+            cmds = [cmd]
+        self.last_timed_out = False
+        self.last_returncode = None
+        slot = self.acquireCommandSlot()
+        if slot == None:
+            self.info("stop requested by signal - not running %s" % cmds[0])
+            self.status = status.STOPPED
+            return Response(ResponseCode(False),
+                            "transferData stopped by SIGUSR1")
         try:
-            p = Popen(cmd, shell=True, bufsize=1024, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = p.communicate()
-            # communicate waits for process to terminate
-            out = repr(stdout)
-            err = repr(stderr)
-            rv = str(p.returncode)
-            if (rv == "0"):
-                # transfer went ok
-                grc = ResponseCode(True)
-                grv = Response(grc, cmd, out)
+            for cmd in cmds:
+                cmd = makeCommand(cmd)
+                try:
+                    result = runProcess(cmd, timeout = timeout,
+                                        line_callback = line_callback,
+                                        check_abort = self.stopRequested)
+                except Exception, ex:
+                    self.info("transferData for %s raised exception %s " %
+                              (cmd, str(ex)))
+                    return (Response(ResponseCode(False),
+                        "An exception occurred during  transferData ", str(ex)))
+                self.last_stdout = result.stdout
+                self.last_stderr = result.stderr
+                self.last_timed_out = result.timed_out
+                if not (result.aborted or result.timed_out):
+                    self.last_returncode = result.returncode
+                if result.aborted:
+                    self.info("stop requested by signal - killed %s" % cmd)
+                    self.status = status.STOPPED
+                    return Response(ResponseCode(False),
+                                    "transferData stopped by SIGUSR1")
+                if result.timed_out:
+                    self.info("transferData for %s timed out after %d "
+                              "seconds" % (cmd, timeout))
+                    return Response(ResponseCode(False),
+                                    "timed out after %d seconds" % timeout,
+                                    repr(result.stderr))
+                if result.returncode != 0:
+                    # transfer failed in some way
+                    self.info("transferData for %s Failed " % cmd)
+                    return Response(ResponseCode(False),
+                                    str(result.returncode),
+                                    repr(result.stderr))
                 self.info("transferData for %s OK " % cmd)
-            else:
-                # transfer failed in some way
-                grc = ResponseCode(False)
-                grv = Response(grc, rv, err)
-                self.info("transferData for %s Failed " % cmd)
+            return Response(ResponseCode(True), str(cmd), repr(result.stdout))
+        finally:
+            slot.release()
+
+    def transferStream(self, cmd, producer, timeout = None,
+                       fifo_path = None):
+        """
+        as transferData, but the standard input of the command is written
+        by producer(fileobj) while it runs - e.g. an archive made on the
+        fly, so that it never has to be written to disk.  If producer
+        raises an exception, the command is killed and this fails.  As with
+        transferData, it is also killed after timeout seconds (default
+        outgoing.command_timeout) or if we are asked to stop.  With
+        global.bandwidth_limit, the stream is written no faster than this
+        data_stream's share.
+
+        If fifo_path is given, the stream is written to a named pipe made
+        there for the command to read instead (for a command which reads
+        something else on its standard input - it gets the command's input,
+        if any, as usual).  The pipe is removed afterwards.
+        """
+        self.info("transferStream")
+        if cmd == None:
+            return Response(ResponseCode(False), "cmd was None")
+        cmd = makeCommand(cmd)
+        if timeout == None:
+            timeout = self.getCommandTimeout()
+        self.last_timed_out = False
+        self.last_returncode = None
+        slot = self.acquireCommandSlot()
+        if slot == None:
+            self.info("stop requested by signal - not running %s" % cmd)
+            self.status = status.STOPPED
+            return Response(ResponseCode(False),
+                            "transferStream stopped by SIGUSR1")
+        # (output to files, so that the command can't block on a full pipe
+        # while we are writing to it)
+        out = tempfile.TemporaryFile()
+        err = tempfile.TemporaryFile()
+        sink = None
+        try:
+            try:
+                if fifo_path != None:
+                    os.mkfifo(fifo_path, 0600)
+                p = Popen(cmd.argv, stdin=PIPE, stdout=out, stderr=err,
+                          close_fds=True, preexec_fn=os.setpgrp)
+                # the producer may be stuck writing to it, so watch for a
+                # timeout or stop request from another thread
+                finished = threading.Event()
+                killed = []
+                def watch():
+                    start = time.time()
+                    while not finished.wait(1):
+                        if timeout and time.time() - start > timeout:
+                            killed.append("timed out after %d seconds" %
+                                          timeout)
+                        elif self.stopRequested():
+                            killed.append("transferStream stopped by SIGUSR1")
+                        else:
+                            continue
+                        try:
+                            os.killpg(p.pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+                        return
+                watcher = threading.Thread(target=watch)
+                watcher.setDaemon(True)
+                watcher.start()
+                produce_error = None
+                try:
+                    try:
+                        if fifo_path != None:
+                            if cmd.input != None:
+                                p.stdin.write(cmd.input)
+                            p.stdin.close()
+                            sink = self.openFifo(fifo_path, p)
+                        else:
+                            sink = p.stdin
+                        stdin = sink
+                        if self.getBandwidthScheduler() != None:
+                            stdin = ThrottledWriter(stdin,
+                                                    self.getBandwidthLimit)
+                        producer(stdin)
+                        sink.close()
+                    except Exception, ex:
+                        produce_error = str(ex)
+                        if p.poll() == None:
+                            p.kill()
+                    p.wait()
+                finally:
+                    finished.set()
+                    watcher.join()
+                out.seek(0)
+                err.seek(0)
+                self.last_stdout = out.read()
+                self.last_stderr = err.read()
+            finally:
+                out.close()
+                err.close()
+                slot.release()
+                if sink != None and not sink.closed:
+                    try:
+                        sink.close()
+                    except IOError:
+                        pass
+                if fifo_path != None and os.path.exists(fifo_path):
+                    os.remove(fifo_path)
         except Exception, ex:
-            grc = ResponseCode(False)
-            grv = (Response(grc, "An exception occurred during  transferData ",
-                str(ex)))
-            self.info("transferData for %s raised exception %s " % (cmd, str(ex)))
-        return grv
+            self.info("transferStream for %s raised exception %s " %
+                      (cmd, str(ex)))
+            return (Response(ResponseCode(False),
+                "An exception occurred during  transferStream ", str(ex)))
+        if killed:
+            self.info("transferStream for %s Failed: %s " % (cmd, killed[0]))
+            if self.stopRequested():
+                self.status = status.STOPPED
+            else:
+                self.last_timed_out = True
+            return Response(ResponseCode(False), killed[0],
+                            repr(self.last_stderr))
+        self.last_returncode = p.returncode
+        if produce_error != None:
+            self.info("transferStream for %s Failed: %s " %
+                      (cmd, produce_error))
+            return Response(ResponseCode(False), "stream not written",
+                            produce_error)
+        if p.returncode != 0:
+            self.info("transferStream for %s Failed " % cmd)
+            return Response(ResponseCode(False), str(p.returncode),
+                            repr(self.last_stderr))
+        self.info("transferStream for %s OK " % cmd)
+        return Response(ResponseCode(True), str(cmd), repr(self.last_stdout))
+
+    def openFifo(self, fifo_path, p):
+        '''
+        open the named pipe for writing once process p has opened it for
+        reading (which would block for ever if p exited first)
+        '''
+        while True:
+            try:
+                fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError, err:
+                if err.errno != errno.ENXIO:
+                    raise
+            if p.poll() != None:
+                raise Exception("command exited without reading the stream")
+            time.sleep(0.05)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return os.fdopen(fd, "wb")
+
+    def getProgressInterval(self):
+        '''
+        seconds between reports of the progress of a transfer, from
+        outgoing.progress_interval (0 for none)
+        '''
+        return self.config.get("outgoing.progress_interval") or 0
+
+    def getProgressOptions(self):
+        '''
+        options to add to a push command to make it report its progress
+        (in a form that parseProgress understands), if that is wanted
+        '''
+        return []
+
+    def getBandwidthLimit(self):
+        '''
+        the bandwidth (KB/s) this transfer may use now: the data_stream's
+        share of global.bandwidth_limit (see BandwidthScheduler), divided
+        between the transfers it may be running at once (see
+        parallel_width), or None if there is no limit
+        '''
+        scheduler = self.getBandwidthScheduler()
+        if scheduler == None:
+            return None
+        allocation = scheduler.getAllocation(
+            self.config.get("data_stream.name"), getPriority(self.config))
+        if self.parallel_width != None:
+            allocation = max(allocation / max(self.parallel_width(), 1), 1)
+        return allocation
+
+    def getBandwidthOptions(self):
+        '''
+        options to add to a push command to keep it within
+        getBandwidthLimit(), where the transfer program has any
+        '''
+        return []
+
+    def parseProgress(self, line):
+        '''
+        (bytes so far, seconds to go or None) from a line of output of a push
+        command, or None if the line doesn't say
+        '''
+        return None
+
+    def makeProgressCallback(self, line_callback = None):
+        '''
+        a line callback for transferData which passes the progress of the
+        current transfer to the metrics (and the lines on to line_callback)
+        '''
+        item = self.progress_item
+        def callback(name, line):
+            progress = self.parseProgress(line)
+            if progress != None:
+                nbytes, eta = progress
+                if self.metrics.update(item, nbytes, eta):
+                    self.info("progress of %s" % self.metrics.describe(item))
+            if line_callback != None:
+                line_callback(name, line)
+        return callback
+
+    def startProgress(self, item, total = None, attempt = 1):
+        '''
+        start measuring a push of item (total bytes, if known) - the
+        attempt'th try - until endProgress
+        '''
+        if self.metrics == None:
+            return
+        self.progress_item = item
+        self.metrics.start(item, total, attempt)
+
+    def endProgress(self, rv, nbytes = None):
+        '''
+        finish measuring a push, which got the Response rv and moved nbytes
+        (default the whole item if it succeeded, otherwise as far as the
+        progress got)
+        '''
+        item = self.progress_item
+        self.progress_item = None
+        if self.metrics == None or item == None:
+            return
+        success = (str(rv.code) == "Success")
+        entry = self.metrics.finish(item, success, nbytes)
+        if entry != None:
+            self.info("%s transfer of %s" % (success and "finished" or
+                      "failed", self.metrics.describe(item, entry)))
+
+    def getArchiveOptions(self):
+        '''
+        the keyword arguments for TransferUtils.getPlainFileName saying how
+        to pack directories, from the outgoing.dir_archive_format,
+        dir_compression, dir_compression_level, dir_store_extensions and
+        dir_compression_workers settings.  The checksum is only wanted (to
+        be calculated as the archive is written) with an arrival monitor.
+        '''
+        archive_format = self.config.get("outgoing.dir_archive_format")
+        if archive_format not in futils.archive_formats:
+            self.warn("unknown outgoing.dir_archive_format %s, using zip" %
+                      archive_format)
+            archive_format = "zip"
+        compression = self.config.get("outgoing.dir_compression")
+        if compression not in futils.archive_compressions:
+            self.warn("unknown outgoing.dir_compression %s, using deflate" %
+                      compression)
+            compression = "deflate"
+        level = self.config.get("outgoing.dir_compression_level")
+        if level not in range(1, 10):
+            self.warn("outgoing.dir_compression_level must be 1 to 9, "
+                      "using %d" % futils.default_compression_level)
+            level = futils.default_compression_level
+        store_extensions = []
+        for ext in (self.config.get("outgoing.dir_store_extensions")
+                    or "").split(","):
+            ext = ext.strip()
+            if ext:
+                if not ext.startswith("."):
+                    ext = "." + ext
+                store_extensions.append(ext)
+        algorithm = None
+        if self.config.get("outgoing.target_uses_arrival_monitor"):
+            algorithm = self.config.get("outgoing.checksum_algorithm")
+        return {"archive_format": archive_format,
+                "compression": compression,
+                "level": level,
+                "store_extensions": store_extensions,
+                "workers": self.config.get("outgoing.dir_compression_workers")
+                           or 1,
+                "algorithm": algorithm}
+
+    def canStreamDir(self, f):
+        '''
+        whether to send item f as a tar archive made as it is sent
+        (outgoing.stream_dirs), so that no archive is written to disk: only
+        for directories, and with a module which can (see stream_input)
+        '''
+        path = os.path.join(self.config.get("data_stream.directory"), f)
+        return (self.stream_input != None and
+                self.config.get("outgoing.stream_dirs") == True and
+                os.path.isdir(path) and not os.path.islink(path))
+
+    def getStreamDirSize(self, f):
+        '''
+        the total size of the files in directory f, to be streamed, or None
+        if it cannot be read or is bigger than outgoing.dir_size_limit
+        (see TransferUtils.checkDirSize)
+        '''
+        limit = self.config.get("outgoing.dir_size_limit")
+        if limit:
+            limit = limit * 1048576
+        else:
+            limit = None
+        stats = futils.getDirStats(
+            os.path.join(self.config.get("data_stream.directory"), f), limit)
+        if stats == None or (limit != None and stats[1] > limit):
+            return None
+        return stats[1]
+
+    def streamDir(self):
+        '''
+        send the current item (a directory) as a tar archive made as it is
+        sent, with the commands from setupStreamCmds, tried up to
+        outgoing.retry_count times, and delete the directory once the
+        archive has arrived.
+
+        With an arrival monitor, the archive's checksum is worked out as it
+        is sent, and its control file is sent after it (see confirmStream).
+        The receipt is waited for here even with outgoing.async_receipts,
+        as the directory is not deleted until it comes.
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        dir_path = os.path.join(data_dir, self.getFile())
+        options = self.getArchiveOptions()
+        compression = options["compression"]
+        archive_name = futils.getArchiveName(self.getFile(), "tar",
+                                             compression)
+        use_monitor = self.config.get("outgoing.target_uses_arrival_monitor")
+        fifo_dir = None
+        fifo_path = None
+        if self.stream_input == "fifo":
+            fifo_dir = tempfile.mkdtemp(prefix = "mistamover_stream_")
+            fifo_path = os.path.join(fifo_dir, "archive")
+        streamcmd, renamecmd, cleanupcmd = self.setupStreamCmds(archive_name,
+                                                                fifo_path)
+        writers = []
+
+        def produce(fileobj):
+            algorithm = None
+            if use_monitor:
+                # (as it may have changed since the last try)
+                algorithm = self.config.get("outgoing.checksum_algorithm")
+            writer = Checksum.HashingWriter(fileobj, algorithm)
+            writers.append(writer)
+            futils._tarDir(dir_path, writer, compression, options["level"])
+
+        if not self.config.checkSet("outgoing.retry_count"):
+            self.config.set("outgoing.retry_count", 3)
+        tries = 0
+        grv = None
+        try:
+            while tries < self.config.get("outgoing.retry_count"):
+                grs = self.checkUSR1()
+                if grs != None: return grs
+
+                self.startProgress(archive_name, None, tries + 1)
+                rv = self.transferStream(streamcmd, produce,
+                                         self.getCommandTimeout("push"),
+                                         fifo_path)
+                self.checkTargetFull(rv)
+                if str(rv.code) == "Success" and renamecmd != None:
+                    rv = self.transferData(renamecmd,
+                                           self.getCommandTimeout("push"))
+                self.endProgress(rv, writers and writers[-1].size or 0)
+                if str(rv.code) == "Success" and use_monitor:
+                    rv = self.confirmStream(archive_name, writers[-1])
+                if str(rv.code) == "Success":
+                    futils.deleteDir(dir_path)
+                    self.info("Successfully sent: %s as %s; size: %s" %
+                              (self.getFile(), archive_name,
+                               writers[-1].size))
+                    return rv
+                if cleanupcmd != None:
+                    self.transferData(cleanupcmd)
+                tries += 1
+                if grv == None: grv = rv
+                else: grv += rv
+                if tries < self.config.get("outgoing.retry_count"):
+                    self.backOff(tries)
+                    self.info("streamDir trying transfer again")
+            return grv
+        finally:
+            if fifo_dir != None:
+                shutil.rmtree(fifo_dir, True)
+            if use_monitor:
+                self.removeLocalFiles([self.ctl_file_path,
+                                       self.rcpt_file_path,
+                                       self.thankyou_file_path])
+
+    def confirmStream(self, archive_name, writer):
+        '''
+        with an arrival monitor, once a streamed archive is there: send its
+        control file, with the size and checksum that writer (a
+        Checksum.HashingWriter) found as it was sent, then wait for the
+        receipt and send the thank-you file, as pushData does for a file
+        '''
+        ctl_file_name = self.createControlFile(archive_name, writer.size,
+                                               writer.hexdigest(),
+                                               writer.algorithm)
+        rv = self.transferData(self.setupPushControlCmd(ctl_file_name),
+                               self.getCommandTimeout("push"))
+        if str(rv.code) != "Success":
+            return rv
+        self.info("confirmStream %s sent - pulling receipt" % ctl_file_name)
+        rv = self.pullReceipt()
+        if str(rv.code) == "Success":
+            self.pushThankYou()
+            self.info("confirmStream thankyou file sent ok")
+        return rv
+
+    def createControlFile(self, item_name, size, cksum, algorithm):
+        '''
+        make the control file for an item in the data_stream directory
+        whose size and checksum are known, and set up the names of its
+        receipt.  Returns the name of the control file.
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        ctl_file_name = ".%s.%s" % (item_name, self.config.get(
+            "outgoing.control_file_extension"))
+        self.ctl_file_path = os.path.join(data_dir, ctl_file_name)
+        ts = "%.2f" % time.time()
+        self.rcpt_file_name = ".%s.%s.%s" % (item_name, ts, self.config.get(
+            "outgoing.receipt_file_extension"))
+        self.rcpt_file_path = os.path.join(data_dir, self.rcpt_file_name)
+        ctl_file = ControlFile(self.ctl_file_path, can_overwrite=True)
+        ctl_file.create(item_name, size, cksum, self.rcpt_file_name,
+                        algorithm = algorithm)
+        return ctl_file_name
 
     def checkUSR1(self):
         grv = None
@@ -183,6 +874,7 @@ class TransferBase:
                 shutil.rmtree(filename)    
             else:
                 os.remove(filename)
+                checksum_cache.forget(filename)
             self.info("Removed: %s" % filename)
         except Exception, ex:
             self.warn("Could not delete %s" % filename)
@@ -195,24 +887,50 @@ class TransferBase:
         to do so
         """
         self.info("waitForStopFile")
-        pullstop = self.setupStopFileCmd()
-        stopFilePresent = True
         grc = ResponseCode(True)
         grv = Response(grc, None)
+        if self.stop_file_cache and self.stop_file_cache.isClear():
+            self.info("waitForStopFile: no stop file present within the last "
+                      "%s seconds" % self.stop_file_cache.ttl)
+            return grv
+
+        pullstop = self.setupStopFileCmd()
+        stopFilePresent = True
+        timeouts = 0
+        started = time.time()
         # wait until the underlying protocol tells us that no file exists
         # - the message we look for is defined by self.getStopError()
         while stopFilePresent:
             srv = self.checkUSR1()
             if srv != None: return srv
 
-            rv = self.transferData(pullstop)
+            rv = self.transferData(pullstop,
+                                   self.getCommandTimeout("stop_file"))
+            self.countPoll()
+            if self.last_timed_out:
+                # the target isn't answering - give up after retry_count
+                # tries in a row, rather than waiting for ever
+                timeouts += 1
+                if timeouts >= (self.config.get("outgoing.retry_count")
+                                or 3):
+                    return rv
+                self.backOff(timeouts)
+                continue
+            timeouts = 0
             if rv.data.find(self.getStopError()) != -1:
                 stopFilePresent = False
                 (self.info("pull stop %s : Success, .stop file not present" %
                     (pullstop)))
+                if self.stop_file_cache:
+                    self.stop_file_cache.setClear()
             else:
-                time.sleep(self.config.get("outgoing.stop_file_poll_interval"))
-                self.info("waitForStopFile sleeping")   
+                # look again soon, then less and less often
+                delay = self.getPollDelay(
+                    time.time() - started,
+                    self.config.get("global.general_poll_interval"),
+                    self.config.get("outgoing.stop_file_poll_interval"))
+                self.info("waitForStopFile sleeping for %d seconds" % delay)
+                self.sleepUnlessStopped(delay)
         return grv
 
     def pushData(self):
@@ -239,19 +957,32 @@ class TransferBase:
 
             pushcmd = self.setupPushCmd()
             self.info("pushData %s " % pushcmd)
-            rv = self.transferData(pushcmd)
+            self.startProgress(self.getFile(), self.getItemSize(), tries + 1)
+            rv = self.transferData(pushcmd, self.getCommandTimeout("push"))
+            self.endProgress(rv)
+            self.checkTargetFull(rv)
             if str(rv.code) != "Success":
                 tries += 1
                 if grv == None: grv = rv
                 else: grv += rv
-                time.sleep(self.config.get("global.general_poll_interval"))
-                self.info("pushData trying transfer again")
+                if tries < self.config.get("outgoing.retry_count"):
+                    self.backOff(tries)
+                    self.info("pushData trying transfer again")
             else:
                 # the push succeeded - if we use arrivalMonitor we also need to
                 # do that before we return
                 if self.config.get("outgoing.target_uses_arrival_monitor"):
+                    if self.usesAsyncReceipts():
+                        # don't wait for the receipt - it is collected
+                        # later (see TransferBaseController.reapReceipts),
+                        # and the data file stays where it is until then
+                        self.addPendingReceipt()
+                        self.info("pushData succeeded - receipt for %s "
+                                  "will be collected later" % self.getFile())
+                        return rv
+                    # (pullReceipt spaces out its looks for it, and stops if
+                    # we are asked to)
                     self.info("pushData succeeded - pulling receipt")
-                    time.sleep(self.config.get("global.general_poll_interval"))
                     rrv = self.pullReceipt()
                     if grv == None: grv = rrv
                     else: grv += rrv
@@ -277,48 +1008,297 @@ class TransferBase:
                     "data_stream.directory") + "/" + self.getFile()))
         return grv
 
+    def getItemSize(self):
+        '''
+        the size of the current item, if it is a file (None otherwise)
+        '''
+        path = os.path.join(self.config.get("data_stream.directory"),
+                            self.getFile())
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return None
+
+    def usesAsyncReceipts(self):
+        '''
+        whether receipts are collected separately from pushes (only if the
+        controller has given us somewhere to record the pending ones)
+        '''
+        return (self.pending_receipts != None and
+                self.config.get("outgoing.async_receipts") == True)
+
+    def addPendingReceipt(self):
+        '''
+        record that the current file has been pushed and its receipt is to
+        be collected
+        '''
+        try:
+            size = os.path.getsize(os.path.join(
+                self.config.get("data_stream.directory"), self.getFile()))
+        except OSError:
+            size = None
+        self.pending_receipts.add(self.getFile(), self.rcpt_file_name,
+                                  self.ctl_file_path, size)
+
+    def setupReceiptPull(self):
+        '''
+        called before collectReceipt is used for items pushed earlier (maybe
+        by another instance, or before a restart).  Raises an exception as
+        checkVars does.  Modules which need more than this override it.
+        '''
+        self.checkVarsIfChanged()
+
+    def collectReceipt(self, item, rcpt_file_name):
+        '''
+        make a single attempt to pull the receipt file for an item pushed
+        earlier (with outgoing.async_receipts).  Returns a ReceiptFile, or
+        None if it is not there yet.  Raises an exception if the receipt
+        is not valid.
+        '''
+        self.reset()
+        self.setFile(item)
+        self.rcpt_file_name = rcpt_file_name
+        self.rcpt_file_path = os.path.join(
+            self.config.get("data_stream.directory"), rcpt_file_name)
+        rv = self.transferData(self.setupPullRcptCmd(),
+                               self.getCommandTimeout("receipt"))
+        self.removeTempFiles()
+        stop_error = self.getStopError()
+        if (str(rv.code) != "Success" or
+            (stop_error and rv.data.find(stop_error) != -1) or
+            not os.path.exists(self.rcpt_file_path)):
+            return None
+        return self.readReceipt(self.rcpt_file_path)
+
+    def readReceipt(self, rcpt_file_path):
+        '''
+        read a receipt file, which may be a ReceiptFile or (for a batch
+        sent with outgoing.use_manifests) a ManifestReceiptFile.  Raises
+        an exception if it is neither.
+        '''
+        try:
+            rcpt = ReceiptFile(rcpt_file_path)
+            rcpt.read()
+        except Invalid:
+            rcpt = ManifestReceiptFile(rcpt_file_path)
+            rcpt.read()
+        return rcpt
+
+    def collectReceipts(self, rcpt_file_names):
+        '''
+        pull the receipt files for several items pushed earlier (with
+        outgoing.async_receipts).  Where the module has a command to fetch
+        all of the receipts in the target directory in one go
+        (setupPullAllRcptsCmd), they are fetched into a staging directory
+        and matched against the names wanted; the rest are thrown away.
+        Otherwise each receipt is pulled with collectReceipt.
+
+        Returns a dict of receipt file name -> ReceiptFile for those which
+        were there, or the exception if a receipt could not be read.  The
+        receipts are left in the data_stream directory.
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        staging_dir = os.path.join(data_dir, self.receipt_staging_dir)
+        if not os.path.isdir(staging_dir):
+            os.mkdir(staging_dir)
+        for name in os.listdir(staging_dir):
+            os.remove(os.path.join(staging_dir, name))
+
+        found = {}
+        pullrcpts = self.setupPullAllRcptsCmd(staging_dir)
+        if pullrcpts == None:
+            # (items in one manifest share a receipt)
+            for rcpt_file_name in set(rcpt_file_names):
+                item = rcpt_file_name  # only used for logging
+                try:
+                    rcpt = self.collectReceipt(item, rcpt_file_name)
+                except Exception, err:
+                    rcpt = err
+                if rcpt != None:
+                    found[rcpt_file_name] = rcpt
+            return found
+
+        self.info("collectReceipts %s" % pullrcpts)
+        rv = self.transferData(pullrcpts, self.getCommandTimeout("receipt"))
+        self.removeTempFiles()
+        if str(rv.code) != "Success":
+            # (may still have fetched some of them)
+            self.debug("collectReceipts: %s %s" % (rv.msg, rv.data))
+        wanted = set(rcpt_file_names)
+        for name in os.listdir(staging_dir):
+            path = os.path.join(staging_dir, name)
+            if name not in wanted:
+                # not ours, or already dealt with
+                os.remove(path)
+                continue
+            rcpt_file_path = os.path.join(data_dir, name)
+            os.rename(path, rcpt_file_path)
+            try:
+                found[name] = self.readReceipt(rcpt_file_path)
+            except Exception, err:
+                found[name] = err
+        self.info("collectReceipts: %d of %d receipts in" %
+                  (len(found), len(wanted)))
+        return found
+
+    def pushThankYous(self, rcpts):
+        '''
+        create and push the thank-you files for several receipts (a dict of
+        receipt file name -> ReceiptFile, as from collectReceipts), in one
+        go if the module has a command for that (setupPushAllThanksCmd),
+        otherwise one at a time.  The local receipt and thank-you files are
+        removed afterwards.
+        '''
+        data_dir = self.config.get("data_stream.directory")
+        thankyou_file_names = {}
+        for rcpt_file_name, rcpt in rcpts.items():
+            thankyou_file_names[rcpt_file_name] = \
+                os.path.basename(rcpt.getThankyouFileName())
+        paths = [os.path.join(data_dir, name) for name in
+                 thankyou_file_names.keys() + thankyou_file_names.values()]
+
+        grv = None
+        pushthks = self.setupPushAllThanksCmd(thankyou_file_names.values())
+        if pushthks == None:
+            for rcpt_file_name in rcpts.keys():
+                self.rcpt_file_name = rcpt_file_name
+                self.rcpt_file_path = os.path.join(data_dir, rcpt_file_name)
+                self.thankyou_file_path = None
+                rv = self.pushThankYou()
+                self.removeTempFiles()
+                if grv == None: grv = rv
+                else: grv += rv
+        else:
+            for rcpt_file_name, thankyou_file_name in \
+                    thankyou_file_names.items():
+                thankyou_file = ThankyouFile(
+                    os.path.join(data_dir, thankyou_file_name),
+                    can_overwrite = True)
+                thankyou_file.create(rcpt_file_name)
+            self.info("pushThankYous %s" % pushthks)
+            grv = self.transferData(pushthks,
+                                    self.getCommandTimeout("thankyou"))
+            self.removeTempFiles()
+        self.removeLocalFiles(paths)
+        return grv
+
+    def removeLocalFiles(self, paths):
+        '''
+        remove local copies of files exchanged with the arrival monitor,
+        where they exist
+        '''
+        for path in paths:
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def removeTempFiles(self):
+        '''
+        remove any temporary files made by the last setup..Cmd method
+        (for modules which make them)
+        '''
+        pass
+
+    def checkTargetFull(self, rv):
+        '''
+        if the response from a push suggests that the target is full, make
+        sure that we check for a stop file before the next push
+        '''
+        if self.stop_file_cache and self.stop_file_cache.checkResponse(rv):
+            self.info("target may be full - will check for stop file "
+                      "before next transfer")
+
     def pullReceipt(self):
         """
-        pull a receipt file using transferData
+        pull a receipt file using transferData.  Returns the response to the
+        pull which fetched it (looks which missed only mean that it was not
+        there yet), or the failures if it never came.  The receipt, once
+        read, is kept in self.last_receipt (None if there isn't one).
         """
         self.info("pullReceipt")
+        self.last_receipt = None
         grv = self.checkUSR1()
         if grv != None: return grv
 
         pullrcpt = self.setupPullRcptCmd()
         self.info("pullReceipt %s " % pullrcpt)
-        tries = 0
         grv = None
-        while tries < self.config.get("outgoing.receipt_file_poll_count"):
+        # look straight away, then when it usually turns up, then less and
+        # less often (see getReceiptPollDelay), until the time that
+        # receipt_file_poll_count looks receipt_file_poll_interval apart
+        # would have taken (however many looks that is, as the waits
+        # between them vary)
+        started = time.time()
+        missed = started
+        timeout = self.getReceiptTimeout()
+        while True:
             srv = self.checkUSR1()
             if srv != None: return srv
 
-            rv = self.transferData(pullrcpt)
+            rv = self.transferData(pullrcpt, self.getCommandTimeout("receipt"))
+            self.countPoll()
             if str(rv.code) != "Success" or rv.data.find(self.getStopError()) != -1:
-                tries += 1
+                missed = time.time()
                 rv.code = ResponseCode(False)
                 if grv == None: grv = rv
                 else: grv += rv
-                time.sleep(self.config.get("outgoing.receipt_file_poll_interval"))
+                waited = missed - started
+                if waited >= timeout:
+                    break
+                delay = min(self.getReceiptPollDelay(waited),
+                            timeout - waited)
+                self.sleepUnlessStopped(delay)
                 self.info("pullReceipt trying receipt transfer again")
             else:
-                # the pull receipt succeeded
+                # the pull receipt succeeded - it came back some time
+                # between the last look and this one
+                if self.metrics:
+                    self.metrics.recordReceiptLatency(
+                        (missed + time.time()) / 2 - started)
                 # check it is valid
-                rcpt_err = None
                 try:
-                    rcpt = ReceiptFile(self.rcpt_file_path)
-                    rcpt.read()
-                    if grv == None: grv = rv
-                    else: grv += rv
-                    return grv
+                    rcpt = self.readReceipt(self.rcpt_file_path)
                 except Exception, err:
                     rcpt_err = "bad receipt file: %s" % err
                     self.info("pull receipt raised exception : %s " % rcpt_err)
-                    if grv == None: grv = rv
-                    else: grv += rv
-                    return grv
+                    return Response(ResponseCode(False), rcpt_err)
+                self.last_receipt = rcpt
+                if rcpt.getStatus() == UNSUPPORTED_ALGORITHM:
+                    # the target lacks the module for our algorithm -
+                    # send it again with the default
+                    self.useDefaultAlgorithm(
+                        "target does not support checksum algorithm %s"
+                        % rcpt.getAlgorithm())
+                    rv.code = ResponseCode(False)
+                return rv
+        self.noteMissingReceipt()
         return grv
 
+    def useDefaultAlgorithm(self, reason):
+        '''
+        use the default checksum algorithm (md5) in control files from now
+        on, until the config is reread.  Returns False if we already were.
+        '''
+        algorithm = self.config.get("outgoing.checksum_algorithm")
+        if algorithm in (None, Checksum.default_algorithm):
+            return False
+        self.warn("%s, using %s" % (reason, Checksum.default_algorithm))
+        self.config.set("outgoing.checksum_algorithm",
+                        Checksum.default_algorithm)
+        return True
+
+    def noteMissingReceipt(self):
+        '''
+        a receipt never came.  A target older than outgoing.checksum_algorithm
+        cannot read a control file which names an algorithm, so it never
+        answers (it has no way to say UNSUPPORTED_ALGORITHM) - in case that
+        is why, the item is sent again with the default algorithm, which
+        every version reads.
+        '''
+        self.useDefaultAlgorithm("no receipt - the target may predate "
+                                 "checksum algorithms")
+
     def pushThankYou(self):
         """
         push a thankyou file using transferData
@@ -329,7 +1309,7 @@ class TransferBase:
 
         pushthks = self.setupPushThanksCmd()
         self.info("pushThankYou %s " % pushthks)
-        rv = self.transferData(pushthks)
+        rv = self.transferData(pushthks, self.getCommandTimeout("thankyou"))
         return rv
 
     # the following methods are implemented by the derived class
@@ -347,3 +1327,22 @@ class TransferBase:
 
     def setupPushThanksCmd(self):
         raise NotImplementedError("Should have implemented this")
+
+    # and these optionally, to fetch receipts and send thank-you files in
+    # bulk (see collectReceipts and pushThankYous)
+    def setupPullAllRcptsCmd(self, dest_dir):
+        return None
+
+    def setupPushAllThanksCmd(self, thankyou_file_names):
+        return None
+
+    # and these by modules which can stream directories (see stream_input
+    # and streamDir): the commands to send an archive read from source (the
+    # named pipe, for "fifo"), to give it its name once it is all there
+    # and to remove what there is of it if not (either may be None), and
+    # the command to push a control file
+    def setupStreamCmds(self, archive_name, source):
+        raise NotImplementedError("Should have implemented this")
+
+    def setupPushControlCmd(self, ctl_file_name):
+        raise NotImplementedError("Should have implemented this")
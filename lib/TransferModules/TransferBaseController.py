@@ -5,33 +5,323 @@
 # See the LICENSE file in the source distribution of this software for
 # the full license text.
 
+import os
+import time
+
+import Response
+import ReceiptFile
+import Checksum
+from ManifestReceiptFile import ManifestReceiptFile
 from RsyncTransfer import RsyncTransfer
 from RsyncNativeTransfer import RsyncNativeTransfer
 from FtpTransfer import FtpTransfer
 from GridFTPTransferMyProxy import GridFTPTransferMyProxy
 from GridFTPTransferCertificate import GridFTPTransferCertificate
+from StopFileCache import StopFileCache
+from PendingReceipts import PendingReceipts
+from TransferMetrics import TransferMetrics
+from TransferUtils import TransferUtils
+
 class TransferBaseController:
     '''
     The main controller for transfermodules - this module discovers which transfer
     module to use (as defined by the config file) and creates an instance of it
+
+    The module instance is kept and reused (after a reset) for the following
+    items, so that its logger and any checks of config and credentials are
+    set up once per data_stream rather than once per item.
+
+    A StopFileCache, PendingReceipts and TransferMetrics can be passed in to
+    share them with other controllers for the same data_stream (e.g. in
+    other worker threads), otherwise each controller has its own.
     '''
-    def __init__(self, config):
+    pending_receipts_file = ".mistamover_pending_receipts"
+    transfer_status_file = ".mistamover_transfer_status"
+
+    def __init__(self, config, stop_file_cache = None,
+                 pending_receipts = None, metrics = None,
+                 parallel_width = None):
         self.config = config
+        # (see TransferBase.parallel_width)
+        self.parallel_width = parallel_width
         self.tp = self.config.get("outgoing.transfer_protocol")
-  
-    def transfer(self, f):
+        if stop_file_cache == None:
+            stop_file_cache = StopFileCache(0)
+        self.stop_file_cache = stop_file_cache
+        if pending_receipts == None:
+            pending_receipts = PendingReceipts(os.path.join(
+                self.config.get("data_stream.directory"),
+                self.pending_receipts_file))
+        self.pending_receipts = pending_receipts
+        if metrics == None:
+            metrics = TransferMetrics(os.path.join(
+                self.config.get("data_stream.directory"),
+                self.transfer_status_file),
+                self.config.get("data_stream.name"))
+        self.metrics = metrics
+        self.modules = {}
+
+    def makeModule(self):
+        """
+        Create the transfer module for the protocol, or None if unknown
+        """
         if self.tp == "rsync_ssh":
             r = RsyncTransfer(self.config)
-            r.setupTransfer(f)
-        if self.tp == "rsync_native":
+        elif self.tp == "rsync_native":
             r = RsyncNativeTransfer(self.config)
-            r.setupTransfer(f)
-        if self.tp == "ftp":
+        elif self.tp == "ftp":
             r = FtpTransfer(self.config)
-            r.setupTransfer(f)
-        if self.tp == "gridftp_myproxy":
+        elif self.tp == "gridftp_myproxy":
             r = GridFTPTransferMyProxy(self.config)
-            r.setupTransfer(f)
-        if self.tp == "gridftp_certificate":
+        elif self.tp == "gridftp_certificate":
             r = GridFTPTransferCertificate(self.config)
-            r.setupTransfer(f) 
+        else:
+            return None
+        r.stop_file_cache = self.stop_file_cache
+        r.pending_receipts = self.pending_receipts
+        r.metrics = self.metrics
+        r.parallel_width = self.parallel_width
+        return r
+
+    def getModule(self):
+        """
+        Return the transfer module for the protocol, ready for a new item:
+        the one used for the previous item if there was one, otherwise a
+        new one.  Returns None if the protocol is unknown.
+        """
+        self.tp = self.config.get("outgoing.transfer_protocol")
+        r = self.modules.get(self.tp)
+        if r == None:
+            r = self.makeModule()
+            if r == None:
+                return None
+            self.modules[self.tp] = r
+        else:
+            r.reset()
+        # the ttl may have changed if the config was reread
+        self.stop_file_cache.setTTL(
+            self.config.get("outgoing.stop_file_cache_ttl") or 0)
+        self.metrics.setInterval(self.config.get("outgoing.progress_interval"))
+        return r
+  
+    def transfer(self, f):
+        start = time.time()
+        r = self.getModule()
+        if r != None:
+            r.debug("module setup for %s took %.4f seconds" %
+                    (f, time.time() - start))
+            return r.setupTransfer(f)
+
+    def getBatchLimits(self):
+        """
+        Return (max files, max bytes) for sending several files in one go,
+        where max bytes of 0 means no limit, or None if batching is not used.
+        Only rsync_ssh supports batches, and with an arrival monitor only if
+        outgoing.use_manifests is set (otherwise it needs a control file and
+        receipt per file).
+        """
+        if self.tp != "rsync_ssh":
+            return None
+        if (self.config.get("outgoing.target_uses_arrival_monitor") and
+            not self.config.get("outgoing.use_manifests")):
+            return None
+        max_files = self.config.get("rsync_ssh.batch_max_files") or 1
+        if max_files <= 1:
+            return None
+        max_bytes = self.config.get("rsync_ssh.batch_max_bytes") or 0
+        return (max_files, max_bytes * 1048576)
+
+    def makeBatches(self, items, data_dir = None):
+        """
+        Split a list of items into a list of batches (lists) to pass to
+        transferBatch, keeping the order.  Only plain files are batched
+        together; anything else (directories, links, dotfiles) is sent in
+        a batch of its own.  Without batching, every batch has one item.
+        """
+        limits = self.getBatchLimits()
+        if limits == None:
+            return [[item] for item in items]
+        max_files, max_bytes = limits
+        if data_dir == None:
+            data_dir = self.config.get("data_stream.directory")
+
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            path = os.path.join(data_dir, item)
+            size = None
+            if not item.startswith(".") and not os.path.islink(path):
+                try:
+                    if os.path.isfile(path):
+                        size = os.path.getsize(path)
+                except OSError:
+                    pass
+
+            if size == None:
+                if batch:
+                    batches.append(batch)
+                batches.append([item])
+                batch = []
+                batch_bytes = 0
+                continue
+
+            if batch and (len(batch) >= max_files or
+                          (max_bytes and batch_bytes + size > max_bytes)):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += size
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def transferBatch(self, items):
+        """
+        Transfer a batch made by makeBatches.  Returns a list of
+        (item, response).
+        """
+        if len(items) == 1:
+            return [(items[0], self.transfer(items[0]))]
+        start = time.time()
+        r = self.getModule()
+        r.debug("module setup for batch of %d files took %.4f seconds" %
+                (len(items), time.time() - start))
+        return r.transferBatch(items)
+
+    def reapReceipts(self):
+        """
+        Look for the receipts of items pushed earlier with
+        outgoing.async_receipts, where it is time to look again (straight
+        away, then when receipts usually come back, then less and less
+        often - see TransferBase.getReceiptPollDelay), and finish off those
+        that have come back.  The receipts are fetched together, and the
+        thank-you files sent together, where the transfer module can (see
+        TransferBase.collectReceipts).
+
+        On success the data file is deleted; otherwise the item is left to
+        be sent again, or quarantined after outgoing.retry_count failures.
+        Returns a list of (item, response) for the items finished with.
+        """
+        pending = self.pending_receipts
+        if not len(pending):
+            return []
+        poll_interval = self.config.get("outgoing.receipt_file_poll_interval")
+        due = pending.getDue(poll_interval)
+        if not due:
+            return []
+        r = self.getModule()
+        if r == None:
+            return []
+        try:
+            r.setupReceiptPull()
+            found = r.collectReceipts([pending.get(item)["rcpt_file_name"]
+                                       for item in due])
+        except Exception, ex:
+            r.info("not collecting receipts: %s" % ex)
+            return []
+        r.countPoll()
+
+        # as long as pullReceipt would have kept trying for
+        timeout = r.getReceiptTimeout()
+        data_dir = self.config.get("data_stream.directory")
+        results = []
+        thanks = {}
+        for item in due:
+            entry = pending.get(item)
+            rcpt = found.get(entry["rcpt_file_name"])
+
+            if rcpt == None:
+                if pending.getAge(item) > timeout:
+                    r.removeLocalFiles([entry["ctl_file_path"]])
+                    r.noteMissingReceipt()
+                    results.append((item, self.receiptFailed(
+                        r, item, "no receipt for %s after %d seconds" %
+                        (item, timeout))))
+                else:
+                    pending.markPolled(item, r.getReceiptPollDelay(
+                        pending.getAge(item)))
+                continue
+
+            # it came back some time between the last look and this one
+            self.metrics.recordReceiptLatency(
+                (entry["polled"] - entry["pushed"] + pending.getAge(item)) / 2)
+            r.removeLocalFiles([entry["ctl_file_path"]])
+            if isinstance(rcpt, Exception):
+                r.removeLocalFiles([os.path.join(data_dir,
+                                                 entry["rcpt_file_name"])])
+                results.append((item, self.receiptFailed(
+                    r, item, "bad receipt file for %s: %s" % (item, rcpt))))
+                continue
+
+            thanks[entry["rcpt_file_name"]] = rcpt
+            if isinstance(rcpt, ManifestReceiptFile):
+                # one receipt for a whole batch
+                rcpt_status = rcpt.getStatus(item)
+                if rcpt_status == None:
+                    results.append((item, self.receiptFailed(
+                        r, item, "%s missing from manifest receipt" % item)))
+                    continue
+            else:
+                rcpt_status = rcpt.getStatus()
+            if rcpt_status == ReceiptFile.SUCCESS:
+                pending.remove(item)
+                pending.clearFailures(item)
+                if not self.isMirror():
+                    r.deleteOrWarn(os.path.join(data_dir, item))
+                r.info("Successfully sent: %s; size: %s (receipt collected)"
+                       % (item, entry["size"]))
+                results.append((item, Response.success("sent %s" % item)))
+            elif rcpt_status == ReceiptFile.UNSUPPORTED_ALGORITHM:
+                # as in TransferBase.pullReceipt - fall back and send again
+                r.useDefaultAlgorithm("target does not support checksum "
+                                      "algorithm %s" % rcpt.getAlgorithm())
+                pending.remove(item)
+                results.append((item, Response.failure(
+                    "%s to be sent again with %s checksum" %
+                    (item, Checksum.default_algorithm))))
+            else:
+                results.append((item, self.receiptFailed(
+                    r, item, "target rejected %s: %s" %
+                    (item, rcpt.describeStatus(rcpt_status)))))
+
+        if thanks:
+            rv = r.pushThankYous(thanks)
+            if str(rv.code) != "Success":
+                # the arrival monitor will time them out
+                r.info("pushing %d thank-you files failed: %s" %
+                       (len(thanks), rv.data))
+        pending.save()
+        return results
+
+    def isMirror(self):
+        """
+        Whether items are left in the data_stream directory once sent
+        (transfer_mode = mirror, for the rsync protocols).  This goes by the
+        config rather than the module, which may not have set up an item
+        since it was reset.
+        """
+        if self.tp not in ("rsync_ssh", "rsync_native"):
+            return False
+        return self.config.get("%s.transfer_mode" % self.tp) == "mirror"
+
+    def receiptFailed(self, r, item, reason):
+        """
+        An item pushed with outgoing.async_receipts did not get there intact.
+        Forget it, so that it is sent again when next seen, unless this has
+        happened outgoing.retry_count times, in which case quarantine it.
+        """
+        pending = self.pending_receipts
+        pending.remove(item)
+        failures = pending.addFailure(item)
+        if failures < (self.config.get("outgoing.retry_count") or 3):
+            r.warn("%s - will send it again" % reason)
+            return Response.failure(reason)
+        pending.clearFailures(item)
+        r.error("%s - quarantining it after %d attempts" % (reason, failures))
+        TransferUtils.quarantine(item,
+                                 self.config.get("data_stream.directory"),
+                                 self.config.get("outgoing.quarantine_dir"))
+        return Response.failure("%s; quarantined" % reason)
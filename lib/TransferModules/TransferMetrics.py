@@ -0,0 +1,295 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import os
+import re
+import time
+import json
+import threading
+
+# rsync --info=progress2, e.g.
+#   "    105,185,280  49%   50.16MB/s    0:00:02 (xfr#1, to-chk=0/2)"
+_rsync_progress = re.compile(r"^\s*([\d,]+)\s+(\d+)%\s+\S+/s\s+"
+                             r"(\d+):(\d\d):(\d\d)")
+
+# globus-url-copy -vb, e.g.
+#   "    524288000 bytes        50.00 MB/sec avg        48.00 MB/sec inst"
+_globus_progress = re.compile(r"^\s*(\d+) bytes\s+[\d.]+ \S+/sec avg")
+
+
+def parseRsyncProgress(line):
+    '''
+    (bytes so far, seconds to go) from a line of rsync --info=progress2
+    output, or None if it isn't one
+    '''
+    match = _rsync_progress.match(line)
+    if not match:
+        return None
+    hours, mins, secs = [int(n) for n in match.groups()[2:]]
+    return (int(match.group(1).replace(",", "")),
+            hours * 3600 + mins * 60 + secs)
+
+
+def parseGlobusProgress(line):
+    '''
+    (bytes so far, None) from a performance line of globus-url-copy -vb
+    output, or None if it isn't one
+    '''
+    match = _globus_progress.match(line)
+    if not match:
+        return None
+    return int(match.group(1)), None
+
+
+def formatBytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            return "%.1f %s" % (n, unit)
+        n /= 1024.
+    return "%.1f TB" % n
+
+
+def formatSeconds(n):
+    n = int(n)
+    return "%d:%02d:%02d" % (n / 3600, n / 60 % 60, n % 60)
+
+
+class TransferMetrics(object):
+    """
+    How the transfers for a data_stream are going: for each transfer in
+    progress, the bytes moved so far, the current and average rate and the
+    time left, and totals for the transfers which have finished (bytes,
+    time, retries and failures).
+
+    The transfer modules update this from the progress output of rsync
+    (--info=progress2) or globus-url-copy (-vb) as it arrives (see
+    outgoing.progress_interval), and at the end of each push.  It is kept
+    as json in a dotfile in the data_stream directory (e.g. for a
+    monitoring script to read), rewritten at most every interval seconds
+    while transfers run and when each one ends.
+
+    It also keeps a moving average of how long receipts take to come back,
+    which is used to decide when to look for the next one (see
+    TransferBase.getPollDelay), and counts the looks on the target for
+    receipts and stop files.
+
+    One of these is shared by all of the transfer modules for a data_stream
+    (including those in different worker threads).
+    """
+
+    # weight of each new receipt time in the moving average
+    latency_weight = 0.25
+
+    def __init__(self, path, data_stream = None, interval = 0):
+        self.path = path
+        self.data_stream = data_stream
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.current = {}   # item -> dict, see start()
+        self.totals = {"transfers": 0, "bytes": 0, "seconds": 0.,
+                       "retries": 0, "failures": 0, "polls": 0}
+        self.last = None
+        self.receipt_latency = None
+        self.saved = 0
+
+
+    def setInterval(self, interval):
+        self.interval = interval or 0
+
+
+    def start(self, item, total = None, attempt = 1):
+        '''
+        Record that an attempt to transfer an item (total bytes, if known)
+        has begun
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.current[item] = {"started": now, "total": total,
+                                  "attempt": attempt, "bytes": 0,
+                                  "rate": None, "average_rate": None,
+                                  "eta": None, "sampled": now,
+                                  "reported": now}
+            if attempt > 1:
+                self.totals["retries"] += 1
+        finally:
+            self.lock.release()
+        self.save(True)
+
+
+    def update(self, item, nbytes, eta = None):
+        '''
+        Record that nbytes of an item have been moved so far, with the time
+        to go if the transfer program says (otherwise it is worked out from
+        the total and the current rate).  Returns True if it is time to
+        report on it (once per interval).
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.current.get(item)
+            if entry == None:
+                return False
+            elapsed = now - entry["sampled"]
+            if elapsed > 0 and nbytes >= entry["bytes"]:
+                entry["rate"] = (nbytes - entry["bytes"]) / elapsed
+            if now > entry["started"]:
+                entry["average_rate"] = nbytes / (now - entry["started"])
+            entry["bytes"] = nbytes
+            entry["sampled"] = now
+            if eta == None and entry["total"] and entry["rate"]:
+                eta = max(entry["total"] - nbytes, 0) / entry["rate"]
+            entry["eta"] = eta
+            report = (self.interval > 0 and
+                      now - entry["reported"] >= self.interval)
+            if report:
+                entry["reported"] = now
+        finally:
+            self.lock.release()
+        if report:
+            self.save()
+        return report
+
+
+    def finish(self, item, success, nbytes = None):
+        '''
+        Record the end of an attempt to transfer an item, which moved nbytes
+        (if given, otherwise the whole item if it succeeded and its size is
+        known, or else the last progress reported).  Returns the
+        details of the attempt (as describe() takes), or None if it wasn't
+        started.
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.current.pop(item, None)
+            if entry == None:
+                return None
+            if nbytes == None and success:
+                nbytes = entry["total"]
+            if nbytes != None:
+                entry["bytes"] = nbytes
+            entry["seconds"] = now - entry["started"]
+            if entry["seconds"] > 0:
+                entry["average_rate"] = entry["bytes"] / entry["seconds"]
+            entry["eta"] = None
+            entry["success"] = success
+            if success:
+                self.totals["transfers"] += 1
+                self.totals["bytes"] += entry["bytes"]
+                self.totals["seconds"] += entry["seconds"]
+            else:
+                self.totals["failures"] += 1
+            last = self.last = dict(entry, item = item)
+        finally:
+            self.lock.release()
+        self.save(True)
+        return last
+
+
+    def describe(self, item, entry = None):
+        '''
+        One line about the transfer of an item, for the log
+        '''
+        if entry == None:
+            self.lock.acquire()
+            try:
+                entry = dict(self.current.get(item) or {})
+            finally:
+                self.lock.release()
+            if not entry:
+                return "%s: not being transferred" % item
+        text = "%s: %s" % (item, formatBytes(entry["bytes"]))
+        if entry["total"]:
+            text += " of %s (%d%%)" % (formatBytes(entry["total"]),
+                                       100 * entry["bytes"] / entry["total"])
+        if "seconds" in entry:
+            text += " in %.1f seconds" % entry["seconds"]
+        elif entry["rate"] != None:
+            text += ", %s/s now" % formatBytes(entry["rate"])
+        if entry["average_rate"] != None:
+            text += ", %s/s average" % formatBytes(entry["average_rate"])
+        if entry["eta"] != None:
+            text += ", %s to go" % formatSeconds(entry["eta"])
+        if entry["attempt"] > 1:
+            text += " (attempt %d)" % entry["attempt"]
+        return text
+
+
+    def recordReceiptLatency(self, seconds):
+        '''
+        Add the time a receipt took to come back to the moving average
+        '''
+        self.lock.acquire()
+        try:
+            if self.receipt_latency == None:
+                self.receipt_latency = float(seconds)
+            else:
+                self.receipt_latency += (self.latency_weight *
+                                         (seconds - self.receipt_latency))
+        finally:
+            self.lock.release()
+
+
+    def getReceiptLatency(self):
+        '''
+        The moving average of the time receipts take to come back (seconds),
+        or None if none has been seen yet
+        '''
+        return self.receipt_latency
+
+
+    def countPoll(self):
+        '''
+        Count a look on the target for a receipt or a stop file
+        '''
+        self.lock.acquire()
+        try:
+            self.totals["polls"] += 1
+        finally:
+            self.lock.release()
+
+
+    def getState(self):
+        self.lock.acquire()
+        try:
+            totals = dict(self.totals)
+            if totals["seconds"] > 0:
+                totals["average_rate"] = totals["bytes"] / totals["seconds"]
+            return {"data_stream": self.data_stream,
+                    "updated": time.time(),
+                    "transfers": dict((item, dict(entry))
+                                      for item, entry in self.current.items()),
+                    "totals": totals,
+                    "last": self.last,
+                    "receipt_latency": self.receipt_latency}
+        finally:
+            self.lock.release()
+
+
+    def save(self, force = False):
+        '''
+        Write the state (tmp file and rename, so that a reader never sees it
+        half written), unless it was written less than interval seconds ago.
+        Failures to write it are ignored.
+        '''
+        now = time.time()
+        if not force and now - self.saved < self.interval:
+            return
+        self.saved = now
+        state = self.getState()
+        tmp_path = "%s.%s.tmp" % (self.path,
+                                  threading.currentThread().getName())
+        try:
+            f = open(tmp_path, "w")
+            try:
+                json.dump(state, f, indent = 1, sort_keys = True)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
@@ -16,6 +16,7 @@ lib_dir = os.path.join(top_dir, "lib")
 sys.path.append(lib_dir)
 
 from FileUtils import futils
+from ChecksumCache import checksum_cache
 
 class TransferUtils:
     """
@@ -31,27 +32,12 @@ class TransferUtils:
         return "%.2f" % time.time()
 
     @staticmethod
-    def calcChecksum(file_path):
+    def calcChecksum(file_path, algorithm = "md5"):
         """
-        NOTE: THIS MIGHT NOT BE BEST METHOD FOR CALCULATING MD5 checksum!!!!
-        comment from Alan - tested it and it agrees with md5sum command - 
-        haven't tested performance          
+        Checksum of a file, which is only calculated the first time for
+        a given version of the file (see ChecksumCache)
         """
-        block_size = 0x10000
-
-        def upd(m, data):
-            m.update(data)
-            return m
-
-        fd = open(file_path, "rb")
-        try:
-            contents = iter(lambda: fd.read(block_size), "")
-            m = reduce(upd, contents, hashlib.md5())
-            checksum = m.hexdigest()
-        finally:
-            fd.close()
-
-        return checksum
+        return checksum_cache.getChecksum(file_path, algorithm)
 
     @staticmethod
     def getPathInDir(filename, dirname):
@@ -85,12 +71,37 @@ class TransferUtils:
         return fl2
 
     @staticmethod
-    def getPlainFileName(datadir, item, dir_size_limit, zipdir = True):
+    def checkDirSize(path, dir_size_limit):
+        """
+        True if the directory can be sized and is no bigger than
+        dir_size_limit (in MB, no limit if 0 or None).  The walk stops as
+        soon as the limit is passed.
+        """
+        limit = None
+        if dir_size_limit:
+            limit = dir_size_limit * 1048576  # the size is in bytes
+        size = futils.getDirSize(path, limit)
+        if size < 0:
+            return False
+        if limit and size > limit:
+            return False
+        return True
+
+    @staticmethod
+    def getPlainFileName(datadir, item, dir_size_limit, zipdir = True,
+                         algorithm = None, **archive_options):
         """
         item is an entry in the dataset directory, which may be file or directory
         if a plain file, return the name
         if a directory, zip it up and return the zip file name
         if anything that can't be transferred, return None
+
+        archive_options (archive_format, compression, level,
+        store_extensions, workers) say how directories are packed (see
+        FileUtils._archiveDir).  If algorithm is given, the checksum of a
+        tar file is calculated as it is written and kept in the checksum
+        cache, so that the file is not read again to checksum it for the
+        control file.
         """
 
         path = os.path.join(datadir, os.path.basename(item))
@@ -104,16 +115,17 @@ class TransferUtils:
         if os.path.isfile(path):
             return item
         elif os.path.isdir(path) and zipdir:
-            size = futils.getDirSize(path)  # this is in bytes, limit is in MB
-            if size < 0:
-                return None
-            if dir_size_limit and (size > dir_size_limit  * 1048576):
+            if not TransferUtils.checkDirSize(path, dir_size_limit):
                 return None
 
-            resp = futils.zipDir(path)
+            resp = futils.archiveDir(path, algorithm = algorithm,
+                                     **archive_options)
             if not resp:
                 return None
-            zip_file = resp.data
+            zip_file, checksum = resp.data
+            if checksum:
+                checksum_cache.store(zip_file, checksum, os.stat(zip_file),
+                                     algorithm)
             resp = futils.deleteDir(path)
             return zip_file
         elif os.path.isdir(path) and zipdir == False:
@@ -133,6 +145,6 @@ class TransferUtils:
         if os.path.exists(file_path):
             while os.path.exists(q_file_path):
                 q_file_path += "." + TransferUtils.timeStamp()
-                os.rename(file_path, q_file_path)
+            os.rename(file_path, q_file_path)
 
 
@@ -0,0 +1,138 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import threading
+import Queue
+
+import Response
+from TransferModules.TransferBaseController import TransferBaseController
+
+
+class TransferWorkerPool(object):
+    """
+    A fixed number of worker threads which take batches of items (names of
+    files or directories in the data_stream directory, see
+    TransferBaseController.makeBatches) from a common queue and transfer
+    them, so that a DatasetTransferController can have several transfer
+    units in flight at once.
+
+    Each worker has its own TransferBaseController, so the per-item state
+    held by the transfer modules is never shared between workers.  They do
+    share the stop file cache, pending receipts and transfer metrics, if
+    given.  With global.bandwidth_limit, each transfer gets a part of the
+    data_stream's share of the bandwidth (see getWidth).
+
+    The pool is driven from the controller's (main) thread, which calls
+    submit() and then getResults() until isIdle().  The main thread keeps
+    control throughout, so it can still respond to signals.
+    """
+
+    def __init__(self, dconfig, nworkers, stop_file_cache = None,
+                 pending_receipts = None, metrics = None):
+        self.dconfig = dconfig
+        self.stop_file_cache = stop_file_cache
+        self.pending_receipts = pending_receipts
+        self.metrics = metrics
+        self.pending = Queue.Queue()
+        self.results = Queue.Queue()
+        self.outstanding = 0   # submitted but not yet collected
+        self.workers = []
+        for i in range(nworkers):
+            worker = threading.Thread(target = self._work,
+                                      name = "transfer_worker_%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def _work(self):
+        """
+        Worker thread main loop.  A None batch tells the worker to exit.
+        """
+        tbc = TransferBaseController(self.dconfig, self.stop_file_cache,
+                                     self.pending_receipts, self.metrics,
+                                     self.getWidth)
+        while True:
+            batch = self.pending.get()
+            if batch == None:
+                return
+            try:
+                results = tbc.transferBatch(batch)
+            except Exception, err:
+                resp = Response.failure("exception while transferring %s: %s"
+                                        % (", ".join(batch), err))
+                results = [(item, resp) for item in batch]
+            self.results.put(results)
+
+
+    def submit(self, batch):
+        """
+        Queue a batch (list) of items for transfer by the next free worker
+        """
+        self.outstanding += 1
+        self.pending.put(batch)
+
+
+    def getWidth(self):
+        """
+        The most transfers that may be running at once: the number of
+        workers, or of batches submitted and not yet collected if fewer.
+        Each transfer takes this fraction of the data_stream's bandwidth.
+        """
+        return max(min(self.outstanding, len(self.workers)), 1)
+
+
+    def isIdle(self):
+        """
+        True if every submitted batch has been collected by getResults()
+        """
+        return self.outstanding == 0
+
+
+    def cancelPending(self):
+        """
+        Remove the items that no worker has started on yet, and return them.
+        Transfers already in progress are left to finish, unless we were
+        asked to stop by SIGUSR1, which kills their commands (see
+        TransferBase.transferData).
+        """
+        cancelled = []
+        while True:
+            try:
+                batch = self.pending.get_nowait()
+            except Queue.Empty:
+                break
+            if batch != None:
+                cancelled.extend(batch)
+                self.outstanding -= 1
+        return cancelled
+
+
+    def getResults(self, timeout):
+        """
+        Wait up to timeout seconds for a transfer to finish, and return a
+        list of (item, response) for all of the items in batches which have
+        (may be empty)
+        """
+        results = []
+        try:
+            results.extend(self.results.get(True, timeout))
+            self.outstanding -= 1
+            while True:
+                results.extend(self.results.get_nowait())
+                self.outstanding -= 1
+        except Queue.Empty:
+            pass
+        return results
+
+
+    def shutdown(self):
+        """
+        Tell the workers to exit once they have finished their current item
+        """
+        for worker in self.workers:
+            self.pending.put(None)
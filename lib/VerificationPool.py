@@ -0,0 +1,145 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import os
+import itertools
+import multiprocessing
+
+import ReceiptFile
+import Checksum
+from FileUtils import futils
+from ChecksumCache import checksum_cache
+
+
+def verifyFile(file_path, correct_size, correct_cksum,
+               algorithm = Checksum.default_algorithm):
+    """
+    Check the size and checksum of a file that has arrived.  Returns a tuple
+    of (data to write to the receipt file, warning message or None).
+
+    This is a plain function so that it can be run in a worker process.
+    """
+    if not Checksum.isSupported(algorithm):
+        return ([ReceiptFile.UNSUPPORTED_ALGORITHM],
+                "%s: checksum algorithm %s is not supported here" %
+                (file_path, algorithm))
+    if not os.path.exists(file_path):
+        return [ReceiptFile.NO_SUCH_FILE], "%s: no such file" % file_path
+    try:
+        actual_size = futils.getSize(file_path)
+        if actual_size != correct_size:
+            return ([ReceiptFile.BAD_SIZE, actual_size],
+                    "%s actual size %s correct size %s" %
+                    (file_path, actual_size, correct_size))
+        # (not from the cache: the file may have been replaced by one with
+        # the same size and mtime, and reading it is the point)
+        actual_cksum = checksum_cache.calcChecksum(file_path, algorithm)
+        if actual_cksum != correct_cksum:
+            return ([ReceiptFile.BAD_CKSUM, actual_size, actual_cksum],
+                    "%s actual cksum %s correct cksum %s" %
+                    (file_path, actual_cksum, correct_cksum))
+        return [ReceiptFile.SUCCESS, actual_size, actual_cksum], None
+    except (IOError, OSError):
+        return [ReceiptFile.IO_ERROR], None
+
+
+class VerificationPool(object):
+    """
+    A pool of worker processes which run verifyFile() for the arrival
+    monitor, so that checksumming one large file does not hold up all of
+    the others, and checksums are calculated on several cores at once.
+
+    Each job has a key (the control file name), and submitting a key which
+    is already waiting or running does nothing, so the caller can simply
+    submit everything it sees on each scan.  Jobs are only handed to the
+    processes when one is free, so the order in which they are run can be
+    chosen: "fifo" (order submitted) or "small_first" (smallest file first).
+
+    Like TransferWorkerPool, this is driven from the controller's main
+    thread: it calls submit() and then getResults() on each cycle.
+    """
+
+    orders = ("fifo", "small_first")
+
+    def __init__(self, nworkers, order = "fifo"):
+        if order not in self.orders:
+            raise ValueError("checksum order must be one of: %s" %
+                             ", ".join(self.orders))
+        self.nworkers = nworkers
+        self.order = order
+        self.pool = multiprocessing.Pool(nworkers)
+        self.counter = itertools.count()
+        self.waiting = []  # (priority, key, args)
+        self.running = {}  # key -> AsyncResult
+
+
+    def isQueued(self, key):
+        """
+        True if the job with this key is waiting or running
+        """
+        return key in self.running or key in [w[1] for w in self.waiting]
+
+
+    def submit(self, key, file_path, correct_size, correct_cksum, algorithm):
+        """
+        Queue a file to be verified, unless this key is already queued
+        """
+        if self.isQueued(key):
+            return
+        seq = self.counter.next()
+        if self.order == "small_first":
+            priority = (correct_size, seq)
+        else:
+            priority = (seq,)
+        self.waiting.append((priority, key,
+                             (file_path, correct_size, correct_cksum,
+                              algorithm)))
+        self.dispatch()
+
+
+    def dispatch(self):
+        """
+        Hand waiting jobs to the worker processes while any are free
+        """
+        self.waiting.sort()
+        while self.waiting and len(self.running) < self.nworkers:
+            priority, key, args = self.waiting.pop(0)
+            self.running[key] = self.pool.apply_async(verifyFile, args)
+
+
+    def getResults(self):
+        """
+        Return a list of (key, (receipt data, warning message)) for the jobs
+        which have finished since the last call (may be empty).  Does not
+        wait.
+        """
+        results = []
+        for key, async_result in self.running.items():
+            if async_result.ready():
+                del self.running[key]
+                try:
+                    results.append((key, async_result.get()))
+                except Exception, err:
+                    results.append((key, ([ReceiptFile.IO_ERROR],
+                                          "verification failed: %s" % err)))
+        self.dispatch()
+        return results
+
+
+    def isIdle(self):
+        return not (self.waiting or self.running)
+
+
+    def shutdown(self):
+        """
+        Stop the worker processes, abandoning any jobs (the control files are
+        still there, so they will be picked up again next time)
+        """
+        self.waiting = []
+        self.running = {}
+        self.pool.terminate()
+        self.pool.join()
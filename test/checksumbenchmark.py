@@ -0,0 +1,118 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Compare the ways of reading files for checksums (see lib/Checksum.py).
+
+Writes test files of the given sizes to a scratch directory, then times
+calcChecksum on each one in each read mode, with and without dropping the
+file from the page cache afterwards.  Unless --warm is given, each file is
+dropped from the page cache before each run, so that the timings are of
+reading from disk, as for a newly arrived file.
+
+e.g.  python test/checksumbenchmark.py --dir /data/scratch --sizes 1M,1G,100G
+"""
+
+import sys
+import os
+import time
+from optparse import OptionParser
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "test":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "lib")
+sys.path.append(lib_dir)
+
+import Checksum
+
+units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+block_size = 1 << 24
+
+
+def parseSize(text):
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def makeFile(path, size):
+    """
+    Write a file of random-ish data (a random block repeated, so that it is
+    quick to write but still has to be read from disk - unlike a sparse file)
+    """
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+    block = os.urandom(block_size)
+    f = open(path, "wb")
+    try:
+        written = 0
+        while written < size:
+            n = min(block_size, size - written)
+            f.write(block[:n])
+            written += n
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+def dropFromCache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        Checksum._fadvise(fd, 0, 0, Checksum.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option("-d", "--dir", default = "/tmp/checksumbenchmark",
+                      help = "scratch directory for the test files")
+    parser.add_option("-s", "--sizes", default = "1M,10M,100M,1G",
+                      help = "comma separated file sizes, e.g. 1M,100G")
+    parser.add_option("-a", "--algorithm", default = "md5")
+    parser.add_option("-r", "--repeats", type = "int", default = 3)
+    parser.add_option("-w", "--warm", action = "store_true", default = False,
+                      help = "don't drop files from the cache before runs")
+    parser.add_option("-k", "--keep", action = "store_true", default = False,
+                      help = "keep the test files afterwards")
+    options, args = parser.parse_args()
+
+    if not Checksum._libc:
+        print "(posix_fadvise / madvise not available - hints are not used)"
+    if not os.path.isdir(options.dir):
+        os.makedirs(options.dir)
+
+    print "%12s %6s %6s %10s %10s" % ("size", "mode", "drop", "seconds",
+                                      "MB/s")
+    for size in [parseSize(s) for s in options.sizes.split(",")]:
+        path = os.path.join(options.dir, "file_%d" % size)
+        makeFile(path, size)
+        checksums = set()
+        for read_mode in ("read", "mmap"):
+            for drop_cache in (False, True):
+                best = None
+                for i in range(options.repeats):
+                    if not options.warm:
+                        dropFromCache(path)
+                    start = time.time()
+                    checksums.add(Checksum.calcChecksum(
+                            path, options.algorithm, read_mode = read_mode,
+                            drop_cache = drop_cache))
+                    elapsed = time.time() - start
+                    if best == None or elapsed < best:
+                        best = elapsed
+                print "%12d %6s %6s %10.3f %10.1f" % (
+                    size, read_mode, drop_cache, best,
+                    size / float(1 << 20) / max(best, 1e-6))
+        if len(checksums) != 1:
+            print "ERROR: read modes disagree on checksum: %s" % checksums
+        if not options.keep:
+            os.remove(path)
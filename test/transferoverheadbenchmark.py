@@ -0,0 +1,144 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Measure the time taken to get a transfer module ready for each item (see
+lib/TransferModules/TransferBaseController.py), without transferring
+anything.
+
+Compares making a new module for every item and checking its config, as
+was done before modules were reused, with reusing one module (reset() and
+checkVarsIfChanged()) as TransferBaseController.getModule does now.
+
+Writes a global and a data_stream config to a scratch directory, for the
+given transfer protocol.  No LoggerServer needs to be running (log records
+which cannot be sent are dropped).
+
+e.g.  python test/transferoverheadbenchmark.py --items 1000 --protocol ftp
+"""
+
+import sys
+import os
+import time
+import shutil
+from optparse import OptionParser
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "test":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "lib")
+sys.path.append(lib_dir)
+sys.path.append(os.path.join(lib_dir, "TransferModules"))
+
+from Config.GlobalConfig import GlobalConfig
+from Config.DatasetConfig import DatasetConfig
+from TransferBaseController import TransferBaseController
+
+global_ini = """
+[global]
+top = %(top)s
+config_dir = %(dir)s
+data_stream_list = bench
+state_dir = %(dir)s/state
+base_data_dir = %(dir)s
+base_incoming_dir = %(dir)s/incoming
+
+[outgoing]
+transfer_protocol = %(protocol)s
+target_host = localhost
+target_dir = /tmp
+dir_size_limit = 1000.
+
+[incoming]
+
+[logging]
+base_log_dir = %(dir)s/log
+port = 1
+
+[rsync_ssh]
+cmd = rsync
+username = nobody
+transfer_mode = move
+
+[rsync_native]
+cmd = rsync
+username = nobody
+password = nobody
+transfer_mode = move
+
+[ftp]
+cmd = ftp
+username = nobody
+password = nobody
+"""
+
+ds_ini = """
+[data_stream]
+name = bench
+directory = %(dir)s/data
+"""
+
+
+def makeConfig(scratch_dir, protocol):
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    os.makedirs(os.path.join(scratch_dir, "data"))
+    values = {"top": top_dir, "dir": scratch_dir, "protocol": protocol}
+    global_path = os.path.join(scratch_dir, "global.ini")
+    f = open(global_path, "w")
+    f.write(global_ini % values)
+    f.close()
+    f = open(os.path.join(scratch_dir, "ds_bench.ini"), "w")
+    f.write(ds_ini % values)
+    f.close()
+    return DatasetConfig("bench", GlobalConfig(global_path))
+
+
+def timeFresh(tbc, items):
+    """
+    A new module for each item, as before modules were reused
+    """
+    start = time.time()
+    for i in range(items):
+        r = tbc.makeModule()
+        r.checkVars()
+    return time.time() - start
+
+
+def timeReused(tbc, items):
+    """
+    The module for the previous item, reset, as getModule does now
+    """
+    start = time.time()
+    for i in range(items):
+        r = tbc.getModule()
+        r.checkVarsIfChanged()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option("-d", "--dir", default = "/tmp/transferoverheadbenchmark",
+                      help = "scratch directory for the configs")
+    parser.add_option("-p", "--protocol", default = "rsync_ssh",
+                      help = "outgoing.transfer_protocol to benchmark")
+    parser.add_option("-n", "--items", type = "int", default = 500)
+    parser.add_option("-r", "--repeats", type = "int", default = 3)
+    options, args = parser.parse_args()
+
+    dconfig = makeConfig(options.dir, options.protocol)
+    tbc = TransferBaseController(dconfig)
+
+    print "%10s %8s %10s %14s" % ("setup", "items", "seconds", "ms per item")
+    for name, method in (("fresh", timeFresh), ("reused", timeReused)):
+        best = min([method(tbc, options.items)
+                    for i in range(options.repeats)])
+        print "%10s %8d %10.3f %14.3f" % (name, options.items, best,
+                                          best * 1000 / options.items)
+    shutil.rmtree(options.dir)
@@ -0,0 +1,79 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time, shutil
+from cStringIO import StringIO
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+from BandwidthScheduler import BandwidthScheduler, ThrottledWriter, \
+    shareBandwidth
+
+if __name__ == '__main__':
+
+    def test_share():
+        assert shareBandwidth(1000, {"a": 100}) == {"a": 1000}
+        assert shareBandwidth(900, {"a": 100, "b": 200}) == \
+            {"a": 300, "b": 600}
+        assert shareBandwidth(10, {"a": 1, "b": 10000}) == {"a": 1, "b": 9}
+        assert shareBandwidth(10, {}) == {}
+
+    def test_schedule():
+        state_dir = "/tmp/test_bandwidth_state"
+        if os.path.exists(state_dir):
+            shutil.rmtree(state_dir)
+        sched = BandwidthScheduler(state_dir, 1000)
+        stream = BandwidthScheduler(state_dir, 1000)
+        stream.setBusy("bulk", 100)
+        # not shared out yet, but it can work out its share
+        assert stream.getAllocation("ops", 300) == 750
+        assert sched.rebalance() == {"bulk": 1000}
+        assert sched.rebalance() == None
+        stream.setBusy("ops", 300)
+        assert sched.rebalance() == {"bulk": 250, "ops": 750}
+        assert stream.getAllocation("bulk") == 250
+        stream.setBusy("ops", 300, False)
+        assert sched.rebalance() == {"bulk": 1000}
+
+        # the process which said it was busy has gone
+        open(os.path.join(sched.dir_path, "busy.old"), "w").write(
+            '{"priority": 100, "pid": 999999999}')
+        assert sched.getBusy() == {"bulk": 100}
+        assert not os.path.exists(os.path.join(sched.dir_path, "busy.old"))
+        sched.clear()
+        assert os.listdir(sched.dir_path) == []
+        shutil.rmtree(state_dir)
+
+    def test_throttle():
+        out = StringIO()
+        writer = ThrottledWriter(out, lambda: 100)
+        start = time.time()
+        for i in range(25):
+            writer.write("x" * 10240)
+        elapsed = time.time() - start
+        assert out.getvalue() == "x" * 256000
+        assert 2 < elapsed < 3.5, elapsed
+
+        # no limit
+        writer = ThrottledWriter(out, lambda: None)
+        start = time.time()
+        writer.write("x" * 10000000)
+        assert time.time() - start < 1
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--share":
+            test_share()
+        if sys.argv[1] == "--schedule":
+            test_schedule()
+        if sys.argv[1] == "--throttle":
+            test_throttle()
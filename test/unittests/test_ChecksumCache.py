@@ -0,0 +1,96 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+import ChecksumCache
+from FileUtils import futils
+
+if __name__ == '__main__':
+
+    tmp_dir = "/tmp/test_checksum_cache"
+    file_path = os.path.join(tmp_dir, "file1")
+    calls = []
+
+    def calc(path, algorithm, buffer_size, read_mode, drop_cache):
+        calls.append(path)
+        return futils.calcChecksum(path, algorithm, buffer_size, read_mode,
+                                   drop_cache)
+
+    def setup():
+        futils.deleteDir(tmp_dir)
+        futils.ensureDirExists(tmp_dir)
+        del calls[:]
+        fh = open(file_path, "w")
+        fh.write("data\n")
+        fh.close()
+
+    def test_memory():
+        setup()
+        cache = ChecksumCache.ChecksumCache(calc_function = calc)
+        first = cache.getChecksum(file_path)
+        assert cache.getChecksum(file_path) == first
+        assert len(calls) == 1
+        time.sleep(0.1)
+        fh = open(file_path, "a")
+        fh.write("more data\n")
+        fh.close()
+        assert cache.getChecksum(file_path) != first
+        assert len(calls) == 2
+        # a different algorithm is a different entry
+        assert cache.getChecksum(file_path, "sha256") != first
+        assert len(calls) == 3
+
+    def test_replaced():
+        setup()
+        cache = ChecksumCache.ChecksumCache(calc_function = calc)
+        first = cache.getChecksum(file_path)
+        st = os.stat(file_path)
+        time.sleep(0.1)
+        # same size and mtime (as rsync -a would leave it), different data
+        fh = open(file_path, "w")
+        fh.write("DATA\n")
+        fh.close()
+        os.utime(file_path, (st.st_atime, st.st_mtime))
+        assert cache.getChecksum(file_path) != first
+        assert len(calls) == 2
+        # verifying a file always reads it
+        assert cache.calcChecksum(file_path) == cache.getChecksum(file_path)
+        assert len(calls) == 3
+
+    def test_persistent(use_xattr):
+        setup()
+        cache_dir = os.path.join(tmp_dir, "cache")
+        cache = ChecksumCache.ChecksumCache(cache_dir = cache_dir,
+                                            use_xattr = use_xattr,
+                                            calc_function = calc)
+        checksum = cache.getChecksum(file_path)
+        # a new cache (e.g. after restart) should find the stored checksum
+        cache = ChecksumCache.ChecksumCache(cache_dir = cache_dir,
+                                            use_xattr = use_xattr,
+                                            calc_function = calc)
+        assert cache.getChecksum(file_path) == checksum
+        assert len(calls) == 1
+        print "using xattr:", cache.use_xattr
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--memory":
+            test_memory()
+        if sys.argv[1] == "--replaced":
+            test_replaced()
+        if sys.argv[1] == "--sidecar":
+            test_persistent(False)
+        if sys.argv[1] == "--xattr":
+            test_persistent(True)
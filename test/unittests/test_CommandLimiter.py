@@ -0,0 +1,128 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time, shutil, threading
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+from CommandLimiter import CommandLimiter
+
+state_dir = "/tmp/test_command_limiter"
+
+def makeLimiter(max_total, max_per_host):
+    if os.path.exists(state_dir):
+        shutil.rmtree(state_dir)
+    return CommandLimiter(state_dir, max_total, max_per_host,
+                          poll_interval = 0.05)
+
+if __name__ == '__main__':
+
+    def test_limit():
+        limiter = makeLimiter(3, 2)
+        a1, blocked = limiter.tryAcquire("a")
+        a2, blocked = limiter.tryAcquire("a")
+        assert a1 and a2
+        assert limiter.tryAcquire("a") == (None, "host")
+        b1, blocked = limiter.tryAcquire("b")
+        assert b1
+        assert limiter.tryAcquire("b") == (None, "all")
+        status = limiter.getStatus()
+        assert status == {"running": 3, "hosts": {"a": 2, "b": 1},
+                          "waiting": 0}, status
+        a1.release()
+        b2, blocked = limiter.tryAcquire("b")
+        assert b2
+        for slot in (a2, b1, b2):
+            slot.release()
+        assert limiter.getStatus()["running"] == 0
+        shutil.rmtree(state_dir)
+
+    def test_queue():
+        limiter = makeLimiter(1, 0)
+        held = limiter.acquire("a")
+        order = []
+        def wait(name, priority):
+            slot = limiter.acquire("a", priority)
+            order.append(name)
+            time.sleep(0.1)
+            slot.release()
+        threads = []
+        for name, priority in (("low", 1), ("high", 10), ("mid", 5)):
+            thread = threading.Thread(target = wait, name = name,
+                                      args = (name, priority))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.1)
+        assert limiter.getStatus()["waiting"] == 3
+        held.release()
+        for thread in threads:
+            thread.join()
+        assert order == ["high", "mid", "low"], order
+
+        # giving up when asked to stop
+        held = limiter.acquire("a")
+        start = time.time()
+        assert limiter.acquire(
+            "a", check_abort = lambda: time.time() - start > 0.2) == None
+        assert limiter.getTickets() == []
+        held.release()
+        shutil.rmtree(state_dir)
+
+    def test_hosts():
+        # a command for a free host is not held up behind one waiting for
+        # a busy host
+        limiter = makeLimiter(2, 1)
+        held = limiter.acquire("a")
+        got = []
+        def wait(host):
+            slot = limiter.acquire(host, 10)
+            got.append(host)
+            slot.release()
+        waiter = threading.Thread(target = wait, args = ("a",))
+        waiter.start()
+        time.sleep(0.2)
+        slot = limiter.acquire("b", 1)
+        assert got == []
+        slot.release()
+        held.release()
+        waiter.join()
+        assert got == ["a"]
+        shutil.rmtree(state_dir)
+
+    def test_status():
+        # the status is read from the slot files, without locking them
+        limiter = makeLimiter(2, 0)
+        held, blocked = limiter.tryAcquire("a")
+        def noLocking(names):
+            raise AssertionError("getStatus took a lock")
+        limiter._lockOne = noLocking
+        assert limiter.getStatus()["running"] == 1
+        del limiter._lockOne
+        # a slot file left by a process which has gone away
+        f = open(os.path.join(limiter.dir_path, "slot.all.1"), "w")
+        f.write("999999999\n")
+        f.close()
+        assert limiter.getStatus()["running"] == 1
+        held.release()
+        assert limiter.getStatus()["running"] == 0
+        shutil.rmtree(state_dir)
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--limit":
+            test_limit()
+        if sys.argv[1] == "--queue":
+            test_queue()
+        if sys.argv[1] == "--hosts":
+            test_hosts()
+        if sys.argv[1] == "--status":
+            test_status()
@@ -0,0 +1,75 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+import DirIndex
+from FileUtils import futils
+
+if __name__ == '__main__':
+
+    tmp_dir = "/tmp/test_dir_index"
+
+    def setup():
+        futils.deleteDir(tmp_dir)
+        futils.ensureDirExists(os.path.join(tmp_dir, "subdir"))
+        for path in ["file1", ".dotfile", "subdir/file2"]:
+            fh = open(os.path.join(tmp_dir, path), "w")
+            fh.write("data\n")
+            fh.close()
+
+    def test_scan():
+        setup()
+        index = DirIndex.DirIndex(tmp_dir, deep_dirs = True)
+        assert index.scan()
+        print "new:", index.newEntries()
+        assert sorted(index.newEntries()) == ["file1", "subdir"]
+        assert index.stableEntries(1) == []
+
+        time.sleep(1.1)
+        fh = open(os.path.join(tmp_dir, "subdir/file2"), "a")
+        fh.write("more data\n")
+        fh.close()
+        index.scan()
+        print "changed:", index.changedEntries()
+        print "stable:", index.stableEntries(1)
+        assert index.changedEntries() == ["subdir"]
+        assert index.stableEntries(1) == ["file1"]
+        print "oldest first:", index.oldestFirst()
+
+    def test_statKnown():
+        setup()
+        index = DirIndex.DirIndex(tmp_dir, stat_known = False)
+        index.scan()
+        time.sleep(1.1)
+        index.scan()
+        print "newest first:", index.newestFirst(fullPaths = True)
+        assert index.newEntries() == []
+        assert not DirIndex.DirIndex("/no/such/dir").scan()
+
+        # ctime of an entry which was not stat'ed again
+        path = os.path.join(tmp_dir, "file1")
+        old_ctime = index.getEntry("file1").ctime
+        os.chmod(path, 0600)
+        index.scan()
+        index.refreshStats()
+        assert index.getEntry("file1").ctime == os.stat(path).st_ctime
+        assert index.getEntry("file1").ctime > old_ctime
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--scan":
+            test_scan()
+        if sys.argv[1] == "--statKnown":
+            test_statKnown()
@@ -0,0 +1,79 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time, shutil, threading
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+from DirWatcher import DirWatcher
+
+if __name__ == '__main__':
+
+    dir_path = "/tmp/test_dir_watcher"
+
+    def makeWatcher():
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path)
+        os.makedirs(dir_path)
+        watcher = DirWatcher()
+        if not watcher.isEventDriven():
+            print "inotify not available - skipping"
+            return None
+        assert watcher.addDir(dir_path)
+        return watcher
+
+    def later(func, *args):
+        def run():
+            time.sleep(0.5)
+            func(*args)
+        threading.Thread(target = run).start()
+
+    def test_files():
+        watcher = makeWatcher()
+        if not watcher:
+            return
+        path = os.path.join(dir_path, "a.dat")
+        # creating a file is not enough, it has to be written and closed
+        f = open(path, "w")
+        assert watcher.wait(0.5) == []
+        later(f.close)
+        start = time.time()
+        assert watcher.wait(10) == ["a.dat"]
+        assert time.time() - start < 5
+
+        open(path + ".tmp", "w").close()
+        watcher.readEvents()
+        later(os.rename, path + ".tmp", os.path.join(dir_path, "b.dat"))
+        assert watcher.wait(10) == ["b.dat"]
+
+        # only the names asked for end the wait
+        later(open, os.path.join(dir_path, ".hidden"), "w")
+        start = time.time()
+        assert watcher.wait(2, wanted = lambda name: name[0] != ".") == []
+        assert time.time() - start > 1.5
+
+    def test_mkdir():
+        watcher = makeWatcher()
+        if not watcher:
+            return
+        # a dataset directory made in place, to be filled afterwards
+        later(os.mkdir, os.path.join(dir_path, "dataset1"))
+        start = time.time()
+        assert watcher.wait(10) == ["dataset1"]
+        assert time.time() - start < 5
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--files":
+            test_files()
+        if sys.argv[1] == "--mkdir":
+            test_mkdir()
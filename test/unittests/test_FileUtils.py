@@ -44,8 +44,43 @@ if __name__ == '__main__':
         os.system("unzip -l %s" % zipfile)                
         os.remove(zipfile)                                
 
+    def test_archiveDir():
+        os.system("rm -fr /tmp/archive_test; mkdir -p /tmp/archive_test/d/e;"
+                  " echo foo > /tmp/archive_test/d/e/f")
+        for archive_format in f.archive_formats:
+            for compression in f.archive_compressions:
+                resp = f.archiveDir("/tmp/archive_test/d", archive_format,
+                                    compression, "md5")
+                print resp
+                path, checksum = resp.data
+                assert os.path.exists(path)
+                if checksum:
+                    assert checksum == f.calcChecksum(path)
+        os.system("tar tvzf /tmp/archive_test/d.tar.gz")
+        # compressed in parallel, with .gz files stored
+        os.system("echo bar | gzip > /tmp/archive_test/d/e/g.gz")
+        print f.zipDir("/tmp/archive_test/d", "/tmp/archive_test/p.zip",
+                       "deflate", 9, [".gz"], 2)
+        os.system("unzip -v /tmp/archive_test/p.zip")
+        assert os.system("unzip -tq /tmp/archive_test/p.zip") == 0
+        f.deleteDir("/tmp/archive_test")
+        # a tree deeper than the recursion limit
+        deep = "/tmp/archive_deep/d/" + "x/" * (sys.getrecursionlimit() + 10)
+        os.system("rm -fr /tmp/archive_deep; mkdir -p %s; echo foo > %s/f" %
+                  (deep, deep))
+        for archive_format in f.archive_formats:
+            resp = f.archiveDir("/tmp/archive_deep/d", archive_format)
+            print resp
+            assert resp
+        assert os.system("unzip -tq /tmp/archive_deep/d.zip") == 0
+        os.system("rm -fr /tmp/archive_deep")
+
     def test_dirSize():
         print f.getDirSize("/etc/init.d")
+        print f.getDirStats("/etc/init.d")
+        # stops early once over the limit
+        print f.getDirSize("/etc", 1)
+        assert f.getDirSize("/no/such/dir") == -1
 
     def test_deleteDir():
         tmp_path = "/tmp/my_X11_copy"
@@ -88,6 +123,8 @@ if __name__ == '__main__':
             test_deleteFile()
         if sys.argv[1] == "--zipDir":
             test_zipDir()
+        if sys.argv[1] == "--archiveDir":
+            test_archiveDir()
         if sys.argv[1] == "--dirSize":
             test_dirSize()
         if sys.argv[1] == "--deleteDir":
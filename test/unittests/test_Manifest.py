@@ -0,0 +1,75 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+import ControlFile
+import ReceiptFile
+from ManifestControlFile import ManifestControlFile
+from ManifestReceiptFile import ManifestReceiptFile
+
+if __name__ == '__main__':
+
+    def test_control():
+        fname = "manifest.tmp"
+        os.system("rm -f %s" % fname)
+
+        entries = [("foo", 123, "abc123"), ("bar baz", 0, "def456")]
+        out1 = ManifestControlFile(fname)
+        out1.create(".foo.rcpt", entries, algorithm = "sha256")
+        in1 = ManifestControlFile(fname)
+        data = in1.read()
+        print data
+        assert data == [".foo.rcpt", entries]
+        assert in1.getAlgorithm() == "sha256"
+
+        # not an ordinary control file, and vice versa
+        try:
+            ControlFile.ControlFile(fname).read()
+            assert False
+        except ControlFile.Invalid:
+            pass
+        os.system("rm -f %s" % fname)
+        ControlFile.ControlFile(fname).create("foo", 123, "abc123", "x.rcpt")
+        try:
+            ManifestControlFile(fname).read()
+            assert False
+        except ControlFile.Invalid:
+            pass
+        os.system("rm -f %s" % fname)
+
+    def test_receipt():
+        fname = "manifest_rcpt.tmp"
+        os.system("rm -f %s" % fname)
+
+        out1 = ManifestReceiptFile(fname)
+        out1.create(".foo.thanks",
+                    [("foo", ReceiptFile.SUCCESS, 123, "abc123"),
+                     ("bar", ReceiptFile.NO_SUCH_FILE, None, None)])
+        in1 = ManifestReceiptFile(fname)
+        print in1.read()
+        assert in1.getThankyouFileName() == ".foo.thanks"
+        assert in1.getStatus("foo") == ReceiptFile.SUCCESS
+        assert in1.getStatus("bar") == ReceiptFile.NO_SUCH_FILE
+        assert in1.getStatus("baz") == None
+        assert in1.getStatus() == ReceiptFile.NO_SUCH_FILE
+        print in1.describeStatus(in1.getStatus("bar"))
+        os.system("rm -f %s" % fname)
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--control":
+            test_control()
+        if sys.argv[1] == "--receipt":
+            test_receipt()
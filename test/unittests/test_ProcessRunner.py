@@ -0,0 +1,109 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+from ProcessRunner import Command, OutputBuffer, runProcess, makeCommand, \
+    _LineSplitter
+
+if __name__ == '__main__':
+
+    def test_run():
+        # arguments are passed as they are, not through a shell
+        result = runProcess(Command(["echo", "a b", "$HOME;", "*"]))
+        assert result.returncode == 0
+        assert result.stdout == "a b $HOME; *\n"
+        assert not result.timed_out
+
+        result = runProcess(Command(["cat"], input = "x" * 200000))
+        assert result.stdout == "x" * 200000
+
+        result = runProcess(["sh", "-c", "echo oops >&2; exit 3"])
+        assert result.returncode == 3
+        assert result.stderr == "oops\n"
+
+        # old style command strings still work
+        assert makeCommand("ls -l").argv == ["ls", "-l"]
+        assert runProcess("echo one; echo two").stdout == "one\ntwo\n"
+
+    def test_timeout():
+        start = time.time()
+        result = runProcess(["sh", "-c", "sleep 30 & sleep 30"], timeout = 1)
+        assert result.timed_out
+        assert result.returncode != 0
+        assert time.time() - start < 10
+
+        # asked to stop part way through
+        start = time.time()
+        result = runProcess(["sleep", "30"],
+                            check_abort = lambda: time.time() - start > 1)
+        assert result.aborted and not result.timed_out
+        assert time.time() - start < 10
+
+    def test_background():
+        # a command which closes its output still times out
+        start = time.time()
+        result = runProcess(["sh", "-c", "exec >&- 2>&-; sleep 8"],
+                            timeout = 1)
+        assert result.timed_out
+        assert time.time() - start < 5
+
+        # and one which leaves something running with its output open
+        # finishes when it does
+        start = time.time()
+        result = runProcess(["sh", "-c", "sleep 30 & echo hi"], timeout = 2)
+        assert not result.timed_out
+        assert result.returncode == 0
+        assert result.stdout == "hi\n"
+        assert time.time() - start < 5
+
+    def test_output():
+        lines = []
+        def callback(name, line):
+            lines.append((name, line))
+        result = runProcess(["sh", "-c", "printf '10%%\\r20%%\\rdone\\n'; "
+                             "printf 'no newline' >&2"],
+                            line_callback = callback)
+        assert lines == [("stdout", "10%"), ("stdout", "20%"),
+                         ("stdout", "done"), ("stderr", "no newline")]
+
+        # only the end of the output is kept
+        result = runProcess(["sh", "-c", "seq 1 100000"], max_output = 100)
+        assert len(result.stdout) == 100
+        assert result.stdout.endswith("\n99999\n100000\n")
+
+        buf = OutputBuffer(10)
+        for data in ("abc", "defghij", "klmno"):
+            buf.append(data)
+        assert buf.getvalue() == "fghijklmno"
+        assert buf.dropped == 5
+
+        # and only the end of a line which has not ended yet
+        lines = []
+        splitter = _LineSplitter("stdout", callback, 10)
+        for data in ("abc", "x" * 100, "defghij", "\nkl\r"):
+            splitter.feed(data)
+        assert len(splitter.partial) <= 10
+        assert lines == [("stdout", "xxxdefghij"), ("stdout", "kl")]
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--run":
+            test_run()
+        if sys.argv[1] == "--timeout":
+            test_timeout()
+        if sys.argv[1] == "--background":
+            test_background()
+        if sys.argv[1] == "--output":
+            test_output()
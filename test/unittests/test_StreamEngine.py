@@ -0,0 +1,153 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time, shutil, threading
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+
+from StreamEngine import StreamEngine
+
+if __name__ == '__main__':
+
+    class FakeController(object):
+        """
+        Stands in for a DatasetTransferController: dconfig is a dict
+        saying which directory to watch, how many steps to take and how
+        long each takes
+        """
+        shared_watcher = None
+        running = []
+        lock = threading.Lock()
+
+        def __init__(self, dconfig, debug_on = False):
+            self.dconfig = dconfig
+            self.steps = []
+
+        def setUp(self):
+            self.watched_dirs = (self.dconfig["dir"],)
+            self.shared_watcher.addDir(self.dconfig["dir"])
+            return None
+
+        def step(self):
+            self.lock.acquire()
+            try:
+                self.running.append(self.dconfig["dir"])
+                self.dconfig["most"] = max(self.dconfig.get("most", 0),
+                                           len(self.running))
+            finally:
+                self.lock.release()
+            time.sleep(self.dconfig["sleep"])
+            self.lock.acquire()
+            try:
+                self.running.remove(self.dconfig["dir"])
+            finally:
+                self.lock.release()
+            self.steps.append(time.time())
+            self.dconfig["steps"] = self.steps
+            if len(self.steps) == self.dconfig["count"]:
+                return "stopped"
+            return None
+
+        def getWait(self):
+            return (lambda name: name.endswith(".dat")), None
+
+        def getWaitTime(self, timeout = None):
+            if timeout != None:
+                return timeout
+            return self.dconfig["interval"]
+
+        def error(self, message):
+            self.dconfig["error"] = message
+
+        def tearDown(self):
+            self.dconfig["torn_down"] = True
+
+    def makeDirs(n):
+        base = "/tmp/test_stream_engine"
+        if os.path.exists(base):
+            shutil.rmtree(base)
+        dirs = []
+        for i in range(n):
+            dirs.append(os.path.join(base, "ds%d" % i))
+            os.makedirs(dirs[-1])
+        return dirs
+
+    def test_steps():
+        configs = [{"dir": dir_path, "count": 3, "sleep": 0.2,
+                    "interval": 0.1}
+                   for dir_path in makeDirs(6)]
+        # one data_stream whose step blocks for a while (e.g. waiting for
+        # a stop file to go)
+        configs[0].update(count = 1, sleep = 3)
+        engine = StreamEngine()
+        for i, dconfig in enumerate(configs):
+            engine.addStream("ds%d" % i, FakeController, dconfig)
+        start = time.time()
+        assert engine.run() == 0
+        for dconfig in configs[1:]:
+            assert len(dconfig["steps"]) == 3
+            # does not hold up the others
+            assert dconfig["steps"][-1] - start < 2.5, \
+                dconfig["steps"][-1] - start
+        assert max([dconfig["most"] for dconfig in configs]) > 2
+
+    def test_events():
+        dirs = makeDirs(2)
+        configs = [{"dir": dir_path, "count": 2, "sleep": 0,
+                    "interval": 30} for dir_path in dirs]
+        engine = StreamEngine(use_inotify = True)
+        if not engine.watcher.isEventDriven():
+            print "inotify not available - skipping"
+            return
+        for i, dconfig in enumerate(configs):
+            engine.addStream("ds%d" % i, FakeController, dconfig)
+
+        def arrive():
+            time.sleep(0.5)
+            # not of interest
+            open(os.path.join(dirs[0], "x.tmp"), "w").close()
+            time.sleep(0.5)
+            for dir_path in dirs:
+                open(os.path.join(dir_path, "x.dat"), "w").close()
+
+        start = time.time()
+        threading.Thread(target = arrive).start()
+        assert engine.run() == 0
+        # woken up by the files arriving, not the interval
+        assert time.time() - start < 5
+        for dconfig in configs:
+            assert dconfig["steps"][1] - start > 0.9
+
+    def test_failure():
+        dirs = makeDirs(2)
+        configs = [{"dir": dirs[0], "count": 2, "sleep": 0, "interval": 0},
+                   {"dir": dirs[1], "count": 2, "sleep": "oops",
+                    "interval": 0}]
+        engine = StreamEngine()
+        for i, dconfig in enumerate(configs):
+            engine.addStream("ds%d" % i, FakeController, dconfig)
+        # the other data_stream carries on
+        assert engine.run() == 1
+        assert len(configs[0]["steps"]) == 2
+        # and the one which failed has logged why, and let go of what it
+        # shared
+        assert "ds1 failed" in configs[1]["error"]
+        assert configs[1].get("torn_down")
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--steps":
+            test_steps()
+        if sys.argv[1] == "--events":
+            test_events()
+        if sys.argv[1] == "--failure":
+            test_failure()
@@ -0,0 +1,108 @@
+# BSD Licence
+# Copyright (c) 2012, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import sys, os, time, json
+
+this_dir = os.path.dirname(__file__)
+if os.path.basename(this_dir) != "unittests":
+    raise Exception("Must be run from 'test' directory to work.")
+
+top_dir = os.path.abspath(os.path.dirname(this_dir))
+lib_dir = os.path.join(top_dir, "../lib")
+sys.path.append(lib_dir)
+sys.path.append(os.path.join(lib_dir, "TransferModules"))
+
+from TransferMetrics import TransferMetrics, parseRsyncProgress, \
+    parseGlobusProgress
+from PendingReceipts import PendingReceipts
+
+if __name__ == '__main__':
+
+    def test_parse():
+        assert parseRsyncProgress("    105,185,280  49%   50.16MB/s    "
+                                  "0:00:02 (xfr#1, to-chk=0/2)") == \
+            (105185280, 2)
+        assert parseRsyncProgress("      1,048,576 100%  1.00GB/s    "
+                                  "1:02:03") == (1048576, 3723)
+        assert parseRsyncProgress(">f+++++++++|file1") == None
+        assert parseRsyncProgress("sent 1,234 bytes  received 35 bytes") \
+            == None
+        assert parseGlobusProgress("    524288000 bytes        50.00 MB/sec "
+                                   "avg        48.00 MB/sec inst") == \
+            (524288000, None)
+        assert parseGlobusProgress("Source: file:///tmp/") == None
+
+    def test_metrics():
+        path = "/tmp/test_transfer_status"
+        if os.path.exists(path):
+            os.remove(path)
+        metrics = TransferMetrics(path, "stream1", interval = 0.05)
+        metrics.start("file1", 1000)
+        assert json.load(open(path))["transfers"]["file1"]["total"] == 1000
+        time.sleep(0.1)
+        assert metrics.update("file1", 400)
+        assert not metrics.update("file1", 500)
+        entry = metrics.current["file1"]
+        assert entry["bytes"] == 500 and entry["rate"] > 0
+        assert entry["eta"] > 0
+        print metrics.describe("file1")
+        entry = metrics.finish("file1", True)
+        assert entry["bytes"] == 1000
+        print metrics.describe("file1", entry)
+
+        metrics.start("file2", 100, attempt = 2)
+        metrics.update("file2", 50)
+        metrics.finish("file2", False)
+        state = json.load(open(path))
+        assert state["transfers"] == {}
+        assert state["totals"]["transfers"] == 1
+        assert state["totals"]["bytes"] == 1000
+        assert state["totals"]["retries"] == 1
+        assert state["totals"]["failures"] == 1
+        assert state["last"]["item"] == "file2"
+        assert state["last"]["bytes"] == 50
+        os.remove(path)
+
+    def test_latency():
+        path = "/tmp/test_transfer_status"
+        metrics = TransferMetrics(path)
+        assert metrics.getReceiptLatency() == None
+        metrics.recordReceiptLatency(20)
+        assert metrics.getReceiptLatency() == 20
+        for i in range(20):
+            metrics.recordReceiptLatency(4)
+        assert 4 < metrics.getReceiptLatency() < 5
+        metrics.countPoll()
+        metrics.save(True)
+        state = json.load(open(path))
+        assert state["totals"]["polls"] == 1
+        assert 4 < state["receipt_latency"] < 5
+        os.remove(path)
+
+        # receipts are due straight after the push, then when marked
+        pending = PendingReceipts("/tmp/test_pending_receipts")
+        pending.add("file1", "file1.rcpt", "/tmp/file1.ctl", 10)
+        pending.add("file2", "file2.rcpt", "/tmp/file2.ctl", 10)
+        assert pending.getDue(5) == ["file1", "file2"]
+        pending.markPolled("file1", 30)
+        pending.markPolled("file2", 0.1)
+        assert pending.getDue(5) == []
+        assert pending.getNextDue(5) - time.time() < 0.2
+        time.sleep(0.2)
+        assert pending.getDue(5) == ["file2"]
+        pending.remove("file1")
+        pending.remove("file2")
+        pending.save()
+        assert pending.getNextDue(5) == None
+
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--parse":
+            test_parse()
+        if sys.argv[1] == "--metrics":
+            test_metrics()
+        if sys.argv[1] == "--latency":
+            test_latency()